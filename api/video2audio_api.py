@@ -1,9 +1,9 @@
 from fastapi import FastAPI, HTTPException
 from pydantic import BaseModel, Field
 from typing import Optional, Set
-from api.video2audio_func import video2audio
+from api.video2audio_func import video2audio, video2audio_candidates, video2audio_stream
 import asyncio
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 import redis
 import json
 import uuid
@@ -24,7 +24,8 @@ app.include_router(storage_router)
 # Redis 配置
 redis_client = redis.Redis(host='localhost', port=6379, db=0)
 QUEUE_KEY = "video2audio_queue"
-MAX_CONCURRENT_TASKS = 2
+# 模型端会把并发请求合并成一个批次 (mmaudio/batch_scheduler.py)，与其 MAX_BATCH_SIZE 保持一致
+MAX_CONCURRENT_TASKS = 8
 TASK_PREFIX = "v2a_task:"
 
 # 添加全局变量来跟踪运行中的任务
@@ -43,6 +44,10 @@ class Video2AudioRequest(BaseModel):
     user_id: str = Field(default="00000000000000000000000000000000", description="User ID")
     prompt: str = Field(default="", description="Prompt for the audio")
     negative_prompt: str = Field(default="music", description="Negative prompt for the audio")
+    num_samples: int = Field(default=1, ge=1, le=8, description="Number of candidates (ranked, best first)")
+
+class Video2AudioStreamRequest(Video2AudioRequest):
+    duration: float = Field(default=8, description="Duration of the preview in seconds")
 
 class TaskStatus(BaseModel):
     task_id: str
@@ -72,20 +77,35 @@ async def process_single_task(task_data: dict):
         redis_client.set(f"{TASK_PREFIX}{task_id}", json.dumps(task_info))
         
         try:
-            video_url = await asyncio.to_thread(
-                video2audio,
-                task_data["video_path"],
-                task_data["user_id"],
-                task_id,
-                task_data["prompt"],
-                task_data["negative_prompt"],
-            )
+            num_samples = task_data.get("num_samples", 1)
+            if num_samples > 1:
+                # 视频只编码一次，多个候选在同一批次中生成
+                video_urls, scores = await asyncio.to_thread(
+                    video2audio_candidates,
+                    task_data["video_path"],
+                    task_data["user_id"],
+                    task_id,
+                    task_data["prompt"],
+                    task_data["negative_prompt"],
+                    num_samples,
+                )
+                result = {"video_url": video_urls[0], "video_urls": video_urls, "scores": scores}
+            else:
+                video_url = await asyncio.to_thread(
+                    video2audio,
+                    task_data["video_path"],
+                    task_data["user_id"],
+                    task_id,
+                    task_data["prompt"],
+                    task_data["negative_prompt"],
+                )
+                result = {"video_url": video_url}
             # 更新任务状态为完成
             task_info.update({
                 "status": TaskState.COMPLETED,
                 "completed_at": datetime.now().isoformat(),
                 "updated_at": datetime.now().isoformat(),
-                "result": {"video_url": video_url}
+                "result": result
             })
         except Exception as e:
             # 更新任务状态为失败
@@ -151,6 +171,7 @@ async def convert_video_to_audio(request: Video2AudioRequest):
         "user_id": request.user_id,
         "prompt": request.prompt,
         "negative_prompt": request.negative_prompt,
+        "num_samples": request.num_samples,
         "created_at": created_time
     }
     pipe.rpush(QUEUE_KEY, json.dumps(task_data))
@@ -162,6 +183,29 @@ async def convert_video_to_audio(request: Video2AudioRequest):
         task_id=task_id
     )
 
+@app.post("/video2audio/stream")
+async def stream_video_to_audio(request: Video2AudioStreamRequest):
+    """
+    Server-sent events with the generated audio as base64 16-bit mono PCM blocks,
+    sent as soon as each block is decoded (for previews; the video is not remuxed)
+    """
+    def event_stream():
+        # 同步生成器，StreamingResponse 会在线程池中迭代
+        try:
+            for block in video2audio_stream(
+                request.video_path,
+                request.user_id,
+                request.prompt,
+                request.negative_prompt,
+                request.duration,
+            ):
+                yield f"event: audio\ndata: {json.dumps(block)}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        except Exception as e:
+            yield f"event: error\ndata: {json.dumps({'error': str(e)})}\n\n"
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
+
 @app.get("/task/{task_id}", response_model=TaskStatus)
 async def get_task_status(task_id: str):
     task_info = redis_client.get(f"{TASK_PREFIX}{task_id}")
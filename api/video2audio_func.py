@@ -4,10 +4,7 @@ from gradio_client import Client
 from api.utils.url_utils import remove_storage_prefix, add_storage_prefix
 from api.video_transport import download_blob, upload_blob
 
-def video2audio(video_path, user_id, task_id, prompt="", negative_prompt="music"):
-	client = Client("http://0.0.0.0:7860/")
-	print(f"生成有声视频: {video_path}")
-
+def get_local_video(video_path, user_id):
 	if video_path.startswith("https://"):
 		# 移除storage前缀
 		source_blob_name = remove_storage_prefix(video_path)
@@ -20,6 +17,32 @@ def video2audio(video_path, user_id, task_id, prompt="", negative_prompt="music"
 		print(f"下载视频文件完成: {local_file_path}")
 	else:
 		local_file_path = video_path
+	return local_file_path
+
+def video2audio_stream(video_path, user_id, prompt="", negative_prompt="music", duration=8):
+	"""Yields the PCM blocks (dicts with index/sampling_rate/pcm_s16le) as they are decoded"""
+	client = Client("http://0.0.0.0:7860/")
+	print(f"流式生成音频: {video_path}")
+	local_file_path = get_local_video(video_path, user_id)
+
+	job = client.submit(
+			video=local_file_path,
+			prompt=prompt if prompt else "",
+			negative_prompt=negative_prompt if negative_prompt else "music",
+			seed=-1,
+			num_steps=25,
+			cfg_strength=4.5,
+			duration=duration,
+			api_name="/video_to_audio_stream"
+	)
+	# 每个中间输出是一个PCM块
+	for block in job:
+		yield block
+
+def video2audio(video_path, user_id, task_id, prompt="", negative_prompt="music"):
+	client = Client("http://0.0.0.0:7860/")
+	print(f"生成有声视频: {video_path}")
+	local_file_path = get_local_video(video_path, user_id)
 
 	result = client.predict(
 			video=local_file_path,
@@ -45,4 +68,37 @@ def video2audio(video_path, user_id, task_id, prompt="", negative_prompt="music"
 	final_url = add_storage_prefix(upload_result)
 	print(f"上传有声视频文件到GCS完成: {final_url}")
 
-	return final_url
\ No newline at end of file
+	return final_url
+
+def video2audio_candidates(video_path, user_id, task_id, prompt="", negative_prompt="music", num_samples=4):
+	"""Generates num_samples candidates in one batch; returns their URLs and scores, best first"""
+	client = Client("http://0.0.0.0:7860/")
+	print(f"生成{num_samples}个候选有声视频: {video_path}")
+	local_file_path = get_local_video(video_path, user_id)
+
+	result = client.predict(
+			video=local_file_path,
+			prompt=prompt if prompt else "",
+			negative_prompt=negative_prompt if negative_prompt else "music",
+			seed=-1,
+			num_steps=25,
+			cfg_strength=4.5,
+			duration=80000000,
+			num_samples=num_samples,
+			user_id=user_id,
+			task_id=task_id,
+			api_name="/video_to_audio_candidates"
+	)
+	print(f"生成候选有声视频完成: {result}, user_id: {user_id}, task_id: {task_id}")
+
+	final_urls = []
+	for video in result["videos"]:
+		upload_result = upload_blob(
+			bucket_name="soundful",
+			source_file_name=video,
+			destination_blob_name=f"public/uploads/{user_id}/{os.path.basename(video)}"
+		)
+		final_urls.append(add_storage_prefix(upload_result))
+	print(f"上传候选有声视频文件到GCS完成: {final_urls}")
+
+	return final_urls, result["scores"]
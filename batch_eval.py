@@ -14,6 +14,7 @@ from mmaudio.data.data_setup import setup_eval_dataset
 from mmaudio.eval_utils import ModelConfig, all_model_cfg, generate
 from mmaudio.model.flow_matching import FlowMatching
 from mmaudio.model.networks import MMAudio, get_my_mmaudio
+from mmaudio.model.utils.batch_tuner import MicroBatchTuner
 from mmaudio.model.utils.features_utils import FeaturesUtils
 
 torch.backends.cuda.matmul.allow_tf32 = True
@@ -58,14 +59,23 @@ def main(cfg: DictConfig):
     rng.manual_seed(cfg.seed)
     fm = FlowMatching(cfg.sampling.min_sigma,
                       inference_mode=cfg.sampling.method,
-                      num_steps=cfg.sampling.num_steps)
+                      num_steps=cfg.sampling.num_steps,
+                      time_schedule=cfg.sampling.time_schedule,
+                      schedule_shift=cfg.sampling.schedule_shift,
+                      guidance_interval=cfg.sampling.guidance_interval,
+                      guidance_weights=cfg.sampling.guidance_weights,
+                      adaptive_guidance_threshold=cfg.sampling.adaptive_guidance_threshold)
 
     feature_utils = FeaturesUtils(tod_vae_ckpt=model.vae_path,
                                   synchformer_ckpt=model.synchformer_ckpt,
                                   enable_conditions=True,
                                   mode=model.mode,
                                   bigvgan_vocoder_ckpt=model.bigvgan_16k_path,
-                                  need_vae_encoder=False)
+                                  need_vae_encoder=False,
+                                  batch_tuner=MicroBatchTuner(
+                                      cfg.encoder_batch_sizes,
+                                      memory_headroom=cfg.encoder_memory_headroom),
+                                  clip_dedupe_threshold=cfg.clip_dedupe_threshold)
     feature_utils = feature_utils.to(device).eval()
 
     if cfg.compile:
@@ -76,6 +86,7 @@ def main(cfg: DictConfig):
     dataset, loader = setup_eval_dataset(cfg.dataset, cfg)
 
     with torch.amp.autocast(enabled=cfg.amp, dtype=torch.bfloat16, device_type=device):
+        feature_utils.tune_batch_sizes()
         for batch in tqdm(loader):
             audios = generate(batch.get('clip_video', None),
                               batch.get('sync_video', None),
@@ -84,14 +95,16 @@ def main(cfg: DictConfig):
                               net=net,
                               fm=fm,
                               rng=rng,
-                              cfg_strength=cfg.cfg_strength,
-                              clip_batch_size_multiplier=64,
-                              sync_batch_size_multiplier=64)
+                              cfg_strength=cfg.cfg_strength)
             audios = audios.float().cpu()
             names = batch['name']
             for audio, name in zip(audios, names):
                 torchaudio.save(output_dir / f'{name}.flac', audio, seq_cfg.sampling_rate)
 
+    if cfg.clip_dedupe_threshold is not None:
+        stats = feature_utils.clip_dedupe_stats
+        log.info(f'CLIP encoded {stats["encoded"]}/{stats["frames"]} frames after deduplication')
+
 
 def distributed_setup():
     distributed.init_process_group(backend="nccl")
@@ -0,0 +1,58 @@
+"""
+Wall time of the anti-aliased SnakeBeta activation of BigVGANv2 on the CPU: the torch version
+(transposed convolution, activation, strided convolution) against the polyphase CPU version, at
+the channel counts and lengths of the 44.1kHz vocoder for one second of audio.
+
+python -m benchmarks.bigvgan_activation
+"""
+import copy
+from argparse import ArgumentParser
+
+import torch
+
+from benchmarks.common import timeit
+from mmaudio.ext.bigvgan_v2.activations import SnakeBeta
+from mmaudio.ext.bigvgan_v2.alias_free_activation.cpu.activation1d import \
+    Activation1d as CpuActivation1d
+from mmaudio.ext.bigvgan_v2.alias_free_activation.torch.act import Activation1d
+
+# (channels, upsampling factor from the mel frames) of the AMP blocks of
+# bigvgan_v2_44khz_128band_512x (upsampling rates 8, 4, 2, 2, 2, 2)
+STAGES = [(768, 8), (384, 32), (192, 64), (96, 128), (48, 256), (24, 512)]
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--num_frames', type=int, default=87, help='mel frames (~1 s)')
+    parser.add_argument('--num_threads', type=int, default=None)
+    args = parser.parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    torch.manual_seed(0)
+    print(f'{"channels":>8} {"length":>8} {"torch (ms)":>10} {"cpu (ms)":>10} {"speedup":>8} '
+          f'{"max diff":>9}')
+    total_torch = total_cpu = 0
+    for channels, factor in STAGES:
+        act = SnakeBeta(channels, alpha_logscale=True)
+        with torch.no_grad():
+            for p in act.parameters():
+                p.normal_(std=0.3)
+        torch_act = Activation1d(act).eval()
+        cpu_act = CpuActivation1d(copy.deepcopy(act)).eval()
+        x = torch.randn(1, channels, args.num_frames * factor)
+
+        with torch.inference_mode():
+            torch_time, expected = timeit(lambda: torch_act(x))
+            cpu_time, out = timeit(lambda: cpu_act(x))
+        total_torch += torch_time
+        total_cpu += cpu_time
+        print(f'{channels:>8} {x.shape[-1]:>8} {torch_time * 1000:>10.2f} '
+              f'{cpu_time * 1000:>10.2f} {torch_time / cpu_time:>7.2f}x '
+              f'{(out - expected).abs().max().item():>9.2e}')
+    print(f'{"total":>17} {total_torch * 1000:>10.2f} {total_cpu * 1000:>10.2f} '
+          f'{total_torch / total_cpu:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
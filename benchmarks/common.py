@@ -0,0 +1,59 @@
+import time
+from typing import Callable
+
+import torch
+
+from mmaudio.model.networks import MMAudio, PreprocessedConditions
+
+
+def get_tiny_mmaudio(device: str = 'cpu', dtype: torch.dtype = torch.float32) -> MMAudio:
+    """
+    A small MMAudio network with random weights.
+    The default initialization zeros out the modulation and output layers, so we re-initialize.
+    """
+    torch.manual_seed(0)
+    num_heads = 4
+    net = MMAudio(latent_dim=40,
+                  clip_dim=1024,
+                  sync_dim=768,
+                  text_dim=1024,
+                  hidden_dim=64 * num_heads,
+                  depth=6,
+                  fused_depth=4,
+                  num_heads=num_heads,
+                  latent_seq_len=345,
+                  clip_seq_len=64,
+                  sync_seq_len=192,
+                  latent_mean=torch.zeros(40),
+                  latent_std=torch.ones(40),
+                  v2=True)
+    with torch.no_grad():
+        for p in net.parameters():
+            if p.requires_grad:
+                p.normal_(std=0.02)
+    return net.to(device, dtype).eval()
+
+
+def get_random_conditions(net: MMAudio, bs: int) -> tuple[PreprocessedConditions,
+                                                         PreprocessedConditions]:
+    device, dtype = net.device, net.latent_mean.dtype
+    clip_f = torch.randn(bs, net.clip_seq_len, 1024, device=device, dtype=dtype)
+    sync_f = torch.randn(bs, net.sync_seq_len, 768, device=device, dtype=dtype)
+    text_f = torch.randn(bs, 77, 1024, device=device, dtype=dtype)
+    conditions = net.preprocess_conditions(clip_f, sync_f, text_f)
+    empty_conditions = net.get_empty_conditions(bs)
+    return conditions, empty_conditions
+
+
+def timeit(fn: Callable, num_repeats: int = 3) -> tuple[float, object]:
+    # returns the best wall time in seconds and the output of the last run
+    best = float('inf')
+    for _ in range(num_repeats):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        out = fn()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best, out
@@ -0,0 +1,60 @@
+"""
+Quality/latency of reusing the fused-block residual across steps (FusedBlockCache)
+against the vanilla sampler, on a tiny random-weight network.
+
+python -m benchmarks.fused_block_cache
+"""
+from argparse import ArgumentParser
+
+import torch
+
+from benchmarks.common import get_random_conditions, get_tiny_mmaudio, timeit
+from mmaudio.model.flow_matching import FlowMatching
+from mmaudio.model.networks import FusedBlockCache
+
+
+@torch.inference_mode()
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--num_steps', type=int, default=25)
+    parser.add_argument('--cfg_strength', type=float, default=4.5)
+    args = parser.parse_args()
+
+    net = get_tiny_mmaudio(args.device)
+    conditions, empty_conditions = get_random_conditions(net, args.batch_size)
+    fm = FlowMatching(inference_mode='euler', num_steps=args.num_steps)
+
+    rng = torch.Generator(device=args.device).manual_seed(0)
+    x0 = torch.randn(args.batch_size,
+                     net.latent_seq_len,
+                     net.latent_dim,
+                     device=args.device,
+                     generator=rng)
+
+    def sample(refresh_interval: int, similarity_threshold: float = None):
+        caches = []
+        if refresh_interval > 1:
+            caches = [FusedBlockCache(refresh_interval, similarity_threshold) for _ in range(2)]
+        conditions.fused_block_cache, empty_conditions.fused_block_cache = (caches or [None, None])
+        fn = lambda t, x: net.ode_wrapper(t, x, conditions, empty_conditions, args.cfg_strength)
+        x1 = fm.to_data(fn, x0)
+        reused = sum(c.num_reused for c in caches)
+        total = sum(c.num_evaluations for c in caches)
+        return x1, reused, total
+
+    vanilla_time, (reference, _, _) = timeit(lambda: sample(1))
+    print(f'{"interval":>8} {"threshold":>9} {"reused":>9} {"time (s)":>9} {"speedup":>7} '
+          f'{"RMSE":>9}')
+    print(f'{"vanilla":>8} {"-":>9} {"-":>9} {vanilla_time:>9.4f} {1:>7.2f} {0:>9.5f}')
+    for interval in [2, 3, 4, 5]:
+        for threshold in [None, 0.95, 0.99]:
+            wall_time, (x1, reused, total) = timeit(lambda: sample(interval, threshold))
+            rmse = (x1 - reference).pow(2).mean().sqrt().item()
+            print(f'{interval:>8} {str(threshold):>9} {f"{reused}/{total}":>9} {wall_time:>9.4f} '
+                  f'{vanilla_time / wall_time:>7.2f} {rmse:>9.5f}')
+
+
+if __name__ == '__main__':
+    main()
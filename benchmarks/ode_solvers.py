@@ -0,0 +1,51 @@
+"""
+Compares the fixed-step ODE solvers in FlowMatching on a tiny random-weight network.
+Reports the wall time and the RMS distance to a 100-step Euler reference.
+
+python -m benchmarks.ode_solvers
+"""
+from argparse import ArgumentParser
+
+import torch
+
+from benchmarks.common import get_random_conditions, get_tiny_mmaudio, timeit
+from mmaudio.model.flow_matching import FlowMatching
+
+
+@torch.inference_mode()
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--cfg_strength', type=float, default=4.5)
+    args = parser.parse_args()
+
+    net = get_tiny_mmaudio(args.device)
+    conditions, empty_conditions = get_random_conditions(net, args.batch_size)
+    fn = lambda t, x: net.ode_wrapper(t, x, conditions, empty_conditions, args.cfg_strength)
+
+    rng = torch.Generator(device=args.device).manual_seed(0)
+    x0 = torch.randn(args.batch_size,
+                     net.latent_seq_len,
+                     net.latent_dim,
+                     device=args.device,
+                     generator=rng)
+
+    reference = FlowMatching(inference_mode='euler', num_steps=100).to_data(fn, x0)
+
+    print(f'{"method":>14} {"schedule":>8} {"steps":>5} {"NFE":>4} {"time (s)":>9} {"RMSE":>9}')
+    for method in ['euler', 'midpoint', 'heun', 'rk4', 'dpm_solver_2m']:
+        for schedule in ['linear', 'shifted', 'cosine']:
+            for num_steps in [8, 10, 12, 25]:
+                fm = FlowMatching(inference_mode=method,
+                                  num_steps=num_steps,
+                                  time_schedule=schedule)
+                wall_time, x1 = timeit(lambda: fm.to_data(fn, x0))
+                rmse = (x1 - reference).pow(2).mean().sqrt().item()
+                nfe = num_steps * fm.nfe_per_step * (2 if args.cfg_strength >= 1 else 1)
+                print(f'{method:>14} {schedule:>8} {num_steps:>5} {nfe:>4} '
+                      f'{wall_time:>9.4f} {rmse:>9.5f}')
+
+
+if __name__ == '__main__':
+    main()
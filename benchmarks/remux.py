@@ -0,0 +1,52 @@
+"""
+Wall time of writing the output video by copying the video packets (remux) against re-encoding
+every frame, on the example videos, with the resulting track durations.
+
+python -m benchmarks.remux
+"""
+import tempfile
+from argparse import ArgumentParser
+from pathlib import Path
+
+import av
+import torch
+
+from benchmarks.common import timeit
+from mmaudio.eval_utils import load_video, make_video
+
+EXAMPLE_DIR = Path(__file__).parents[1] / 'training/example_videos'
+
+
+def get_track_durations(video_path: Path) -> tuple[float, float]:
+    with av.open(video_path) as container:
+        video_stream = container.streams.video[0]
+        audio_stream = container.streams.audio[0]
+        return (float(video_stream.duration * video_stream.time_base),
+                float(audio_stream.duration * audio_stream.time_base))
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--duration', type=float, default=8.0)
+    parser.add_argument('--sampling_rate', type=int, default=44100)
+    args = parser.parse_args()
+
+    print(f'{"video":>24} {"mode":>8} {"time (s)":>9} {"size (MB)":>9} {"video (s)":>9} '
+          f'{"audio (s)":>9}')
+    with tempfile.TemporaryDirectory() as output_dir:
+        for video_path in sorted(EXAMPLE_DIR.glob('*.mp4')):
+            video_info = load_video(video_path, args.duration)
+            audio = torch.randn(1, int(video_info.duration_sec * args.sampling_rate)) * 0.1
+            for remux in [False, True]:
+                mode = 'remux' if remux else 'reencode'
+                output_path = Path(output_dir) / f'{video_path.stem}_{mode}.mp4'
+                wall_time, _ = timeit(lambda: make_video(
+                    video_info, output_path, audio, args.sampling_rate, remux=remux))
+                video_duration, audio_duration = get_track_durations(output_path)
+                size = output_path.stat().st_size / 2**20
+                print(f'{video_path.stem:>24} {mode:>8} {wall_time:>9.4f} {size:>9.2f} '
+                      f'{video_duration:>9.3f} {audio_duration:>9.3f}')
+
+
+if __name__ == '__main__':
+    main()
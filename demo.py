@@ -32,6 +32,11 @@ def main():
     parser.add_argument('--duration', type=float, default=8.0)
     parser.add_argument('--cfg_strength', type=float, default=4.5)
     parser.add_argument('--num_steps', type=int, default=25)
+    parser.add_argument('--inference_mode',
+                        type=str,
+                        default='euler',
+                        help='euler, heun, midpoint, rk4, dpm_solver_2m')
+    parser.add_argument('--time_schedule', type=str, default='linear', help='linear, shifted, cosine')
 
     parser.add_argument('--mask_away_clip', action='store_true')
 
@@ -81,7 +86,10 @@ def main():
     # misc setup
     rng = torch.Generator(device=device)
     rng.manual_seed(seed)
-    fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
+    fm = FlowMatching(min_sigma=0,
+                      inference_mode=args.inference_mode,
+                      num_steps=num_steps,
+                      time_schedule=args.time_schedule)
 
     feature_utils = FeaturesUtils(tod_vae_ckpt=model.vae_path,
                                   synchformer_ckpt=model.synchformer_ckpt,
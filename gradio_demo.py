@@ -1,5 +1,7 @@
-import os
+import base64
+import dataclasses
 import logging
+import os
 from argparse import ArgumentParser
 from datetime import datetime
 from fractions import Fraction
@@ -9,12 +11,19 @@ import gradio as gr
 import torch
 import torchaudio
 
-from mmaudio.eval_utils import (ModelConfig, VideoInfo, all_model_cfg, generate, load_image,
-                                load_video, make_video, setup_eval_logging)
+from mmaudio.batch_scheduler import BatchScheduler, GenerationRequest, ModelEntry
+from mmaudio.data.frame_preprocessor import FramePreprocessor
+from mmaudio.eval_utils import (ModelConfig, VideoInfo, all_model_cfg, generate,
+                                generate_candidates, generate_long, generate_streaming,
+                                load_and_encode_video, load_image, load_video, make_video,
+                                setup_eval_logging)
 from mmaudio.model.flow_matching import FlowMatching
 from mmaudio.model.networks import MMAudio, get_my_mmaudio
 from mmaudio.model.sequence_config import SequenceConfig
+from mmaudio.model.utils.batch_tuner import MicroBatchTuner
 from mmaudio.model.utils.features_utils import FeaturesUtils
+from mmaudio.utils.feature_cache import TextFeatureCache, VideoFeatureCache
+from mmaudio.utils.tensor_utils import make_generators
 
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
@@ -38,6 +47,8 @@ output_dir = Path('/workspace/tmp')
 
 setup_eval_logging()
 
+MAX_BATCH_SIZE = 8
+
 
 def get_model() -> tuple[MMAudio, FeaturesUtils, SequenceConfig]:
     seq_cfg = model.seq_cfg
@@ -51,44 +62,92 @@ def get_model() -> tuple[MMAudio, FeaturesUtils, SequenceConfig]:
                                   enable_conditions=True,
                                   mode=model.mode,
                                   bigvgan_vocoder_ckpt=model.bigvgan_16k_path,
-                                  need_vae_encoder=False)
+                                  need_vae_encoder=False,
+                                  text_cache=TextFeatureCache(output_dir / 'text_cache'),
+                                  batch_tuner=MicroBatchTuner(output_dir /
+                                                              'encoder_batch_sizes.json',
+                                                              memory_headroom=0.3),
+                                  clip_dedupe_threshold=1 / 255,
+                                  cpu_activation=device == 'cpu')
     feature_utils = feature_utils.to(device, dtype).eval()
+    # probed once per GPU and dtype; with more headroom than batch_eval for concurrent requests
+    feature_utils.tune_batch_sizes()
 
     return net, feature_utils, seq_cfg
 
 
 net, feature_utils, seq_cfg = get_model()
+# visual features of recently seen videos, so that retries with a new prompt or seed
+# skip the CLIP/Synchformer encoders
+feature_cache = VideoFeatureCache(output_dir / 'feature_cache')
+# the features depend on the encoders, the precision, and the CLIP frame deduplication only
+feature_variant = (f'clip_dfn5b_h14_384-synchformer-{dtype}'
+                   f'-dedupe{feature_utils.clip_dedupe_threshold}')
+# resizes the sampled frames on the GPU, one chunk at a time (load_and_encode_video) or for a
+# single image
+frame_preprocessor = FramePreprocessor(device=device)
+# load_video preprocesses all the frames of the upload at once, which stay on the CPU; the
+# windows of generate_long move their own frames to the GPU
+video_frame_preprocessor = FramePreprocessor()
+# batches concurrent requests of similar durations into one generate call
+scheduler = BatchScheduler(
+    {model.model_name: ModelEntry(net, feature_utils, seq_cfg)},
+    max_batch_size=MAX_BATCH_SIZE,
+    generate_kwargs={
+        'batch_cfg': True,
+        'precompute_modulation': True
+    },
+    feature_cache=feature_cache,
+).start()
 
 
 @torch.inference_mode()
 def video_to_audio(video: str, prompt: str, negative_prompt: str, seed: int, num_steps: int,
                    cfg_strength: float, duration: float, user_id: str, task_id: str):
     print(f"video: {video}")
-    rng = torch.Generator(device=device)
-    if seed >= 0:
-        rng.manual_seed(seed)
-    else:
-        rng.seed()
-    fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
-
-    video_info = load_video(video, duration)
+    # keyed by the requested duration, which is known before decoding
+    video_key = feature_cache.make_key(video, duration, feature_variant)
+    video_info = load_video(video, duration, frame_preprocessor=video_frame_preprocessor)
     clip_frames = video_info.clip_frames
     sync_frames = video_info.sync_frames
     duration = video_info.duration_sec
-    clip_frames = clip_frames.unsqueeze(0)
-    sync_frames = sync_frames.unsqueeze(0)
-    seq_cfg.duration = duration
-    net.update_seq_lengths(seq_cfg.latent_seq_len, seq_cfg.clip_seq_len, seq_cfg.sync_seq_len)
 
-    audios = generate(clip_frames,
-                      sync_frames, [prompt],
-                      negative_text=[negative_prompt],
-                      feature_utils=feature_utils,
-                      net=net,
-                      fm=fm,
-                      rng=rng,
-                      cfg_strength=cfg_strength)
-    audio = audios.float().cpu()[0]
+    if duration <= seq_cfg.duration:
+        audio = scheduler(
+            GenerationRequest(clip_frames,
+                              sync_frames,
+                              prompt,
+                              negative_prompt,
+                              duration,
+                              seed=seed,
+                              cfg_strength=cfg_strength,
+                              num_steps=num_steps,
+                              model_name=model.model_name,
+                              video_key=video_key))
+    else:
+        # videos longer than the training window (8s) are generated with overlapping windows,
+        # so the memory does not grow with the video length
+        rng = torch.Generator(device=device)
+        if seed >= 0:
+            rng.manual_seed(seed)
+        else:
+            rng.seed()
+        fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
+        audios = generate_long(clip_frames.unsqueeze(0),
+                               sync_frames.unsqueeze(0), [prompt],
+                               negative_text=[negative_prompt],
+                               feature_utils=feature_utils,
+                               net=net,
+                               fm=fm,
+                               rng=rng,
+                               cfg_strength=cfg_strength,
+                               batch_cfg=True,
+                               seq_cfg=seq_cfg,
+                               duration_sec=duration,
+                               precompute_modulation=True,
+                               feature_cache=feature_cache,
+                               video_keys=[video_key])
+        audio = audios.float().cpu()[0]
 
     # current_time_string = datetime.now().strftime('%Y%m%d_%H%M%S')
     # output_dir.mkdir(exist_ok=True, parents=True)
@@ -101,6 +160,108 @@ def video_to_audio(video: str, prompt: str, negative_prompt: str, seed: int, num
     return video_save_path
 
 
+@torch.inference_mode()
+def video_to_audio_candidates(video: str, prompt: str, negative_prompt: str, seed: int,
+                              num_steps: int, cfg_strength: float, duration: float,
+                              num_samples: int, user_id: str, task_id: str):
+    """
+    Generates num_samples candidates (seeds seed, seed + 1, ...) for one video, which is loaded
+    and encoded once. Returns the paths of the output videos ranked by av_sync_score.
+    """
+    num_samples = int(num_samples)
+    # the candidates are generated in one window of the model (the API asks for the whole video)
+    duration = min(duration, seq_cfg.duration)
+    # decoding overlaps with encoding
+    video_info, clip_features, sync_features = load_and_encode_video(
+        video,
+        duration,
+        feature_utils=feature_utils,
+        feature_cache=feature_cache,
+        video_key=feature_cache.make_key(video, duration, feature_variant),
+        frame_preprocessor=frame_preprocessor)
+    duration = video_info.duration_sec
+    request_seq_cfg = dataclasses.replace(seq_cfg, duration=duration)
+    seeds = [seed + i if seed >= 0 else -1 for i in range(num_samples)]
+    fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
+
+    audios, scores = generate_candidates(video_info.clip_frames.unsqueeze(0),
+                                         video_info.sync_frames.unsqueeze(0), [prompt],
+                                         negative_text=[negative_prompt],
+                                         feature_utils=feature_utils,
+                                         net=net,
+                                         fm=fm,
+                                         rng=make_generators(seeds, device),
+                                         cfg_strength=cfg_strength,
+                                         batch_cfg=True,
+                                         seq_cfg=request_seq_cfg,
+                                         precompute_modulation=True,
+                                         num_samples=num_samples,
+                                         sampling_rate=seq_cfg.sampling_rate,
+                                         video_features=(clip_features, sync_features))
+
+    _output_dir = f"/workspace/tmp/{user_id}" if user_id else "/workspace/tmp"
+    os.makedirs(_output_dir, exist_ok=True)
+    video_save_paths = []
+    for i, audio in enumerate(audios.float().cpu()[0]):
+        video_save_path = f"{_output_dir}/soundful_video_{task_id}_{i}.mp4"
+        make_video(video_info, video_save_path, audio, sampling_rate=seq_cfg.sampling_rate)
+        video_save_paths.append(video_save_path)
+    return {'videos': video_save_paths, 'scores': scores[0].tolist()}
+
+
+@torch.inference_mode()
+def video_to_audio_stream(video: str, prompt: str, negative_prompt: str, seed: int,
+                          num_steps: int, cfg_strength: float, duration: float):
+    """
+    Yields the generated audio in blocks of 16-bit little-endian mono PCM (base64-encoded)
+    as soon as each block is decoded, for previews.
+    """
+    rng = torch.Generator(device=device)
+    if seed >= 0:
+        rng.manual_seed(seed)
+    else:
+        rng.seed()
+    fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
+    # streamed in one window of the model, as for the candidates
+    duration = min(duration, seq_cfg.duration)
+
+    video_info, clip_features, sync_features = load_and_encode_video(
+        video,
+        duration,
+        feature_utils=feature_utils,
+        feature_cache=feature_cache,
+        video_key=feature_cache.make_key(video, duration, feature_variant),
+        frame_preprocessor=frame_preprocessor)
+    clip_frames = video_info.clip_frames.unsqueeze(0)
+    sync_frames = video_info.sync_frames.unsqueeze(0)
+    request_seq_cfg = dataclasses.replace(seq_cfg, duration=video_info.duration_sec)
+
+    audio_blocks = generate_streaming(clip_frames,
+                                      sync_frames, [prompt],
+                                      negative_text=[negative_prompt],
+                                      feature_utils=feature_utils,
+                                      net=net,
+                                      fm=fm,
+                                      rng=rng,
+                                      cfg_strength=cfg_strength,
+                                      batch_cfg=True,
+                                      seq_cfg=request_seq_cfg,
+                                      precompute_modulation=True,
+                                      video_features=(clip_features, sync_features))
+    num_samples = int(video_info.duration_sec * seq_cfg.sampling_rate)
+    offset = 0
+    for index, block in enumerate(audio_blocks):
+        # the last latent may cover more than the requested duration
+        block = block.float().cpu()[0, 0, :max(num_samples - offset, 0)]
+        offset += block.shape[-1]
+        pcm = (block.clamp(-1, 1) * 32767).to(torch.int16).numpy().tobytes()
+        yield {
+            'index': index,
+            'sampling_rate': seq_cfg.sampling_rate,
+            'pcm_s16le': base64.b64encode(pcm).decode('ascii'),
+        }
+
+
 @torch.inference_mode()
 def image_to_audio(image: gr.Image, prompt: str, negative_prompt: str, seed: int, num_steps: int,
                    cfg_strength: float, duration: float):
@@ -112,13 +273,13 @@ def image_to_audio(image: gr.Image, prompt: str, negative_prompt: str, seed: int
         rng.seed()
     fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
 
-    image_info = load_image(image)
+    image_info = load_image(image, frame_preprocessor=frame_preprocessor)
     clip_frames = image_info.clip_frames
     sync_frames = image_info.sync_frames
     clip_frames = clip_frames.unsqueeze(0)
     sync_frames = sync_frames.unsqueeze(0)
-    seq_cfg.duration = duration
-    net.update_seq_lengths(seq_cfg.latent_seq_len, seq_cfg.clip_seq_len, seq_cfg.sync_seq_len)
+    # per-request sequence config; the network itself is not mutated
+    request_seq_cfg = dataclasses.replace(seq_cfg, duration=duration)
 
     audios = generate(clip_frames,
                       sync_frames, [prompt],
@@ -128,7 +289,10 @@ def image_to_audio(image: gr.Image, prompt: str, negative_prompt: str, seed: int
                       fm=fm,
                       rng=rng,
                       cfg_strength=cfg_strength,
-                      image_input=True)
+                      image_input=True,
+                      batch_cfg=True,
+                      seq_cfg=request_seq_cfg,
+                      precompute_modulation=True)
     audio = audios.float().cpu()[0]
 
     current_time_string = datetime.now().strftime('%Y%m%d_%H%M%S')
@@ -143,26 +307,16 @@ def image_to_audio(image: gr.Image, prompt: str, negative_prompt: str, seed: int
 def text_to_audio(prompt: str, negative_prompt: str, seed: int, num_steps: int, cfg_strength: float,
                   duration: float):
 
-    rng = torch.Generator(device=device)
-    if seed >= 0:
-        rng.manual_seed(seed)
-    else:
-        rng.seed()
-    fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
-
-    clip_frames = sync_frames = None
-    seq_cfg.duration = duration
-    net.update_seq_lengths(seq_cfg.latent_seq_len, seq_cfg.clip_seq_len, seq_cfg.sync_seq_len)
-
-    audios = generate(clip_frames,
-                      sync_frames, [prompt],
-                      negative_text=[negative_prompt],
-                      feature_utils=feature_utils,
-                      net=net,
-                      fm=fm,
-                      rng=rng,
-                      cfg_strength=cfg_strength)
-    audio = audios.float().cpu()[0]
+    audio = scheduler(
+        GenerationRequest(None,
+                          None,
+                          prompt,
+                          negative_prompt,
+                          duration,
+                          seed=seed,
+                          cfg_strength=cfg_strength,
+                          num_steps=num_steps,
+                          model_name=model.model_name))
 
     current_time_string = datetime.now().strftime('%Y%m%d_%H%M%S')
     output_dir.mkdir(exist_ok=True, parents=True)
@@ -298,6 +452,47 @@ video_to_audio_tab = gr.Interface(
     # ]
     )
 
+# consumed by the API (api/video2audio_api.py) for requests with num_samples > 1
+video_to_audio_candidates_tab = gr.Interface(
+    fn=video_to_audio_candidates,
+    inputs=[
+        gr.Text(label='Video File Path'),
+        gr.Text(label='Prompt'),
+        gr.Text(label='Negative prompt', value='music'),
+        gr.Number(label='Seed (-1: random)', value=-1, precision=0, minimum=-1),
+        gr.Number(label='Num steps', value=25, precision=0, minimum=1),
+        gr.Number(label='Guidance Strength', value=4.5, minimum=1),
+        gr.Number(label='Duration (sec)', value=8, minimum=1),
+        gr.Number(label='Num candidates', value=4, precision=0, minimum=1),
+        gr.Text(label='User ID'),
+        gr.Text(label='Task ID'),
+    ],
+    outputs='json',
+    cache_examples=False,
+    title='MMAudio — Video-to-Audio Synthesis (multiple candidates)',
+    allow_flagging="never",
+    api_name='video_to_audio_candidates',
+)
+
+# consumed by the streaming endpoint of the API (api/video2audio_api.py)
+video_to_audio_stream_tab = gr.Interface(
+    fn=video_to_audio_stream,
+    inputs=[
+        gr.Text(label='Video File Path'),
+        gr.Text(label='Prompt'),
+        gr.Text(label='Negative prompt', value='music'),
+        gr.Number(label='Seed (-1: random)', value=-1, precision=0, minimum=-1),
+        gr.Number(label='Num steps', value=25, precision=0, minimum=1),
+        gr.Number(label='Guidance Strength', value=4.5, minimum=1),
+        gr.Number(label='Duration (sec)', value=8, minimum=1),
+    ],
+    outputs='json',
+    cache_examples=False,
+    title='MMAudio — Video-to-Audio Synthesis (streaming PCM)',
+    allow_flagging="never",
+    api_name='video_to_audio_stream',
+)
+
 text_to_audio_tab = gr.Interface(
     fn=text_to_audio,
     description="""
@@ -347,6 +542,17 @@ if __name__ == "__main__":
     parser.add_argument('--share', action='store_true')
     args = parser.parse_args()
 
-    gr.TabbedInterface([video_to_audio_tab, text_to_audio_tab, image_to_audio_tab],
-                       ['Video-to-Audio', 'Text-to-Audio', 'Image-to-Audio (experimental)']).launch(
-                           server_port=args.port, allowed_paths=[output_dir], share=args.share, show_error=True, server_name=args.host)
+    demo = gr.TabbedInterface([
+        video_to_audio_tab, text_to_audio_tab, image_to_audio_tab, video_to_audio_stream_tab,
+        video_to_audio_candidates_tab
+    ], [
+        'Video-to-Audio', 'Text-to-Audio', 'Image-to-Audio (experimental)',
+        'Video-to-Audio (streaming)', 'Video-to-Audio (candidates)'
+    ])
+    # concurrent requests are needed for the scheduler to form batches
+    demo.queue(default_concurrency_limit=MAX_BATCH_SIZE)
+    demo.launch(server_port=args.port,
+                allowed_paths=[output_dir],
+                share=args.share,
+                show_error=True,
+                server_name=args.host)
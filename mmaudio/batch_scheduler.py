@@ -0,0 +1,193 @@
+import dataclasses
+import logging
+import queue
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from typing import Any, Optional
+
+import torch
+
+from mmaudio.eval_utils import generate
+from mmaudio.model.flow_matching import FlowMatching
+from mmaudio.model.networks import MMAudio
+from mmaudio.model.sequence_config import SequenceConfig
+from mmaudio.model.utils.features_utils import FeaturesUtils
+from mmaudio.utils.feature_cache import VideoFeatureCache
+from mmaudio.utils.tensor_utils import make_generators
+
+log = logging.getLogger()
+
+
+@dataclasses.dataclass
+class GenerationRequest:
+    """
+    One sample to be generated by the BatchScheduler.
+    clip_frames/sync_frames: (T, C, H, W) as returned by load_video/load_image, or None
+    seed: < 0 for a random seed
+    video_key: key of the video features in the scheduler's feature_cache (None: not cached)
+    The result is a (1, L) float waveform on the CPU that covers duration_sec.
+    """
+    clip_frames: Optional[torch.Tensor]
+    sync_frames: Optional[torch.Tensor]
+    prompt: str
+    negative_prompt: str
+    duration_sec: float
+    seed: int = -1
+    cfg_strength: float = 4.5
+    num_steps: int = 25
+    model_name: str = 'default'
+    image_input: bool = False
+    video_key: Optional[str] = None
+
+    future: Future = dataclasses.field(default_factory=Future, init=False, repr=False)
+
+
+@dataclasses.dataclass
+class ModelEntry:
+    net: MMAudio
+    feature_utils: FeaturesUtils
+    seq_cfg: SequenceConfig
+
+
+class BatchScheduler:
+    """
+    Collects concurrent generation requests for up to max_wait_sec, groups them by
+    (model, number of steps, input type), and runs one batched generate call per group with
+    per-sample prompts, negative prompts, seeds, CFG strengths, and durations.
+    Requests of different durations share a padded batch (with per-sample sequence configs);
+    within a group, requests are sorted by duration so that the padding is kept small.
+    Requests are submitted from any thread and the batches run on a single worker thread.
+    With a feature_cache, the visual features of requests with a video_key are looked up in it
+    and only the missing videos are encoded.
+    """
+
+    def __init__(self,
+                 models: dict[str, ModelEntry],
+                 *,
+                 max_batch_size: int = 8,
+                 max_wait_sec: float = 0.05,
+                 generate_kwargs: Optional[dict[str, Any]] = None,
+                 feature_cache: Optional[VideoFeatureCache] = None):
+        self.models = models
+        self.max_batch_size = max_batch_size
+        self.max_wait_sec = max_wait_sec
+        self.generate_kwargs = generate_kwargs or {}
+        self.feature_cache = feature_cache
+
+        self._queue: queue.Queue[GenerationRequest] = queue.Queue()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+    def start(self) -> 'BatchScheduler':
+        if self._worker is None:
+            self._stop.clear()
+            self._worker = threading.Thread(target=self._run, name='batch_scheduler', daemon=True)
+            self._worker.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+
+    def submit(self, request: GenerationRequest) -> Future:
+        assert request.model_name in self.models, f'Unknown model: {request.model_name}'
+        self._queue.put(request)
+        return request.future
+
+    def __call__(self, request: GenerationRequest) -> torch.Tensor:
+        # blocking version of submit
+        return self.submit(request).result()
+
+    def batch_key(self, request: GenerationRequest) -> tuple:
+        return (request.model_name, request.num_steps, request.image_input,
+                request.clip_frames is None, request.sync_frames is None)
+
+    def _collect(self) -> list[GenerationRequest]:
+        try:
+            requests = [self._queue.get(timeout=0.1)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.max_wait_sec
+        while True:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                requests.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return requests
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            requests = self._collect()
+            groups = defaultdict(list)
+            for request in requests:
+                if request.future.set_running_or_notify_cancel():
+                    groups[self.batch_key(request)].append(request)
+
+            for key, group in groups.items():
+                group.sort(key=lambda r: r.duration_sec)
+                for i in range(0, len(group), self.max_batch_size):
+                    batch = group[i:i + self.max_batch_size]
+                    try:
+                        audios = self.run_batch(key, batch)
+                    except Exception as e:
+                        log.exception(f'Batch {key} of size {len(batch)} failed')
+                        for request in batch:
+                            request.future.set_exception(e)
+                        continue
+                    for request, audio in zip(batch, audios):
+                        request.future.set_result(audio)
+
+    @torch.inference_mode()
+    def run_batch(self, key: tuple, batch: list[GenerationRequest]) -> list[torch.Tensor]:
+        model_name, num_steps, image_input, no_clip, no_sync = key
+        model = self.models[model_name]
+        seq_cfg = [dataclasses.replace(model.seq_cfg, duration=r.duration_sec) for r in batch]
+        max_duration = max(r.duration_sec for r in batch)
+        device = model.feature_utils.device
+
+        def pad_frames(frames: torch.Tensor, num_frames: int) -> torch.Tensor:
+            # the padded frames are masked out in the network
+            if image_input or len(frames) >= num_frames:
+                return frames[:num_frames]
+            padding = frames.new_zeros(num_frames - len(frames), *frames.shape[1:])
+            return torch.cat([frames, padding])
+
+        clip_frames = sync_frames = None
+        if not no_clip:
+            num_frames = int(max_duration * model.seq_cfg.clip_frame_rate)
+            clip_frames = torch.stack([pad_frames(r.clip_frames, num_frames) for r in batch])
+        if not no_sync:
+            num_frames = int(max_duration * model.seq_cfg.sync_frame_rate)
+            sync_frames = torch.stack([pad_frames(r.sync_frames, num_frames) for r in batch])
+
+        # per-sample generators, so that a request's output does not depend on its batch
+        rng = make_generators([r.seed for r in batch], device)
+
+        fm = FlowMatching(min_sigma=0, inference_mode='euler', num_steps=num_steps)
+        audios = generate(clip_frames,
+                          sync_frames, [r.prompt for r in batch],
+                          negative_text=[r.negative_prompt for r in batch],
+                          feature_utils=model.feature_utils,
+                          net=model.net,
+                          fm=fm,
+                          rng=rng,
+                          cfg_strength=torch.tensor([r.cfg_strength for r in batch]),
+                          image_input=image_input,
+                          seq_cfg=seq_cfg,
+                          feature_cache=self.feature_cache,
+                          video_keys=[r.video_key for r in batch],
+                          **self.generate_kwargs)
+
+        log.info(f'Generated a batch of {len(batch)} ({model_name}, up to {max_duration}s)')
+        sampling_rate = model.seq_cfg.sampling_rate
+        return [
+            audio.float().cpu()[:, :int(request.duration_sec * sampling_rate)]
+            for request, audio in zip(batch, audios)
+        ]
@@ -1,7 +1,9 @@
+import queue
+import threading
 from dataclasses import dataclass
 from fractions import Fraction
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional, Union
 
 import av
 import numpy as np
@@ -9,20 +11,48 @@ import torch
 from av import AudioFrame
 
 
+@dataclass
+class FrameIndex:
+    """
+    The frames of a video within [start_sec, end_sec], kept as a reference to the source instead
+    of pixel data; iterating decodes them again as rgb24 arrays (e.g., for reencode_with_audio).
+    """
+    video_path: Path
+    start_sec: float
+    end_sec: float
+    num_frames: int
+    height: int
+    width: int
+
+    def __len__(self) -> int:
+        return self.num_frames
+
+    def __iter__(self) -> Iterator[np.ndarray]:
+        with av.open(self.video_path) as container:
+            stream = container.streams.video[0]
+            stream.thread_type = 'AUTO'
+            for frame in _decode_range(container, stream, self.start_sec, self.end_sec):
+                yield frame.to_ndarray(format='rgb24')
+
+
 @dataclass
 class VideoInfo:
     duration_sec: float
     fps: Fraction
     clip_frames: torch.Tensor
     sync_frames: torch.Tensor
-    all_frames: Optional[list[np.ndarray]]
+    all_frames: Optional[Union[list[np.ndarray], FrameIndex]]
 
     @property
     def height(self):
+        if isinstance(self.all_frames, FrameIndex):
+            return self.all_frames.height
         return self.all_frames[0].shape[0]
 
     @property
     def width(self):
+        if isinstance(self.all_frames, FrameIndex):
+            return self.all_frames.width
         return self.all_frames[0].shape[1]
 
     @classmethod
@@ -52,42 +82,201 @@ class ImageInfo:
         return self.original_frame.shape[1]
 
 
-def read_frames(video_path: Path, list_of_fps: list[float], start_sec: float, end_sec: float,
-                need_all_frames: bool) -> tuple[list[np.ndarray], list[np.ndarray], Fraction]:
-    output_frames = [[] for _ in list_of_fps]
+def _decode_range(container: av.container.InputContainer, stream: av.video.stream.VideoStream,
+                  start_sec: float, end_sec: float) -> Iterator[av.VideoFrame]:
+    # decodes the frames within [start_sec, end_sec] and stops demuxing after end_sec
+    if start_sec > 0:
+        container.seek(int(start_sec * av.time_base))
+    for packet in container.demux(stream):
+        for frame in packet.decode():
+            frame_time = frame.time
+            if frame_time < start_sec:
+                continue
+            if frame_time > end_sec:
+                return
+            yield frame
+
+
+def _sample_frames(container: av.container.InputContainer, stream: av.video.stream.VideoStream,
+                   list_of_fps: list[float], start_sec: float,
+                   end_sec: float) -> Iterator[tuple[av.VideoFrame, list[int]]]:
+    # yields each decoded frame and the indices into list_of_fps (with repetitions when the
+    # video has a lower frame rate) for which it is sampled
     next_frame_time_for_each_fps = [0.0 for _ in list_of_fps]
     time_delta_for_each_fps = [1 / fps for fps in list_of_fps]
+    for frame in _decode_range(container, stream, start_sec, end_sec):
+        sampled = []
+        for i, _ in enumerate(list_of_fps):
+            while frame.time >= next_frame_time_for_each_fps[i]:
+                sampled.append(i)
+                next_frame_time_for_each_fps[i] += time_delta_for_each_fps[i]
+        yield frame, sampled
+
+
+def _to_rgb24(frame: av.VideoFrame, frame_size: Optional[int]) -> np.ndarray:
+    # scaled by the decoder such that the short side is at most frame_size
+    short_side = min(frame.width, frame.height)
+    if frame_size is None or short_side <= frame_size:
+        return frame.to_ndarray(format='rgb24')
+    scale = frame_size / short_side
+    return frame.to_ndarray(format='rgb24',
+                            width=round(frame.width * scale),
+                            height=round(frame.height * scale),
+                            interpolation='BICUBIC')
+
+
+def read_frames(video_path: Path,
+                list_of_fps: list[float],
+                start_sec: float,
+                end_sec: float,
+                need_all_frames: bool,
+                *,
+                frame_size: Optional[int] = None,
+                index_all_frames: bool = False
+                ) -> tuple[list[np.ndarray], Union[list[np.ndarray], FrameIndex], Fraction]:
+    """
+    Samples the frames of the video within [start_sec, end_sec] at each fps in list_of_fps.
+    Only the sampled frames are converted to rgb24; a frame that is sampled at several rates
+    is shared.
+    frame_size: if given, the sampled frames are scaled by the decoder (bicubic) such that their
+        short side is at most frame_size, instead of being converted at the full resolution
+    need_all_frames: also return every frame within the range at the full resolution; with
+        index_all_frames, a FrameIndex that decodes them again on demand is returned instead
+    """
+    output_frames = [[] for _ in list_of_fps]
     all_frames = []
+    num_frames = 0
+    frame_height = frame_width = None
 
     # container = av.open(video_path)
     with av.open(video_path) as container:
         stream = container.streams.video[0]
         fps = stream.guessed_rate
         stream.thread_type = 'AUTO'
-        for packet in container.demux(stream):
-            for frame in packet.decode():
-                frame_time = frame.time
-                if frame_time < start_sec:
-                    continue
-                if frame_time > end_sec:
-                    break
+        for frame, sampled in _sample_frames(container, stream, list_of_fps, start_sec, end_sec):
+            num_frames += 1
+            if frame_height is None:
+                frame_height, frame_width = frame.height, frame.width
+
+            frame_np = None
+            if need_all_frames and not index_all_frames:
+                full_frame = frame.to_ndarray(format='rgb24')
+                all_frames.append(full_frame)
+                if frame_size is None:
+                    frame_np = full_frame
+
+            for i in sampled:
+                if frame_np is None:
+                    frame_np = _to_rgb24(frame, frame_size)
+                output_frames[i].append(frame_np)
+
+    if need_all_frames and index_all_frames:
+        all_frames = FrameIndex(video_path,
+                                start_sec,
+                                end_sec,
+                                num_frames=num_frames,
+                                height=frame_height,
+                                width=frame_width)
 
-                frame_np = None
-                if need_all_frames:
-                    frame_np = frame.to_ndarray(format='rgb24')
-                    all_frames.append(frame_np)
+    output_frames = [np.stack(frames) for frames in output_frames]
+    return output_frames, all_frames, fps
 
-                for i, _ in enumerate(list_of_fps):
-                    this_time = frame_time
-                    while this_time >= next_frame_time_for_each_fps[i]:
-                        if frame_np is None:
-                            frame_np = frame.to_ndarray(format='rgb24')
 
-                        output_frames[i].append(frame_np)
-                        next_frame_time_for_each_fps[i] += time_delta_for_each_fps[i]
+class FrameReader:
+    """
+    Samples the frames like read_frames(need_all_frames=True, index_all_frames=True), but in a
+    background thread: iterating yields (index into list_of_fps, (T, H, W, 3) uint8 array) chunks
+    of up to chunk_size consecutive sampled frames as soon as they are decoded. At most
+    max_queued_chunks chunks are buffered. fps and frame_index are set after the last chunk.
+    """
 
-    output_frames = [np.stack(frames) for frames in output_frames]
-    return output_frames, all_frames, fps
+    def __init__(self,
+                 video_path: Path,
+                 list_of_fps: list[float],
+                 start_sec: float,
+                 end_sec: float,
+                 *,
+                 frame_size: Optional[int] = None,
+                 chunk_size: int = 32,
+                 max_queued_chunks: int = 4):
+        self.video_path = video_path
+        self.list_of_fps = list_of_fps
+        self.start_sec = start_sec
+        self.end_sec = end_sec
+        self.frame_size = frame_size
+        self.chunk_size = chunk_size
+
+        self.fps: Optional[Fraction] = None
+        self.frame_index: Optional[FrameIndex] = None
+
+        self._queue = queue.Queue(max_queued_chunks)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='frame_reader', daemon=True)
+        self._thread.start()
+
+    def _put(self, item) -> bool:
+        # returns False if the reader is closed
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self) -> None:
+        try:
+            chunks = [[] for _ in self.list_of_fps]
+            num_frames = 0
+            frame_height = frame_width = None
+            with av.open(self.video_path) as container:
+                stream = container.streams.video[0]
+                self.fps = stream.guessed_rate
+                stream.thread_type = 'AUTO'
+                for frame, sampled in _sample_frames(container, stream, self.list_of_fps,
+                                                     self.start_sec, self.end_sec):
+                    num_frames += 1
+                    if frame_height is None:
+                        frame_height, frame_width = frame.height, frame.width
+
+                    frame_np = None
+                    for i in sampled:
+                        if frame_np is None:
+                            frame_np = _to_rgb24(frame, self.frame_size)
+                        chunks[i].append(frame_np)
+                        if len(chunks[i]) == self.chunk_size:
+                            if not self._put((i, np.stack(chunks[i]))):
+                                return
+                            chunks[i] = []
+
+            for i, chunk in enumerate(chunks):
+                if len(chunk) > 0 and not self._put((i, np.stack(chunk))):
+                    return
+            self.frame_index = FrameIndex(self.video_path,
+                                          self.start_sec,
+                                          self.end_sec,
+                                          num_frames=num_frames,
+                                          height=frame_height,
+                                          width=frame_width)
+            self._put(None)
+        except Exception as e:
+            self._put(e)
+
+    def __iter__(self) -> Iterator[tuple[int, np.ndarray]]:
+        try:
+            while True:
+                item = self._queue.get()
+                if item is None:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._thread.join()
 
 
 def reencode_with_audio(video_info: VideoInfo, output_path: Path, audio: torch.Tensor,
@@ -101,7 +290,7 @@ def reencode_with_audio(video_info: VideoInfo, output_path: Path, audio: torch.T
 
     output_audio_stream = container.add_stream('aac', sampling_rate)
 
-    # encode video
+    # encode video; a FrameIndex decodes the source frames one at a time
     for image in video_info.all_frames:
         image = av.VideoFrame.from_ndarray(image)
         packet = output_video_stream.encode(image)
@@ -124,39 +313,78 @@ def reencode_with_audio(video_info: VideoInfo, output_path: Path, audio: torch.T
     container.close()
 
 
-def remux_with_audio(video_path: Path, audio: torch.Tensor, output_path: Path, sampling_rate: int):
-    """
-    NOTE: I don't think we can get the exact video duration right without re-encoding
-    so we are not using this but keeping it here for reference
-    """
-    video = av.open(video_path)
-    output = av.open(output_path, 'w')
-    input_video_stream = video.streams.video[0]
-    output_video_stream = output.add_stream(template=input_video_stream)
-    output_audio_stream = output.add_stream('aac', sampling_rate)
-
-    duration_sec = audio.shape[-1] / sampling_rate
-
-    for packet in video.demux(input_video_stream):
-        # We need to skip the "flushing" packets that `demux` generates.
-        if packet.dts is None:
-            continue
-        # We need to assign the packet to the new stream.
-        packet.stream = output_video_stream
-        output.mux(packet)
-
-    # convert float tensor audio to numpy array
-    audio_np = audio.numpy().astype(np.float32)
-    audio_frame = av.AudioFrame.from_ndarray(audio_np, format='flt', layout='mono')
-    audio_frame.sample_rate = sampling_rate
-
-    for packet in output_audio_stream.encode(audio_frame):
-        output.mux(packet)
-
-    for packet in output_audio_stream.encode():
-        output.mux(packet)
+# video codecs that can be copied into an mp4 container as they are
+REMUX_CODECS = {'h264', 'hevc', 'mpeg4', 'av1', 'vp9'}
 
-    video.close()
-    output.close()
 
-    output.close()
+def remux_with_audio(video_path: Path,
+                     audio: torch.Tensor,
+                     output_path: Path,
+                     sampling_rate: int,
+                     end_sec: Optional[float] = None):
+    """
+    Copies the video packets of the frames of video_path within [0, end_sec] (the frames of
+    FrameIndex) into output_path without re-encoding, and adds the audio as an AAC track.
+    The video is only cut where the copied frames are a prefix of the stream in decoding order,
+    so that every frame they reference is copied as well and no later frame is; a cut after a
+    frame that is decoded after a later one (e.g., a B-frame that references the next P-frame)
+    raises ValueError instead, as it needs re-encoding (see reencode_with_audio).
+    The audio is trimmed or zero-padded to the duration of the copied video track, so the two
+    tracks end together. The muxer writes edit lists for the start of the tracks (the AAC
+    priming samples and the B-frame delay), so that both start exactly at zero.
+    Raises ValueError if the video codec cannot be copied into output_path.
+    """
+    with av.open(video_path) as video:
+        input_video_stream = video.streams.video[0]
+        codec_name = input_video_stream.codec_context.name
+        if codec_name not in REMUX_CODECS:
+            raise ValueError(f'Cannot copy {codec_name} video into {output_path}')
+
+        time_base = input_video_stream.time_base
+        packets = []
+        past_end = False
+        for packet in video.demux(input_video_stream):
+            # We need to skip the "flushing" packets that `demux` generates.
+            if packet.dts is None or packet.pts is None:
+                continue
+            if end_sec is not None and packet.pts * time_base > end_sec:
+                # no later packet has an earlier presentation time than its decoding time
+                if packet.dts * time_base > end_sec:
+                    break
+                past_end = True
+                continue
+            if past_end:
+                raise ValueError(f'Cannot cut {video_path} at {end_sec}s without re-encoding: '
+                                 f'the frame at {float(packet.pts * time_base):.3f}s is decoded '
+                                 'after a later frame')
+            packets.append(packet)
+
+        if len(packets) == 0:
+            raise ValueError(f'No video packets to copy from {video_path}')
+
+        with av.open(output_path, 'w') as output:
+            output_video_stream = output.add_stream_from_template(input_video_stream)
+            output_audio_stream = output.add_stream('aac', sampling_rate)
+
+            start_pts = min(packet.pts for packet in packets)
+            end_pts = max(packet.pts + (packet.duration or 0) for packet in packets)
+            for packet in packets:
+                # We need to assign the packet to the new stream.
+                packet.stream = output_video_stream
+                output.mux(packet)
+
+            num_samples = round(float((end_pts - start_pts) * time_base) * sampling_rate)
+            audio = audio[..., :num_samples]
+            if audio.shape[-1] < num_samples:
+                audio = torch.nn.functional.pad(audio, (0, num_samples - audio.shape[-1]))
+
+            # convert float tensor audio to numpy array
+            audio_np = audio.numpy().astype(np.float32)
+            audio_frame = av.AudioFrame.from_ndarray(audio_np, format='flt', layout='mono')
+            audio_frame.sample_rate = sampling_rate
+
+            for packet in output_audio_stream.encode(audio_frame):
+                output.mux(packet)
+
+            for packet in output_audio_stream.encode():
+                output.mux(packet)
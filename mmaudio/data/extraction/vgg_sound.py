@@ -7,9 +7,9 @@ import pandas as pd
 import torch
 import torchaudio
 from torch.utils.data.dataset import Dataset
-from torchvision.transforms import v2
 from torio.io import StreamingMediaDecoder
 
+from mmaudio.data.frame_preprocessor import FramePreprocessor
 from mmaudio.utils.dist_utils import local_rank
 
 log = logging.getLogger()
@@ -73,19 +73,7 @@ class VGGSound(Dataset):
         self.clip_expected_length = int(_CLIP_FPS * self.duration_sec)
         self.sync_expected_length = int(_SYNC_FPS * self.duration_sec)
 
-        self.clip_transform = v2.Compose([
-            v2.Resize((_CLIP_SIZE, _CLIP_SIZE), interpolation=v2.InterpolationMode.BICUBIC),
-            v2.ToImage(),
-            v2.ToDtype(torch.float32, scale=True),
-        ])
-
-        self.sync_transform = v2.Compose([
-            v2.Resize(_SYNC_SIZE, interpolation=v2.InterpolationMode.BICUBIC),
-            v2.CenterCrop(_SYNC_SIZE),
-            v2.ToImage(),
-            v2.ToDtype(torch.float32, scale=True),
-            v2.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-        ])
+        self.frame_preprocessor = FramePreprocessor(clip_size=_CLIP_SIZE, sync_size=_SYNC_SIZE)
 
         self.resampler = {}
 
@@ -163,14 +151,14 @@ class VGGSound(Dataset):
             raise RuntimeError(f'CLIP video wrong length {video_id}, '
                                f'expected {self.clip_expected_length}, '
                                f'got {clip_chunk.shape[0]}')
-        clip_chunk = self.clip_transform(clip_chunk)
+        clip_chunk = self.frame_preprocessor.clip(clip_chunk)
 
         sync_chunk = sync_chunk[:self.sync_expected_length]
         if sync_chunk.shape[0] != self.sync_expected_length:
             raise RuntimeError(f'Sync video wrong length {video_id}, '
                                f'expected {self.sync_expected_length}, '
                                f'got {sync_chunk.shape[0]}')
-        sync_chunk = self.sync_transform(sync_chunk)
+        sync_chunk = self.frame_preprocessor.sync(sync_chunk)
 
         data = {
             'id': video_id,
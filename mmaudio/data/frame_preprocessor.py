@@ -0,0 +1,70 @@
+from typing import Optional, Union
+
+import torch
+from torchvision.transforms import v2
+from torchvision.transforms.v2 import functional as TF
+
+CLIP_SIZE = 384
+SYNC_SIZE = 224
+
+
+class FramePreprocessor:
+    """
+    Shared preprocessing of (T, C, H, W) uint8 frames into the CLIP grid (CLIP_SIZE x CLIP_SIZE,
+    in [0, 1]) and the Synchformer grid (SYNC_SIZE center crop, in [-1, 1]).
+    All frames are resized at once in uint8 (bicubic, antialiased), first to an intermediate size
+    with a short side of CLIP_SIZE, from which both grids are derived; the conversion to float
+    comes last. The input frames can stay on the CPU; device: where the resizing runs,
+    e.g., the device of the encoders.
+    """
+
+    def __init__(self,
+                 *,
+                 clip_size: int = CLIP_SIZE,
+                 sync_size: int = SYNC_SIZE,
+                 device: Union[str, torch.device] = 'cpu',
+                 dtype: torch.dtype = torch.float32):
+        self.clip_size = clip_size
+        self.sync_size = sync_size
+        self.device = device
+        self.dtype = dtype
+
+    def _resize(self, frames: torch.Tensor, size: Union[int, list[int]]) -> torch.Tensor:
+        return TF.resize(frames, size, interpolation=v2.InterpolationMode.BICUBIC, antialias=True)
+
+    def intermediate(self, frames: torch.Tensor) -> torch.Tensor:
+        # moved to the device and scaled to a short side of (at most) clip_size, in uint8
+        assert frames.dtype == torch.uint8, f'{frames.dtype=}'
+        frames = frames.to(self.device, non_blocking=True)
+        if min(frames.shape[-2:]) > self.clip_size:
+            frames = self._resize(frames, self.clip_size)
+        return frames
+
+    def clip(self, frames: torch.Tensor, *, is_intermediate: bool = False) -> torch.Tensor:
+        if not is_intermediate:
+            frames = self.intermediate(frames)
+        frames = self._resize(frames, [self.clip_size, self.clip_size])
+        return frames.to(self.dtype) / 255
+
+    def sync(self, frames: torch.Tensor, *, is_intermediate: bool = False) -> torch.Tensor:
+        if not is_intermediate:
+            frames = self.intermediate(frames)
+        frames = TF.center_crop(self._resize(frames, self.sync_size), self.sync_size)
+        # normalized with mean = std = 0.5
+        return frames.to(self.dtype) / 127.5 - 1
+
+    def __call__(
+        self,
+        clip_frames: Optional[torch.Tensor],
+        sync_frames: Optional[torch.Tensor],
+    ) -> tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        clip_frames/sync_frames: the frames sampled for each grid, which may be the same tensor;
+        then, the intermediate resize is shared
+        """
+        if clip_frames is sync_frames and clip_frames is not None:
+            frames = self.intermediate(clip_frames)
+            return (self.clip(frames, is_intermediate=True), self.sync(frames,
+                                                                       is_intermediate=True))
+        return (self.clip(clip_frames) if clip_frames is not None else None,
+                self.sync(sync_frames) if sync_frames is not None else None)
@@ -1,20 +1,25 @@
 import dataclasses
 import logging
+import math
 from pathlib import Path
-from typing import Optional
+from typing import Iterator, Optional, Union
 
+import av
 import numpy as np
 import torch
 from colorlog import ColoredFormatter
 from PIL import Image
-from torchvision.transforms import v2
 
-from mmaudio.data.av_utils import ImageInfo, VideoInfo, read_frames, reencode_with_audio
+from mmaudio.data.av_utils import (FrameIndex, FrameReader, ImageInfo, VideoInfo, read_frames,
+                                   reencode_with_audio, remux_with_audio)
+from mmaudio.data.frame_preprocessor import FramePreprocessor
 from mmaudio.model.flow_matching import FlowMatching
-from mmaudio.model.networks import MMAudio
+from mmaudio.model.networks import FusedBlockCache, MMAudio, PreprocessedConditions
 from mmaudio.model.sequence_config import CONFIG_16K, CONFIG_44K, SequenceConfig
 from mmaudio.model.utils.features_utils import FeaturesUtils
 from mmaudio.utils.download_utils import download_model_if_needed
+from mmaudio.utils.feature_cache import VideoFeatureCache
+from mmaudio.utils.tensor_utils import randn_per_sample
 
 log = logging.getLogger()
 
@@ -77,7 +82,7 @@ all_model_cfg: dict[str, ModelConfig] = {
 }
 
 
-def generate(
+def generate_latents(
     clip_video: Optional[torch.Tensor],
     sync_video: Optional[torch.Tensor],
     text: Optional[list[str]],
@@ -86,64 +91,604 @@ def generate(
     feature_utils: FeaturesUtils,
     net: MMAudio,
     fm: FlowMatching,
-    rng: torch.Generator,
-    cfg_strength: float,
-    clip_batch_size_multiplier: int = 40,
-    sync_batch_size_multiplier: int = 40,
+    rng: Union[torch.Generator, list[Union[torch.Generator, int]]],
+    cfg_strength: Union[float, torch.Tensor],
+    clip_batch_size_multiplier: Optional[int] = None,
+    sync_batch_size_multiplier: Optional[int] = None,
     image_input: bool = False,
+    batch_cfg: bool = False,
+    seq_cfg: Optional[Union[SequenceConfig, list[SequenceConfig]]] = None,
+    precompute_modulation: bool = False,
+    fused_cache_interval: int = 1,
+    fused_cache_threshold: Optional[float] = None,
+    known_latents: Optional[torch.Tensor] = None,
+    known_mask: Optional[torch.Tensor] = None,
+    num_samples: int = 1,
+    feature_cache: Optional[VideoFeatureCache] = None,
+    video_keys: Optional[list[Optional[str]]] = None,
+    video_features: Optional[tuple[torch.Tensor, torch.Tensor]] = None,
 ) -> torch.Tensor:
+    """
+    Samples (normalized) latents; see generate for the waveform.
+    rng: a generator for the whole batch, or one generator or seed per sample; with the latter,
+        the noise of each sample does not depend on the rest of the batch
+    cfg_strength: a float, or a (B, ) tensor of per-sample strengths
+    clip_batch_size_multiplier, sync_batch_size_multiplier: the micro-batch sizes of the encoders
+        per video; None: the sizes tuned by feature_utils.batch_tuner, or 40 without one
+    seq_cfg: if given, the sequence lengths are taken from it instead of the ones set by
+        net.update_seq_lengths; this allows concurrent requests of different durations.
+        A list gives one config per sample for a padded batch of different durations: the videos
+        are padded to the longest one, and the returned latents are padded to the longest
+        latent length (see generate for per-sample outputs).
+    precompute_modulation: precompute the timestep embeddings and global adaLN modulations
+        for all steps of the (fixed-step) schedule once per request; ignored in adaptive
+        inference mode, whose evaluation times are not known in advance
+    fused_cache_interval: recompute the fused blocks every this many network evaluations and
+        reuse their residual in between (1: no reuse); see FusedBlockCache
+    fused_cache_threshold: also recompute when the similarity of the fused block inputs drops
+        below this
+    known_latents, known_mask: (B, N, C) normalized latents and a mask broadcastable to it;
+        the masked latents are fixed to known_latents (inpainting), e.g., for long-form generation
+    num_samples: number of candidates per video; the videos are encoded once and their features
+        are shared by the candidates, which are sampled in the same batch. text, negative_text,
+        seq_cfg, and cfg_strength can be given per video or per candidate, and rng per candidate.
+        The outputs are ordered by video, then by candidate.
+    feature_cache, video_keys: with one key (see VideoFeatureCache.make_key, None: not cached)
+        per video, the CLIP and Synchformer features are looked up in the cache and only the
+        missing videos are encoded; used when both videos are given and image_input is False
+    video_features: precomputed (B, N, D) CLIP and Synchformer features of the videos (e.g.,
+        from load_and_encode_video), which are used instead of encoding clip_video/sync_video
+    """
     device = feature_utils.device
     dtype = feature_utils.dtype
 
+    if num_samples > 1:
+        if clip_video is not None:
+            num_videos = len(clip_video)
+        elif sync_video is not None:
+            num_videos = len(sync_video)
+        else:
+            num_videos = len(text)
+        num_candidates = num_videos * num_samples
+        text = _repeat_per_candidate(text, num_samples, num_candidates)
+        negative_text = _repeat_per_candidate(negative_text, num_samples, num_candidates)
+        if isinstance(seq_cfg, list):
+            seq_cfg = _repeat_per_candidate(seq_cfg, num_samples, num_candidates)
+        if isinstance(cfg_strength, torch.Tensor) and len(cfg_strength) != num_candidates:
+            cfg_strength = cfg_strength.repeat_interleave(num_samples)
+
+    # per-sample (latent, clip, sync) lengths of a padded batch
+    seq_lens = None
+    if isinstance(seq_cfg, list):
+        assert len(seq_cfg) == len(text), f'{len(seq_cfg)=} {len(text)=}'
+        seq_lens = [(cfg.latent_seq_len, cfg.clip_seq_len, cfg.sync_seq_len) for cfg in seq_cfg]
+        latent_seq_len, clip_seq_len, sync_seq_len = (max(lens) for lens in zip(*seq_lens))
+        if len(set(seq_lens)) == 1:
+            seq_lens = None
+    elif seq_cfg is not None:
+        latent_seq_len = seq_cfg.latent_seq_len
+        clip_seq_len = seq_cfg.clip_seq_len
+        sync_seq_len = seq_cfg.sync_seq_len
+    else:
+        latent_seq_len = net.latent_seq_len
+        clip_seq_len = net.clip_seq_len
+        sync_seq_len = net.sync_seq_len
+
     bs = len(text)
+    if video_features is not None:
+        clip_features, sync_features = (f.to(device, dtype, non_blocking=True).repeat_interleave(
+            num_samples, dim=0) for f in video_features)
+        clip_video = sync_video = None
+    elif (feature_cache is not None and video_keys is not None and clip_video is not None
+            and sync_video is not None and not image_input):
+        # the unpadded lengths of each video's features
+        feature_lens = None
+        if seq_lens is not None:
+            feature_lens = [(clip_len, sync_len) for _, clip_len, sync_len in seq_lens]
+            feature_lens = feature_lens[::num_samples]
+        clip_features, sync_features = _encode_videos_with_cache(
+            clip_video,
+            sync_video,
+            feature_utils=feature_utils,
+            feature_cache=feature_cache,
+            video_keys=video_keys,
+            feature_lens=feature_lens,
+            clip_batch_size_multiplier=clip_batch_size_multiplier,
+            sync_batch_size_multiplier=sync_batch_size_multiplier)
+        clip_features = clip_features.repeat_interleave(num_samples, dim=0)
+        sync_features = sync_features.repeat_interleave(num_samples, dim=0)
+        clip_video = sync_video = None
+    else:
+        clip_features = sync_features = None
+
     if clip_video is not None:
         clip_video = clip_video.to(device, dtype, non_blocking=True)
-        clip_features = feature_utils.encode_video_with_clip(clip_video,
-                                                             batch_size=bs *
-                                                             clip_batch_size_multiplier)
+        clip_features = feature_utils.encode_video_with_clip(
+            clip_video,
+            batch_size=_encoder_batch_size(len(clip_video), clip_batch_size_multiplier,
+                                           feature_utils))
+        clip_features = clip_features.repeat_interleave(num_samples, dim=0)
         if image_input:
-            clip_features = clip_features.expand(-1, net.clip_seq_len, -1)
-    else:
-        clip_features = net.get_empty_clip_sequence(bs)
+            clip_features = clip_features.expand(-1, clip_seq_len, -1)
+    elif clip_features is None:
+        clip_features = net.get_empty_clip_sequence(bs, clip_seq_len)
 
     if sync_video is not None and not image_input:
         sync_video = sync_video.to(device, dtype, non_blocking=True)
-        sync_features = feature_utils.encode_video_with_sync(sync_video,
-                                                             batch_size=bs *
-                                                             sync_batch_size_multiplier)
-    else:
-        sync_features = net.get_empty_sync_sequence(bs)
+        sync_features = feature_utils.encode_video_with_sync(
+            sync_video,
+            batch_size=_encoder_batch_size(len(sync_video), sync_batch_size_multiplier,
+                                           feature_utils))
+        sync_features = sync_features.repeat_interleave(num_samples, dim=0)
+    elif sync_features is None:
+        sync_features = net.get_empty_sync_sequence(bs, sync_seq_len)
 
     if text is not None:
         text_features = feature_utils.encode_text(text)
     else:
         text_features = net.get_empty_string_sequence(bs)
 
-    if negative_text is not None:
-        assert len(negative_text) == bs
-        negative_text_features = feature_utils.encode_text(negative_text)
+    if isinstance(rng, torch.Generator) and seq_lens is None:
+        x0 = torch.randn(bs,
+                         latent_seq_len,
+                         net.latent_dim,
+                         device=device,
+                         dtype=dtype,
+                         generator=rng)
     else:
-        negative_text_features = net.get_empty_string_sequence(bs)
-
-    x0 = torch.randn(bs,
-                     net.latent_seq_len,
-                     net.latent_dim,
-                     device=device,
-                     dtype=dtype,
-                     generator=rng)
-    preprocessed_conditions = net.preprocess_conditions(clip_features, sync_features, text_features)
-    empty_conditions = net.get_empty_conditions(
-        bs, negative_text_features=negative_text_features if negative_text is not None else None)
-
-    cfg_ode_wrapper = lambda t, x: net.ode_wrapper(t, x, preprocessed_conditions, empty_conditions,
-                                                   cfg_strength)
+        if isinstance(rng, torch.Generator):
+            rng = [rng] * bs
+        assert len(rng) == bs, f'{len(rng)=} {bs=}'
+        # each sample is drawn at its own length and zero-padded
+        if seq_lens is not None:
+            latent_lens = [lens[0] for lens in seq_lens]
+        else:
+            latent_lens = [latent_seq_len] * bs
+        x0 = randn_per_sample(rng,
+                              latent_lens,
+                              net.latent_dim,
+                              max_length=latent_seq_len,
+                              device=device,
+                              dtype=dtype)
+    if isinstance(cfg_strength, torch.Tensor):
+        cfg_strength = cfg_strength.to(device, dtype)
+    preprocessed_conditions = net.preprocess_conditions(clip_features,
+                                                        sync_features,
+                                                        text_features,
+                                                        latent_seq_len=latent_seq_len,
+                                                        seq_lens=seq_lens)
+    # memoized per negative text; the text encoder only runs for unseen negative prompts
+    empty_conditions = net.get_cached_empty_conditions(
+        bs,
+        negative_text=negative_text,
+        encode_text=feature_utils.encode_text,
+        seq_lengths=seq_lens if seq_lens is not None else
+        (latent_seq_len, clip_seq_len, sync_seq_len))
+
+    times = fm.get_evaluation_times(0, 1) if precompute_modulation else None
+    if precompute_modulation and times is None:
+        log.warning('The modulation cannot be precomputed in adaptive inference mode')
+    # per-step CFG strengths, if the FlowMatching object is configured with a guidance schedule
+    guidance = fm.get_guidance_schedule(cfg_strength)
+    if batch_cfg:
+        # run the conditional and unconditional branches in a single forward pass
+        joint_conditions = PreprocessedConditions.cat([preprocessed_conditions, empty_conditions])
+        if times is not None:
+            joint_conditions.modulation = net.build_modulation_plan(times, joint_conditions)
+        all_conditions = [joint_conditions]
+        cfg_ode_wrapper = lambda t, x: net.ode_wrapper_batched(t, x, joint_conditions, cfg_strength,
+                                                               guidance)
+    else:
+        if times is not None:
+            preprocessed_conditions.modulation = net.build_modulation_plan(
+                times, preprocessed_conditions)
+            empty_conditions.modulation = net.build_modulation_plan(times, empty_conditions)
+        all_conditions = [preprocessed_conditions, empty_conditions]
+        cfg_ode_wrapper = lambda t, x: net.ode_wrapper(t, x, preprocessed_conditions,
+                                                       empty_conditions, cfg_strength, guidance)
+
+    if fused_cache_interval > 1:
+        for conditions in all_conditions:
+            conditions.fused_block_cache = FusedBlockCache(
+                refresh_interval=fused_cache_interval, similarity_threshold=fused_cache_threshold)
+
+    if known_latents is not None:
+        # keep the known latents on their conditional flow path from x0,
+        # i.e., x_t = (1 - (1 - min_sigma) * t) * x0 + t * x1, which has a constant velocity
+        # that all the solvers integrate exactly
+        known_flow = known_latents.to(device, dtype) - (1 - fm.min_sigma) * x0
+        known_mask = known_mask.to(device)
+        unknown_ode_wrapper = cfg_ode_wrapper
+        cfg_ode_wrapper = lambda t, x: torch.where(known_mask, known_flow,
+                                                   unknown_ode_wrapper(t, x))
+
     x1 = fm.to_data(cfg_ode_wrapper, x0)
+    for conditions in all_conditions:
+        if conditions.fused_block_cache is not None:
+            cache = conditions.fused_block_cache
+            log.debug(f'Fused blocks reused in {cache.num_reused}/{cache.num_evaluations} '
+                      'evaluations')
+    if guidance is not None:
+        log.debug(f'CFG applied in {guidance.num_guided}/'
+                  f'{guidance.num_guided + guidance.num_unguided} evaluations')
+    return x1
+
+
+def _encoder_batch_size(num_videos: int, multiplier: Optional[int],
+                        feature_utils: FeaturesUtils) -> int:
+    # -1: the size tuned by the batch tuner of feature_utils
+    if multiplier is None:
+        return -1 if feature_utils.batch_tuner is not None else num_videos * 40
+    return num_videos * multiplier
+
+
+def _encode_videos_with_cache(
+    clip_video: torch.Tensor,
+    sync_video: torch.Tensor,
+    *,
+    feature_utils: FeaturesUtils,
+    feature_cache: VideoFeatureCache,
+    video_keys: list[Optional[str]],
+    feature_lens: Optional[list[tuple[int, int]]],
+    clip_batch_size_multiplier: Optional[int],
+    sync_batch_size_multiplier: Optional[int],
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Encodes the videos that are not in feature_cache and stores their features.
+    feature_lens: per-video (clip, sync) lengths of the unpadded features; the features are cached
+        without the padding and zero-padded to the batch (the padding is masked out in the network)
+    """
+    assert len(video_keys) == len(clip_video), f'{len(video_keys)=} {len(clip_video)=}'
+    device = feature_utils.device
+    dtype = feature_utils.dtype
+
+    features = [feature_cache.get(key) if key is not None else None for key in video_keys]
+    missing = [i for i, f in enumerate(features) if f is None]
+    if len(missing) > 0:
+        clip_video = clip_video[missing].to(device, dtype, non_blocking=True)
+        sync_video = sync_video[missing].to(device, dtype, non_blocking=True)
+        clip_features = feature_utils.encode_video_with_clip(
+            clip_video,
+            batch_size=_encoder_batch_size(len(missing), clip_batch_size_multiplier,
+                                           feature_utils))
+        sync_features = feature_utils.encode_video_with_sync(
+            sync_video,
+            batch_size=_encoder_batch_size(len(missing), sync_batch_size_multiplier,
+                                           feature_utils))
+        for j, i in enumerate(missing):
+            if feature_lens is not None:
+                clip_len, sync_len = feature_lens[i]
+            else:
+                clip_len, sync_len = clip_features.shape[1], sync_features.shape[1]
+            features[i] = (clip_features[j, :clip_len], sync_features[j, :sync_len])
+            if video_keys[i] is not None:
+                feature_cache.put(video_keys[i], *features[i])
+
+    def pad_and_stack(tensors: list[torch.Tensor]) -> torch.Tensor:
+        length = max(len(t) for t in tensors)
+        tensors = [t.to(device, dtype, non_blocking=True) for t in tensors]
+        return torch.stack([
+            torch.cat([t, t.new_zeros(length - len(t), *t.shape[1:])]) if len(t) < length else t
+            for t in tensors
+        ])
+
+    return pad_and_stack([f[0] for f in features]), pad_and_stack([f[1] for f in features])
+
+
+def _repeat_per_candidate(values: Optional[list], num_samples: int,
+                          num_candidates: int) -> Optional[list]:
+    # per-video values are repeated for each of their candidates
+    if values is None or len(values) == num_candidates:
+        return values
+    assert len(values) * num_samples == num_candidates, f'{len(values)=} {num_candidates=}'
+    return [value for value in values for _ in range(num_samples)]
+
+
+def decode_latents(x1: torch.Tensor, *, feature_utils: FeaturesUtils, net: MMAudio) -> torch.Tensor:
+    # NOTE: unnormalizes x1 in-place
     x1 = net.unnormalize(x1)
     spec = feature_utils.decode(x1)
     audio = feature_utils.vocode(spec)
     return audio
 
 
+def decode_latents_streaming(x1: torch.Tensor,
+                             *,
+                             feature_utils: FeaturesUtils,
+                             net: MMAudio,
+                             chunk_len: int = 32,
+                             context_len: int = 32) -> Iterator[torch.Tensor]:
+    """
+    Decodes and vocodes the latents chunk by chunk and yields consecutive waveform blocks that
+    concatenate to the full waveform.
+    chunk_len: number of latents per yielded block
+    context_len: number of extra latents decoded on each side of a chunk and discarded afterwards
+        to hide the seams
+    The peak decoder memory is bounded by chunk_len + 2 * context_len latents.
+    The convolutions of the VAE decoder see about 21 latents on each side, and those of the
+    vocoder about 22 mel frames (11 latents), so the default context reproduces them exactly.
+    The mid-block attention of the VAE decoder sees the whole sequence, though, so the blocks
+    are not exactly the full decode: with the 16k decoder, the relative error is within 5%
+    (see test_decode_latents_streaming_seams).
+    """
+    # NOTE: unnormalizes x1 in-place
+    x1 = net.unnormalize(x1)
+    seq_len = x1.shape[1]
+    for start in range(0, seq_len, chunk_len):
+        end = min(start + chunk_len, seq_len)
+        lo = max(start - context_len, 0)
+        hi = min(end + context_len, seq_len)
+        spec = feature_utils.decode(x1[:, lo:hi])
+        audio = feature_utils.vocode(spec)
+        # both the decoder and the vocoder upsample by an integer factor
+        samples_per_latent = audio.shape[-1] // (hi - lo)
+        yield audio[..., (start - lo) * samples_per_latent:(end - lo) * samples_per_latent]
+
+
+def generate_streaming(clip_video: Optional[torch.Tensor],
+                       sync_video: Optional[torch.Tensor],
+                       text: Optional[list[str]],
+                       *,
+                       feature_utils: FeaturesUtils,
+                       net: MMAudio,
+                       chunk_len: int = 32,
+                       context_len: int = 32,
+                       **kwargs) -> Iterator[torch.Tensor]:
+    """
+    Same as generate, but yields the waveform in blocks as soon as they are decoded;
+    see decode_latents_streaming.
+    """
+    x1 = generate_latents(clip_video,
+                          sync_video,
+                          text,
+                          feature_utils=feature_utils,
+                          net=net,
+                          **kwargs)
+    yield from decode_latents_streaming(x1,
+                                        feature_utils=feature_utils,
+                                        net=net,
+                                        chunk_len=chunk_len,
+                                        context_len=context_len)
+
+
+def generate(clip_video: Optional[torch.Tensor], sync_video: Optional[torch.Tensor],
+             text: Optional[list[str]], *, feature_utils: FeaturesUtils, net: MMAudio,
+             **kwargs) -> Union[torch.Tensor, list[torch.Tensor]]:
+    """
+    Takes the same arguments as generate_latents and returns the waveform.
+    With a list of per-sample seq_cfg, returns a list with the waveform of each sample,
+    trimmed to its own length.
+    """
+    x1 = generate_latents(clip_video,
+                          sync_video,
+                          text,
+                          feature_utils=feature_utils,
+                          net=net,
+                          **kwargs)
+    seq_cfg = kwargs.get('seq_cfg')
+    if isinstance(seq_cfg, list):
+        seq_cfg = _repeat_per_candidate(seq_cfg, kwargs.get('num_samples', 1), len(x1))
+        # the padded latents are not decoded
+        return [
+            decode_latents(x1[i:i + 1, :cfg.latent_seq_len], feature_utils=feature_utils,
+                           net=net)[0] for i, cfg in enumerate(seq_cfg)
+        ]
+    return decode_latents(x1, feature_utils=feature_utils, net=net)
+
+
+def generate_candidates(clip_video: Optional[torch.Tensor],
+                        sync_video: Optional[torch.Tensor],
+                        text: Optional[list[str]],
+                        *,
+                        feature_utils: FeaturesUtils,
+                        net: MMAudio,
+                        num_samples: int,
+                        sampling_rate: int,
+                        rank: bool = True,
+                        **kwargs) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Generates num_samples candidates per video (see generate_latents) that share the encoded
+    visual features.
+    Returns the waveforms (B, num_samples, ...) and their scores (B, num_samples);
+    with rank, the candidates of each video are sorted by decreasing av_sync_score.
+    With a list of per-sample seq_cfg, the waveforms are zero-padded to the longest one, and
+    each is scored over its own length.
+    """
+    audio = generate(clip_video,
+                     sync_video,
+                     text,
+                     feature_utils=feature_utils,
+                     net=net,
+                     num_samples=num_samples,
+                     **kwargs)
+    lengths = None
+    if isinstance(audio, list):
+        lengths = [a.shape[-1] for a in audio]
+        audio = torch.stack(
+            [torch.nn.functional.pad(a, (0, max(lengths) - a.shape[-1])) for a in audio])
+    audio = audio.unflatten(0, (-1, num_samples))
+    if not rank or sync_video is None:
+        return audio, audio.new_zeros(audio.shape[:2])
+
+    sync_video = sync_video.repeat_interleave(num_samples, dim=0)
+    if lengths is None:
+        scores = av_sync_score(audio.flatten(0, 1), sync_video, sampling_rate=sampling_rate)
+    else:
+        # the padded frames of shorter videos fall outside of their audio
+        scores = torch.cat([
+            av_sync_score(a[None, ..., :length], v[None], sampling_rate=sampling_rate)
+            for a, v, length in zip(audio.flatten(0, 1), sync_video, lengths)
+        ])
+    scores = scores.unflatten(0, (-1, num_samples))
+    order = scores.argsort(dim=1, descending=True)
+    audio = audio[torch.arange(len(audio)).unsqueeze(1), order.to(audio.device)]
+    return audio, scores.gather(1, order)
+
+
+def av_sync_score(audio: torch.Tensor,
+                  sync_video: torch.Tensor,
+                  *,
+                  sampling_rate: int,
+                  fps: float = 25.0) -> torch.Tensor:
+    """
+    A cheap audio-visual agreement score for ranking candidates: the Pearson correlation between
+    the visual motion energy (mean absolute frame difference) and the audio loudness (RMS) at
+    the video frame rate.
+    audio: (B, 1, L) or (B, L); sync_video: (B, T, C, H, W)
+    Returns (B, ) scores in [-1, 1].
+    """
+    sync_video = sync_video.to(audio.device, torch.float32)
+    motion = (sync_video[:, 1:] - sync_video[:, :-1]).abs().flatten(2).mean(dim=2)  # (B, T-1)
+
+    audio = audio.reshape(len(audio), -1).float()
+    hop = int(round(sampling_rate / fps))
+    num_frames = min(motion.shape[1], audio.shape[1] // hop - 1)
+    # the loudness of the audio frame that ends at each video frame transition
+    loudness = audio[:, hop:hop * (num_frames + 1)].unflatten(1, (num_frames, hop))
+    loudness = loudness.square().mean(dim=2).sqrt()  # (B, T-1)
+    motion = motion[:, :num_frames]
+
+    motion = motion - motion.mean(dim=1, keepdim=True)
+    loudness = loudness - loudness.mean(dim=1, keepdim=True)
+    return (motion * loudness).sum(dim=1) / (motion.norm(dim=1) * loudness.norm(dim=1) + 1e-8)
+
+
+def generate_long(
+    clip_video: Optional[torch.Tensor],
+    sync_video: Optional[torch.Tensor],
+    text: list[str],
+    *,
+    negative_text: Optional[list[str]] = None,
+    feature_utils: FeaturesUtils,
+    net: MMAudio,
+    seq_cfg: SequenceConfig,
+    duration_sec: float,
+    overlap_sec: float = 1.0,
+    condition_on_previous: bool = True,
+    window_batch_size: int = 4,
+    video_keys: Optional[list[Optional[str]]] = None,
+    **kwargs,
+) -> torch.Tensor:
+    """
+    Long-form generation with overlapping fixed-length windows so that the peak memory is
+    constant and the attention cost is linear in the duration.
+    seq_cfg: the window, e.g., CONFIG_44K (8s); duration_sec: the total duration
+    clip_video/sync_video: (B, T, C, H, W) covering the total duration (can stay on the CPU)
+    condition_on_previous: inpaint the overlapping latents of each window with those generated
+        by the previous window; otherwise, the windows are independent and generated in batches
+        of window_batch_size
+    The audio of adjacent windows is crossfaded over the overlap.
+    Other arguments are passed to generate_latents.
+    """
+    sampling_rate = seq_cfg.sampling_rate
+    samples_per_latent = seq_cfg.spectrogram_frame_rate * seq_cfg.latent_downsample_rate
+    latent_rate = sampling_rate / samples_per_latent
+
+    window_len = seq_cfg.latent_seq_len
+    total_len = int(math.ceil(duration_sec * latent_rate))
+    if total_len <= window_len:
+        return generate(clip_video,
+                        sync_video,
+                        text,
+                        negative_text=negative_text,
+                        feature_utils=feature_utils,
+                        net=net,
+                        seq_cfg=dataclasses.replace(seq_cfg, duration=duration_sec),
+                        video_keys=video_keys,
+                        **kwargs)
+
+    overlap_len = int(round(overlap_sec * latent_rate))
+    assert 0 < overlap_len < window_len, f'{overlap_len=} {window_len=}'
+    # the last window is aligned to the end, so all windows have the same length
+    starts = list(range(0, total_len - window_len, window_len - overlap_len))
+    starts.append(total_len - window_len)
+
+    num_clip_frames = int(seq_cfg.duration * seq_cfg.clip_frame_rate)
+    num_sync_frames = int(seq_cfg.duration * seq_cfg.sync_frame_rate)
+
+    def get_window(video: Optional[torch.Tensor], fps: float, num_frames: int,
+                   start: int) -> Optional[torch.Tensor]:
+        if video is None:
+            return None
+        frame_start = int(round(start / latent_rate * fps))
+        frame_start = max(min(frame_start, video.shape[1] - num_frames), 0)
+        return video[:, frame_start:frame_start + num_frames]
+
+    def generate_windows(window_starts: list[int], **window_kwargs) -> list[torch.Tensor]:
+        # returns the normalized latents of each window
+        num_windows = len(window_starts)
+        clip_windows = [
+            get_window(clip_video, seq_cfg.clip_frame_rate, num_clip_frames, start)
+            for start in window_starts
+        ]
+        sync_windows = [
+            get_window(sync_video, seq_cfg.sync_frame_rate, num_sync_frames, start)
+            for start in window_starts
+        ]
+        if video_keys is not None:
+            # each window is cached separately
+            window_kwargs['video_keys'] = [
+                f'{key}-{start}' if key is not None else None for start in window_starts
+                for key in video_keys
+            ]
+        latents = generate_latents(
+            torch.cat(clip_windows) if clip_video is not None else None,
+            torch.cat(sync_windows) if sync_video is not None else None,
+            text * num_windows,
+            negative_text=negative_text * num_windows if negative_text is not None else None,
+            feature_utils=feature_utils,
+            net=net,
+            seq_cfg=seq_cfg,
+            **kwargs,
+            **window_kwargs)
+        return list(latents.chunk(num_windows))
+
+    audio = None
+    written_end = 0  # in samples
+    prev_start = prev_latents = None
+    for batch_idx in range(0, len(starts), 1 if condition_on_previous else window_batch_size):
+        if condition_on_previous:
+            window_starts = starts[batch_idx:batch_idx + 1]
+            window_kwargs = {}
+            if prev_latents is not None:
+                # fix the latents that overlap with the previous window
+                overlap = prev_start + window_len - window_starts[0]
+                known_latents = torch.zeros_like(prev_latents)
+                known_latents[:, :overlap] = prev_latents[:, -overlap:]
+                known_mask = torch.zeros(1, window_len, 1, dtype=torch.bool)
+                known_mask[:, :overlap] = True
+                window_kwargs = {'known_latents': known_latents, 'known_mask': known_mask}
+            window_latents = generate_windows(window_starts, **window_kwargs)
+            prev_start, prev_latents = window_starts[0], window_latents[0].clone()
+        else:
+            window_starts = starts[batch_idx:batch_idx + window_batch_size]
+            window_latents = generate_windows(window_starts)
+
+        for start, latents in zip(window_starts, window_latents):
+            # decoding one window at a time keeps the decoder memory constant as well
+            window_audio = decode_latents(latents, feature_utils=feature_utils, net=net)
+            start = start * samples_per_latent
+            if audio is None:
+                audio = window_audio.new_zeros(*window_audio.shape[:-1],
+                                               starts[-1] * samples_per_latent +
+                                               window_audio.shape[-1])
+            _crossfade_into(audio, window_audio, start, max(written_end - start, 0))
+            written_end = start + window_audio.shape[-1]
+
+    return audio
+
+
+def _crossfade_into(audio: torch.Tensor, window_audio: torch.Tensor, start: int,
+                    overlap: int) -> None:
+    # writes window_audio into audio[..., start:]; linear crossfade over the first overlap samples
+    end = start + window_audio.shape[-1]
+    if overlap > 0:
+        fade_in = torch.linspace(0, 1, overlap + 2, device=audio.device, dtype=audio.dtype)[1:-1]
+        audio[..., start:start + overlap] = (audio[..., start:start + overlap] * (1 - fade_in) +
+                                             window_audio[..., :overlap] * fade_in)
+    audio[..., start + overlap:end] = window_audio[..., overlap:]
+
+
 LOGFORMAT = "[%(log_color)s%(levelname)-8s%(reset)s]: %(log_color)s%(message)s%(reset)s"
 
 
@@ -158,41 +703,31 @@ def setup_eval_logging(log_level: int = logging.INFO):
     log.addHandler(stream)
 
 
-_CLIP_SIZE = 384
 _CLIP_FPS = 8.0
-
-_SYNC_SIZE = 224
 _SYNC_FPS = 25.0
 
 
-def load_video(video_path: Path, duration_sec: float, load_all_frames: bool = True) -> VideoInfo:
-
-    clip_transform = v2.Compose([
-        v2.Resize((_CLIP_SIZE, _CLIP_SIZE), interpolation=v2.InterpolationMode.BICUBIC),
-        v2.ToImage(),
-        v2.ToDtype(torch.float32, scale=True),
-    ])
-
-    sync_transform = v2.Compose([
-        v2.Resize(_SYNC_SIZE, interpolation=v2.InterpolationMode.BICUBIC),
-        v2.CenterCrop(_SYNC_SIZE),
-        v2.ToImage(),
-        v2.ToDtype(torch.float32, scale=True),
-        v2.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-    ])
+def load_video(video_path: Path,
+               duration_sec: float,
+               load_all_frames: bool = True,
+               frame_preprocessor: Optional[FramePreprocessor] = None) -> VideoInfo:
 
+    frame_preprocessor = frame_preprocessor or FramePreprocessor()
+    # the decoder scales the sampled frames down to the CLIP resolution, and the full-resolution
+    # frames for make_video are decoded again from the source instead of being kept in memory
     output_frames, all_frames, orig_fps = read_frames(video_path,
                                                       list_of_fps=[_CLIP_FPS, _SYNC_FPS],
                                                       start_sec=0,
                                                       end_sec=duration_sec,
-                                                      need_all_frames=load_all_frames)
+                                                      need_all_frames=load_all_frames,
+                                                      frame_size=frame_preprocessor.clip_size,
+                                                      index_all_frames=True)
 
     clip_chunk, sync_chunk = output_frames
     clip_chunk = torch.from_numpy(clip_chunk).permute(0, 3, 1, 2)
     sync_chunk = torch.from_numpy(sync_chunk).permute(0, 3, 1, 2)
 
-    clip_frames = clip_transform(clip_chunk)
-    sync_frames = sync_transform(sync_chunk)
+    clip_frames, sync_frames = frame_preprocessor(clip_chunk, sync_chunk)
 
     clip_length_sec = clip_frames.shape[0] / _CLIP_FPS
     sync_length_sec = sync_frames.shape[0] / _SYNC_FPS
@@ -220,28 +755,116 @@ def load_video(video_path: Path, duration_sec: float, load_all_frames: bool = Tr
     return video_info
 
 
-def load_image(image_path: Path) -> VideoInfo:
-    clip_transform = v2.Compose([
-        v2.Resize((_CLIP_SIZE, _CLIP_SIZE), interpolation=v2.InterpolationMode.BICUBIC),
-        v2.ToImage(),
-        v2.ToDtype(torch.float32, scale=True),
-    ])
+@torch.inference_mode()
+def load_and_encode_video(
+    video_path: Path,
+    duration_sec: float,
+    *,
+    feature_utils: FeaturesUtils,
+    chunk_size: int = 32,
+    max_queued_chunks: int = 4,
+    feature_cache: Optional[VideoFeatureCache] = None,
+    video_key: Optional[str] = None,
+    frame_preprocessor: Optional[FramePreprocessor] = None,
+) -> tuple[VideoInfo, torch.Tensor, torch.Tensor]:
+    """
+    Same as load_video followed by the CLIP/Synchformer encoding, but pipelined: the frames are
+    decoded in a background thread (FrameReader), and chunks of chunk_size frames are
+    preprocessed and encoded as soon as they are decoded, so that decoding overlaps with encoding.
+    The Synchformer segments (16 frames with a step of 8) that span two chunks are encoded once
+    enough frames are available (see FeaturesUtils.encode_video_with_sync_streaming).
+    Returns the video info and the (1, N, D) CLIP and Synchformer features, which can be passed
+    to generate_latents as video_features.
+    With a feature_cache and video_key, cached features are returned without encoding.
+    """
+    if feature_cache is not None and video_key is not None:
+        features = feature_cache.get(video_key)
+        if features is not None:
+            video_info = load_video(video_path,
+                                    duration_sec,
+                                    frame_preprocessor=frame_preprocessor)
+            return video_info, features[0].unsqueeze(0), features[1].unsqueeze(0)
+
+    frame_preprocessor = frame_preprocessor or FramePreprocessor()
+    device, dtype = feature_utils.device, feature_utils.dtype
+    # read_frames samples at most one frame beyond the requested duration
+    max_clip_frames = int(_CLIP_FPS * duration_sec) + 1
+    max_sync_frames = int(_SYNC_FPS * duration_sec) + 1
+    segment_size, step_size = 16, 8
+
+    clip_frames, sync_frames = [], []
+    clip_features = []
+
+    reader = FrameReader(video_path, [_CLIP_FPS, _SYNC_FPS],
+                         start_sec=0,
+                         end_sec=duration_sec,
+                         frame_size=frame_preprocessor.clip_size,
+                         chunk_size=chunk_size,
+                         max_queued_chunks=max_queued_chunks)
+
+    def read_sync_chunks() -> Iterator[torch.Tensor]:
+        # the CLIP chunks are encoded as they come by
+        for fps_idx, chunk in reader:
+            chunk = torch.from_numpy(chunk).permute(0, 3, 1, 2)
+            if fps_idx == 0:
+                chunk = chunk[:max_clip_frames - sum(len(f) for f in clip_frames)]
+                if len(chunk) > 0:
+                    chunk = frame_preprocessor.clip(chunk)
+                    clip_frames.append(chunk)
+                    clip_features.append(
+                        feature_utils.encode_video_with_clip(
+                            chunk.to(device, dtype, non_blocking=True).unsqueeze(0)))
+            else:
+                chunk = chunk[:max_sync_frames - sum(len(f) for f in sync_frames)]
+                if len(chunk) > 0:
+                    chunk = frame_preprocessor.sync(chunk)
+                    sync_frames.append(chunk)
+                    yield chunk.to(device, dtype, non_blocking=True).unsqueeze(0)
+
+    # at least chunk_size frames' worth of segments at a time
+    sync_features = list(
+        feature_utils.encode_video_with_sync_streaming(read_sync_chunks(),
+                                                       min_segments=chunk_size // step_size))
+
+    clip_frames = torch.cat(clip_frames)
+    sync_frames = torch.cat(sync_frames)
+    clip_features = torch.cat(clip_features, dim=1)
+    sync_features = torch.cat(sync_features, dim=1)
+
+    # the same truncation as in load_video
+    clip_length_sec = clip_frames.shape[0] / _CLIP_FPS
+    sync_length_sec = sync_frames.shape[0] / _SYNC_FPS
+    if min(clip_length_sec, sync_length_sec) < duration_sec:
+        duration_sec = min(clip_length_sec, sync_length_sec)
+        log.warning(f'Video is too short, truncating to {duration_sec:.2f} sec')
+    clip_frames = clip_frames[:int(_CLIP_FPS * duration_sec)]
+    sync_frames = sync_frames[:int(_SYNC_FPS * duration_sec)]
+    clip_features = clip_features[:, :len(clip_frames)]
+    # drop the segments that include truncated frames
+    num_segments = (len(sync_frames) - segment_size) // step_size + 1
+    tokens_per_segment = 8  # Synchformer output per 16-frame segment
+    sync_features = sync_features[:, :num_segments * tokens_per_segment]
+
+    video_info = VideoInfo(
+        duration_sec=duration_sec,
+        fps=reader.fps,
+        clip_frames=clip_frames,
+        sync_frames=sync_frames,
+        all_frames=reader.frame_index,
+    )
+    if feature_cache is not None and video_key is not None:
+        feature_cache.put(video_key, clip_features[0], sync_features[0])
+    return video_info, clip_features, sync_features
 
-    sync_transform = v2.Compose([
-        v2.Resize(_SYNC_SIZE, interpolation=v2.InterpolationMode.BICUBIC),
-        v2.CenterCrop(_SYNC_SIZE),
-        v2.ToImage(),
-        v2.ToDtype(torch.float32, scale=True),
-        v2.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
-    ])
 
+def load_image(image_path: Path,
+               frame_preprocessor: Optional[FramePreprocessor] = None) -> ImageInfo:
+    frame_preprocessor = frame_preprocessor or FramePreprocessor()
     frame = np.array(Image.open(image_path))
 
-    clip_chunk = torch.from_numpy(frame).unsqueeze(0).permute(0, 3, 1, 2)
-    sync_chunk = torch.from_numpy(frame).unsqueeze(0).permute(0, 3, 1, 2)
-
-    clip_frames = clip_transform(clip_chunk)
-    sync_frames = sync_transform(sync_chunk)
+    # the same frame for both grids, so the intermediate resize is shared
+    chunk = torch.from_numpy(frame).unsqueeze(0).permute(0, 3, 1, 2)
+    clip_frames, sync_frames = frame_preprocessor(chunk, chunk)
 
     video_info = ImageInfo(
         clip_frames=clip_frames,
@@ -251,5 +874,24 @@ def load_image(image_path: Path) -> VideoInfo:
     return video_info
 
 
-def make_video(video_info: VideoInfo, output_path: Path, audio: torch.Tensor, sampling_rate: int):
+def make_video(video_info: VideoInfo,
+               output_path: Path,
+               audio: torch.Tensor,
+               sampling_rate: int,
+               remux: bool = True):
+    """
+    remux: if the frames come from a video file (see load_video), copy its video packets instead
+        of re-encoding them; falls back to re-encoding if the video cannot be copied
+    """
+    frame_index = video_info.all_frames
+    if remux and isinstance(frame_index, FrameIndex) and frame_index.start_sec == 0:
+        try:
+            remux_with_audio(frame_index.video_path,
+                             audio,
+                             output_path,
+                             sampling_rate,
+                             end_sec=video_info.duration_sec)
+            return
+        except (ValueError, av.error.FFmpegError) as e:
+            log.warning(f'Cannot remux {frame_index.video_path}, re-encoding instead: {e}')
     reencode_with_audio(video_info, output_path, audio, sampling_rate)
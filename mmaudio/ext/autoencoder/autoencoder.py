@@ -5,6 +5,7 @@ import torch.nn as nn
 
 from mmaudio.ext.autoencoder.vae import VAE, get_my_vae
 from mmaudio.ext.bigvgan import BigVGAN
+from mmaudio.ext.bigvgan_v2.alias_free_activation.cpu.activation1d import replace_activations
 from mmaudio.ext.bigvgan_v2.bigvgan import BigVGAN as BigVGANv2
 from mmaudio.model.utils.distributions import DiagonalGaussianDistribution
 
@@ -16,7 +17,12 @@ class AutoEncoderModule(nn.Module):
                  vae_ckpt_path,
                  vocoder_ckpt_path: Optional[str] = None,
                  mode: Literal['16k', '44k'],
-                 need_vae_encoder: bool = True):
+                 need_vae_encoder: bool = True,
+                 cpu_activation: bool = False):
+        """
+        cpu_activation: use the polyphase anti-aliased activations of the vocoder, which are
+            faster on CPUs (see alias_free_activation.cpu.activation1d)
+        """
         super().__init__()
         self.vae: VAE = get_my_vae(mode).eval()
         vae_state_dict = torch.load(vae_ckpt_path, weights_only=True, map_location='cpu')
@@ -32,6 +38,8 @@ class AutoEncoderModule(nn.Module):
             self.vocoder.remove_weight_norm()
         else:
             raise ValueError(f'Unknown mode: {mode}')
+        if cpu_activation:
+            replace_activations(self.vocoder)
 
         for param in self.parameters():
             param.requires_grad = False
@@ -0,0 +1,114 @@
+from typing import Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from mmaudio.ext.bigvgan.alias_free_torch.act import Activation1d as TorchActivation1dV1
+from mmaudio.ext.bigvgan_v2.alias_free_activation.torch.act import \
+    Activation1d as TorchActivation1d
+from mmaudio.ext.bigvgan_v2.alias_free_activation.torch.resample import (DownSample1d,
+                                                                          UpSample1d)
+
+
+class Activation1d(nn.Module):
+    """
+    The anti-aliased Snake/SnakeBeta activation (2x upsampling, activation, 2x downsampling with
+    12-tap filters and replicate padding) in polyphase form, for CPU inference.
+    The two phases of the upsampled signal come from one grouped convolution with the polyphase
+    filter bank of the upsampling filter (no transposed convolution, padding, or cropping of the
+    upsampled signal), go through the activation without being interleaved, and are filtered and
+    summed by one grouped convolution with the filter bank of the downsampling filter.
+    It has the same parameters and buffers as the torch version, and the same outputs up to
+    floating-point error.
+    """
+
+    def __init__(
+        self,
+        activation,
+        up_ratio: int = 2,
+        down_ratio: int = 2,
+        up_kernel_size: int = 12,
+        down_kernel_size: int = 12,
+    ):
+        super().__init__()
+        # the filter banks below are derived for these
+        assert up_ratio == down_ratio == 2, f'{up_ratio=} {down_ratio=}'
+        assert up_kernel_size == down_kernel_size == 12, f'{up_kernel_size=} {down_kernel_size=}'
+        self.up_ratio = up_ratio
+        self.down_ratio = down_ratio
+        self.act = activation
+        self.upsample = UpSample1d(up_ratio, up_kernel_size)
+        self.downsample = DownSample1d(down_ratio, down_kernel_size)
+
+        # (per-channel) filter banks of the last input's shape, device, and dtype
+        self._banks: Optional[tuple[torch.Tensor, torch.Tensor]] = None
+
+    def _get_banks(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        num_channels = x.shape[1]
+        if (self._banks is None or self._banks[0].shape[0] != 2 * num_channels
+                or self._banks[0].device != x.device or self._banks[0].dtype != x.dtype):
+            f = self.upsample.filter.flatten().to(x.device, x.dtype)
+            g = self.downsample.lowpass.filter.flatten().to(x.device, x.dtype)
+            zero = f.new_zeros(1)
+            # even/odd output samples of the upsampling, over a 7-sample window of the input
+            up_bank = torch.stack([torch.cat([2 * f[11::-2], zero]),
+                                   torch.cat([zero, 2 * f[10::-2]])])
+            # even/odd taps of the downsampling filter
+            down_bank = torch.stack([g[0::2], g[1::2]])
+            self._banks = (up_bank.repeat(num_channels, 1).unsqueeze(1),
+                           down_bank.unsqueeze(0).repeat(num_channels, 1, 1))
+        return self._banks
+
+    def _get_snake_params(self) -> tuple[torch.Tensor, torch.Tensor]:
+        # alpha and 1 / beta as (C, 1, 1)
+        alpha = self.act.alpha
+        beta = self.act.beta if hasattr(self.act, 'beta') else alpha  # Snake: beta = alpha
+        if self.act.alpha_logscale:
+            alpha = torch.exp(alpha)
+            beta = torch.exp(beta)
+        inv_beta = 1.0 / (beta + self.act.no_div_by_zero)
+        return alpha.view(-1, 1, 1), inv_beta.view(-1, 1, 1)
+
+    # x: [B, C, T]
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        b, c, t = x.shape
+        up_bank, down_bank = self._get_banks(x)
+
+        # (B, C, 2, T): the even and odd samples of the upsampled signal
+        x = F.conv1d(F.pad(x, (3, 3), mode='replicate'), up_bank, groups=c)
+        x = x.view(b, c, 2, t)
+
+        alpha, inv_beta = self._get_snake_params()
+        x = torch.addcmul(x, torch.sin(x * alpha.to(x.dtype)).square_(), inv_beta.to(x.dtype))
+
+        # the replicate-padded upsampled signal, split into its even and odd samples
+        padded = x.new_empty(b, c, 2, t + 6)
+        first = x[:, :, 0, :1]
+        last = x[:, :, 1, -1:]
+        padded[:, :, 0, :3] = first
+        padded[:, :, 0, 3:t + 3] = x[:, :, 1]
+        padded[:, :, 0, t + 3:] = last
+        padded[:, :, 1, :2] = first
+        padded[:, :, 1, 2:t + 2] = x[:, :, 0]
+        padded[:, :, 1, t + 2:] = last
+
+        x = F.conv1d(padded.view(b, 2 * c, t + 6), down_bank, groups=c)
+        return x[..., :t]
+
+
+def replace_activations(model: nn.Module) -> nn.Module:
+    """
+    Replaces (in-place) the anti-aliased activations of a BigVGAN (v1 or v2) model with the
+    polyphase CPU version, which keeps their parameters and buffers.
+    """
+    for name, module in model.named_children():
+        if isinstance(module, (TorchActivation1d, TorchActivation1dV1)):
+            fused = Activation1d(module.act, module.up_ratio, module.down_ratio,
+                                 module.upsample.kernel_size, module.downsample.kernel_size)
+            fused.upsample = module.upsample
+            fused.downsample = module.downsample
+            setattr(model, name, fused)
+        else:
+            replace_activations(module)
+    return model
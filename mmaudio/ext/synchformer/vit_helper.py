@@ -33,11 +33,29 @@ def qkv_attn(q, k, v, tok_mask: torch.Tensor = None):
     return out
 
 
+def sdpa_attn(q, k, v, tok_mask: torch.Tensor = None):
+    # same as qkv_attn (q is pre-scaled) for (..., N, D) inputs, but with
+    # F.scaled_dot_product_attention, which does not materialize the similarity matrix;
+    # tok_mask is (..., N): 1s - keep
+    attn_mask = None
+    if tok_mask is not None:
+        attn_mask = (tok_mask != 0).unsqueeze(-2)
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, scale=1.0)
+
+
 class DividedAttention(nn.Module):
 
-    def __init__(self, dim, num_heads=8, qkv_bias=False, attn_drop=0., proj_drop=0.):
+    def __init__(self,
+                 dim,
+                 num_heads=8,
+                 qkv_bias=False,
+                 attn_drop=0.,
+                 proj_drop=0.,
+                 fused_attn: bool = True):
         super().__init__()
         self.num_heads = num_heads
+        # use sdpa_attn; otherwise, the reference qkv_attn
+        self.fused_attn = fused_attn
         head_dim = dim // num_heads
         self.scale = head_dim**-0.5
         self.qkv = nn.Linear(dim, dim * 3, bias=qkv_bias)
@@ -67,6 +85,13 @@ class DividedAttention(nn.Module):
         # Scale q
         q *= self.scale
 
+        if self.fused_attn:
+            out = self._fused_attn(q, k, v, tok_mask, einops_from, einops_to, **einops_dims)
+            out = rearrange(out, '(b h) n d -> b n (h d)', h=h)
+            x = self.proj(out)
+            x = self.proj_drop(x)
+            return x
+
         # Take out cls_q, cls_k, cls_v
         (cls_q, q_), (cls_k, k_), (cls_v, v_) = map(lambda t: (t[:, 0:1], t[:, 1:]), (q, k, v))
         # the same for masking
@@ -115,6 +140,36 @@ class DividedAttention(nn.Module):
         x = self.proj_drop(x)
         return x
 
+    def _fused_attn(self, q, k, v, tok_mask, einops_from, einops_to, **einops_dims):
+        # the same as forward (before merging the heads) with sdpa_attn; the groups (over time or
+        # space) are kept as a separate dimension, so that the CLS key/value is broadcast to
+        # them within the concatenation instead of being repeated first
+        (cls_q, q_), (cls_k, k_), (cls_v, v_) = map(lambda t: (t[:, 0:1], t[:, 1:]), (q, k, v))
+
+        # let CLS token attend to key / values of all patches across time and space
+        cls_out = sdpa_attn(cls_q, k, v, tok_mask=tok_mask)
+
+        # rearrange across time or space: (BH, R, N, D)
+        q_, k_, v_ = map(
+            lambda t: rearrange(t, f'{einops_from} -> {einops_to}', **einops_dims).unflatten(
+                0, (len(q), -1)), (q_, k_, v_))
+        r = q_.shape[1]
+        k_ = torch.cat((cls_k.unsqueeze(1).expand(-1, r, -1, -1), k_), dim=2)
+        v_ = torch.cat((cls_v.unsqueeze(1).expand(-1, r, -1, -1), v_), dim=2)
+
+        mask_ = None
+        if tok_mask is not None:
+            cls_mask, mask_ = tok_mask[:, 0:1], tok_mask[:, 1:]
+            mask_ = rearrange(mask_, f'{einops_from} -> {einops_to}'.replace(' d', ''),
+                              **einops_dims).unflatten(0, (len(q), -1))
+            mask_ = torch.cat((cls_mask.unsqueeze(1).expand(-1, r, -1), mask_), dim=2)
+
+        out = sdpa_attn(q_, k_, v_, tok_mask=mask_).flatten(0, 1)
+
+        # merge back time or space and concat back the cls token
+        out = rearrange(out, f'{einops_to} -> {einops_from}', **einops_dims)
+        return torch.cat((cls_out, out), dim=1)
+
 
 class DividedSpaceTimeBlock(nn.Module):
 
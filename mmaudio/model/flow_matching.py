@@ -1,5 +1,6 @@
 import logging
-from typing import Callable, Optional
+import math
+from typing import Callable, Optional, Union
 
 import torch
 from torchdiffeq import odeint
@@ -7,22 +8,130 @@ from torchdiffeq import odeint
 log = logging.getLogger()
 
 
+class GuidanceSchedule:
+    """
+    Per-request (stateful) schedule of the classifier-free guidance strength over the ODE time.
+    A strength < 1 means that only the conditional branch is evaluated at that time.
+    - interval: (t_start, t_end); CFG is only applied for t_start <= t <= t_end
+    - weights: one CFG strength per step of step_times (the num_steps + 1 fixed time points);
+      an evaluation at time t uses the weight of the last step that starts at or before t
+    - adaptive_threshold: stop evaluating the unconditional branch for the remaining steps once
+      the cosine similarity between the conditional and the guided flows exceeds this
+    """
+
+    def __init__(self,
+                 cfg_strength: Union[float, torch.Tensor],
+                 *,
+                 interval: Optional[tuple[float, float]] = None,
+                 weights: Optional[list[float]] = None,
+                 step_times: Optional[torch.Tensor] = None,
+                 adaptive_threshold: Optional[float] = None):
+        self.cfg_strength = cfg_strength
+        self.interval = interval
+        self.weights = weights
+        self.step_times = step_times
+        self.adaptive_threshold = adaptive_threshold
+        if weights is not None:
+            assert step_times is not None and len(weights) == len(step_times) - 1, \
+                'weights need one entry per step'
+            # the step times can be increasing or decreasing
+            self._direction = 1 if step_times[-1] >= step_times[0] else -1
+            self._inner_step_times = [self._direction * float(s) for s in step_times[1:-1]]
+
+        self.converged = False
+        self.num_guided = 0
+        self.num_unguided = 0
+
+    def get_strength(self, t: torch.Tensor) -> Union[float, torch.Tensor]:
+        t = float(t)
+        if self.converged:
+            strength = 0.0
+        elif self.interval is not None and not (self.interval[0] <= t <= self.interval[1]):
+            strength = 0.0
+        elif self.weights is not None:
+            idx = sum(1 for s in self._inner_step_times if self._direction * t >= s)
+            strength = self.weights[idx]
+        else:
+            strength = self.cfg_strength
+
+        # cfg_strength can also be a (B, ) tensor of per-sample strengths
+        if (torch.as_tensor(strength) < 1.0).all():
+            self.num_unguided += 1
+        else:
+            self.num_guided += 1
+        return strength
+
+    def observe(self, cond_flow: torch.Tensor, guided_flow: torch.Tensor) -> None:
+        # called after each guided evaluation
+        if self.adaptive_threshold is None:
+            return
+        similarity = torch.nn.functional.cosine_similarity(cond_flow.flatten(1).float(),
+                                                           guided_flow.flatten(1).float(),
+                                                           dim=1)
+        if similarity.min() > self.adaptive_threshold:
+            self.converged = True
+
+
 # Partially from https://github.com/gle-bellier/flow-matching
 class FlowMatching:
 
-    def __init__(self, min_sigma: float = 0.0, inference_mode='euler', num_steps: int = 25):
-        # inference_mode: 'euler' or 'adaptive'
-        # num_steps: number of steps in the euler inference mode
+    def __init__(self,
+                 min_sigma: float = 0.0,
+                 inference_mode='euler',
+                 num_steps: int = 25,
+                 time_schedule: str = 'linear',
+                 schedule_shift: float = 3.0,
+                 guidance_interval: Optional[tuple[float, float]] = None,
+                 guidance_weights: Optional[list[float]] = None,
+                 adaptive_guidance_threshold: Optional[float] = None):
+        # inference_mode: 'euler', 'heun', 'midpoint', 'rk4', 'dpm_solver_2m', or 'adaptive'
+        # num_steps: number of steps in the fixed-step inference modes
+        # time_schedule: 'linear', 'shifted', or 'cosine' spacing of the fixed steps
+        # schedule_shift: used by the 'shifted' schedule; >1 puts more steps near the noise
+        # guidance_interval, guidance_weights, adaptive_guidance_threshold: see GuidanceSchedule
         super().__init__()
         self.min_sigma = min_sigma
         self.inference_mode = inference_mode
         self.num_steps = num_steps
+        self.time_schedule = time_schedule
+        self.schedule_shift = schedule_shift
+        self.guidance_interval = guidance_interval
+        self.guidance_weights = guidance_weights
+        self.adaptive_guidance_threshold = adaptive_guidance_threshold
 
         # self.fm = ExactOptimalTransportConditionalFlowMatcher(sigma=min_sigma)
 
-        assert self.inference_mode in ['euler', 'adaptive']
+        assert self.inference_mode in [
+            'euler', 'heun', 'midpoint', 'rk4', 'dpm_solver_2m', 'adaptive'
+        ]
+        assert self.time_schedule in ['linear', 'shifted', 'cosine']
         if self.inference_mode == 'adaptive' and num_steps > 0:
             log.info('The number of steps is ignored in adaptive inference mode ')
+        if self.inference_mode == 'dpm_solver_2m':
+            assert self.min_sigma == 0, 'dpm_solver_2m assumes min_sigma == 0'
+        if self.guidance_weights is not None:
+            assert self.inference_mode != 'adaptive', 'guidance weights need fixed steps'
+            assert len(self.guidance_weights) == self.num_steps, \
+                f'{len(self.guidance_weights)=} != {self.num_steps=}'
+
+    @property
+    def nfe_per_step(self) -> int:
+        # number of network evaluations per step in the fixed-step inference modes
+        nfe = {'euler': 1, 'heun': 2, 'midpoint': 2, 'rk4': 4, 'dpm_solver_2m': 1}
+        return nfe[self.inference_mode]
+
+    def get_guidance_schedule(
+            self, cfg_strength: Union[float, torch.Tensor]) -> Optional[GuidanceSchedule]:
+        # a new (stateful) schedule for one to_data call; None if CFG is applied at every step
+        if (self.guidance_interval is None and self.guidance_weights is None
+                and self.adaptive_guidance_threshold is None):
+            return None
+        return GuidanceSchedule(
+            cfg_strength,
+            interval=self.guidance_interval,
+            weights=self.guidance_weights,
+            step_times=self.get_time_steps(0, 1) if self.guidance_weights is not None else None,
+            adaptive_threshold=self.adaptive_guidance_threshold)
 
     def get_conditional_flow(self, x0: torch.Tensor, x1: torch.Tensor,
                              t: torch.Tensor) -> torch.Tensor:
@@ -54,18 +163,89 @@ class FlowMatching:
     def to_data(self, fn: Callable, x0: torch.Tensor) -> torch.Tensor:
         return self.run_t0_to_t1(fn, x0, 0, 1)
 
+    def get_time_steps(self, t0: float, t1: float) -> torch.Tensor:
+        # the num_steps + 1 time points of the fixed-step inference modes
+        if self.time_schedule == 'linear':
+            return torch.linspace(t0, t1 - self.min_sigma, self.num_steps + 1)
+
+        u = torch.linspace(0, 1, self.num_steps + 1)
+        if self.time_schedule == 'shifted':
+            # shift in the noise level (1 - u) as in SD3
+            noise = 1 - u
+            u = 1 - self.schedule_shift * noise / (1 + (self.schedule_shift - 1) * noise)
+        elif self.time_schedule == 'cosine':
+            # denser near both ends
+            u = (1 - torch.cos(math.pi * u)) / 2
+
+        if t0 > t1:
+            # going towards the prior; use the same time points in reverse
+            u = 1 - u.flip(0)
+        return t0 + (t1 - self.min_sigma - t0) * u
+
+    def get_evaluation_times(self, t0: float, t1: float) -> Optional[torch.Tensor]:
+        """
+        all the times at which run_t0_to_t1 evaluates fn (computed exactly as in run_t0_to_t1),
+        e.g., for precomputing time-dependent network inputs; None for the adaptive mode
+        """
+        if self.inference_mode == 'adaptive':
+            return None
+
+        steps = self.get_time_steps(t0, t1)
+        times = []
+        for ti, t in enumerate(steps[:-1]):
+            next_t = steps[ti + 1]
+            dt = next_t - t
+            times.append(t)
+            if self.inference_mode in ['midpoint', 'rk4']:
+                times.append(t + dt / 2)
+            if self.inference_mode in ['heun', 'rk4']:
+                times.append(next_t)
+        return torch.stack(times).unique()
+
     def run_t0_to_t1(self, fn: Callable, x0: torch.Tensor, t0: float, t1: float) -> torch.Tensor:
         # fn: a function that takes (t, x) and returns the direction x0->x1
 
         if self.inference_mode == 'adaptive':
-            return odeint(fn, x0, torch.tensor([t0, t1], device=x0.device, dtype=x0.dtype))
-        elif self.inference_mode == 'euler':
-            x = x0
-            steps = torch.linspace(t0, t1 - self.min_sigma, self.num_steps + 1)
-            for ti, t in enumerate(steps[:-1]):
+            return odeint(fn, x0, torch.tensor([t0, t1], device=x0.device, dtype=x0.dtype))[-1]
+
+        x = x0
+        steps = self.get_time_steps(t0, t1)
+        prev_t = prev_data = None
+        for ti, t in enumerate(steps[:-1]):
+            next_t = steps[ti + 1]
+            dt = next_t - t
+            if self.inference_mode == 'euler':
                 flow = fn(t, x)
-                next_t = steps[ti + 1]
-                dt = next_t - t
                 x = x + dt * flow
+            elif self.inference_mode == 'heun':
+                flow = fn(t, x)
+                next_flow = fn(next_t, x + dt * flow)
+                x = x + dt * (flow + next_flow) / 2
+            elif self.inference_mode == 'midpoint':
+                flow = fn(t, x)
+                x = x + dt * fn(t + dt / 2, x + dt / 2 * flow)
+            elif self.inference_mode == 'rk4':
+                k1 = fn(t, x)
+                k2 = fn(t + dt / 2, x + dt / 2 * k1)
+                k3 = fn(t + dt / 2, x + dt / 2 * k2)
+                k4 = fn(next_t, x + dt * k3)
+                x = x + dt * (k1 + 2 * k2 + 2 * k3 + k4) / 6
+            elif self.inference_mode == 'dpm_solver_2m':
+                flow = fn(t, x)
+                # data prediction; with x_t = (1 - t) * x0 + t * x1 and alpha = t, sigma = 1 - t
+                data = x + (1 - t) * flow
+                # the first-order DPM-Solver++ update is exactly an Euler step
+                next_x = x + dt * flow
+                times = [float(s) for s in (prev_t, t, next_t) if s is not None]
+                if len(times) == 3 and all(0 < s < 1 for s in times):
+                    # second-order multistep correction (DPM-Solver++(2M))
+                    # lambda = log(alpha / sigma) is infinite at t = 0 and t = 1,
+                    # where we fall back to the first-order update
+                    lambda_prev, lambda_t, lambda_next = [math.log(s / (1 - s)) for s in times]
+                    r = (lambda_t - lambda_prev) / (lambda_next - lambda_t)
+                    coef = (times[2] - times[1]) / (1 - times[1])  # alpha_next * (1 - exp(-h))
+                    next_x = next_x + coef / (2 * r) * (data - prev_data)
+                x = next_x
+                prev_t, prev_data = t, data
 
         return x
@@ -1,3 +1,5 @@
+from typing import Optional
+
 import torch
 from torch import nn
 from torch.nn import functional as F
@@ -5,7 +7,10 @@ from torch.nn import functional as F
 
 class ChannelLastConv1d(nn.Conv1d):
 
-    def forward(self, x: torch.Tensor) -> torch.Tensor:
+    def forward(self, x: torch.Tensor, mask: Optional[torch.Tensor] = None) -> torch.Tensor:
+        # mask: (B, N, 1), optional; zeros out the padded tokens of shorter sequences
+        if mask is not None:
+            x = x * mask
         x = x.permute(0, 2, 1)
         x = super().forward(x)
         x = x.permute(0, 2, 1)
@@ -91,5 +96,27 @@ class ConvMLP(nn.Module):
                                     kernel_size=kernel_size,
                                     padding=padding)
 
-    def forward(self, x):
-        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+    def forward(self, x, mask: Optional[torch.Tensor] = None):
+        # mask: (B, N, 1), optional; see ChannelLastConv1d
+        if mask is None:
+            return self.w2(F.silu(self.w1(x)) * self.w3(x))
+        x = x * mask
+        return self.w2(F.silu(self.w1(x)) * self.w3(x), mask)
+
+
+def run_masked(module: nn.Module, x: torch.Tensor, mask: Optional[torch.Tensor]) -> torch.Tensor:
+    """
+    Runs module (possibly an nn.Sequential) on a padded batch.
+    mask: (B, N, 1) with ones for the valid tokens, or None if nothing is padded.
+    The padded tokens are zeroed before every convolution, so that the valid tokens see the same
+    zero padding as when each sequence is processed on its own.
+    """
+    if mask is None:
+        return module(x)
+    if isinstance(module, nn.Sequential):
+        for m in module:
+            x = run_masked(m, x, mask)
+        return x
+    if isinstance(module, (ChannelLastConv1d, ConvMLP)):
+        return module(x, mask)
+    return module(x)
@@ -1,6 +1,8 @@
 import logging
+import threading
+from collections import OrderedDict
 from dataclasses import dataclass
-from typing import Optional
+from typing import Callable, Optional, Union
 
 import torch
 import torch.nn as nn
@@ -8,12 +10,135 @@ import torch.nn.functional as F
 
 from mmaudio.ext.rotary_embeddings import compute_rope_rotations
 from mmaudio.model.embeddings import TimestepEmbedder
-from mmaudio.model.low_level import MLP, ChannelLastConv1d, ConvMLP
+from mmaudio.model.flow_matching import GuidanceSchedule
+from mmaudio.model.low_level import MLP, ChannelLastConv1d, ConvMLP, run_masked
 from mmaudio.model.transformer_layers import (FinalBlock, JointBlock, MMDitSingleBlock)
 
 log = logging.getLogger()
 
 
+@dataclass
+class StepModulation:
+    # the timestep-dependent conditioning of one ODE step that does not depend on the latent
+    global_c: torch.Tensor  # (B, 1, D)
+    clip_modulation: list[torch.Tensor]  # adaLN outputs of the clip branch of each joint block
+    text_modulation: list[torch.Tensor]  # adaLN outputs of the text branch of each joint block
+    final_modulation: torch.Tensor  # adaLN output of the final layer
+
+
+@dataclass
+class ModulationPlan:
+    """
+    StepModulation precomputed for all evaluation times of a fixed step schedule.
+    Tensors are stacked along the first (step) dimension.
+    """
+    times: dict[float, int]
+    global_c: torch.Tensor  # (S, B, 1, D)
+    clip_modulation: list[torch.Tensor]  # (S, B, 1, k*D) for each joint block
+    text_modulation: list[torch.Tensor]
+    final_modulation: torch.Tensor
+
+    def get(self, t: torch.Tensor) -> StepModulation:
+        # t: a scalar evaluation time of the step schedule the plan was built for
+        assert not torch.is_tensor(t) or t.numel() == 1, f'{t.shape=}'
+        idx = self.times.get(float(t))
+        # a miss means that the solver does not evaluate the times of the plan, which would
+        # silently fall back to computing the modulation at every step
+        assert idx is not None, f'{float(t)=} is not an evaluation time of the modulation plan'
+        return StepModulation(global_c=self.global_c[idx],
+                              clip_modulation=[m[idx] for m in self.clip_modulation],
+                              text_modulation=[m[idx] for m in self.text_modulation],
+                              final_modulation=self.final_modulation[idx])
+
+    def __getitem__(self, index) -> 'ModulationPlan':
+        # index along the batch dimension
+        return ModulationPlan(times=self.times,
+                              global_c=self.global_c[:, index],
+                              clip_modulation=[m[:, index] for m in self.clip_modulation],
+                              text_modulation=[m[:, index] for m in self.text_modulation],
+                              final_modulation=self.final_modulation[:, index])
+
+
+@dataclass
+class FusedBlockCache:
+    """
+    DeepCache-style reuse of the fused blocks across ODE steps (inference only).
+    The residual (output - input) of the fused blocks is recomputed every refresh_interval
+    evaluations and reused in between, when only the joint blocks and the final layer run.
+    If similarity_threshold is set, the residual is also recomputed whenever the cosine
+    similarity between the current fused-block input and the one at the last refresh drops below it
+    (this costs a device sync per evaluation).
+    One cache per conditions (i.e., per CFG branch) and per request. Indexing the conditions
+    along the batch dimension gives a view of the same cache (see FusedBlockCache.rows), so the
+    conditional half of a batched-CFG batch keeps the cache on its unguided steps.
+    """
+    refresh_interval: int = 2
+    similarity_threshold: Optional[float] = None
+
+    num_evaluations: int = 0
+    num_reused: int = 0
+    reference_input: Optional[torch.Tensor] = None
+    residual: Optional[torch.Tensor] = None
+
+    def rows(self, index) -> 'FusedBlockCacheRows':
+        return FusedBlockCacheRows(self, index)
+
+    def _get(self, name: str, index, shape: torch.Size) -> Optional[torch.Tensor]:
+        # the rows of a stored tensor, if they match shape; a whole tensor of the shape is
+        # also used, as the last update may have come from the rows
+        x = getattr(self, name)
+        if x is None:
+            return None
+        if index is not None and x[index].shape == shape:
+            return x[index]
+        return x if x.shape == shape else None
+
+    def lookup(self, x: torch.Tensor, index=None) -> Optional[torch.Tensor]:
+        # returns the approximated output of the fused blocks, or None if they need to run
+        # index: the rows of the batch that x is, if any
+        self.num_evaluations += 1
+        residual = self._get('residual', index, x.shape)
+        if residual is None:
+            return None
+        if (self.num_evaluations - 1) % self.refresh_interval == 0:
+            return None
+        if self.similarity_threshold is not None:
+            reference_input = self._get('reference_input', index, x.shape)
+            similarity = F.cosine_similarity(x.flatten(1), reference_input.flatten(1), dim=1)
+            if similarity.min() < self.similarity_threshold:
+                return None
+        self.num_reused += 1
+        return x + residual
+
+    def update(self, fused_input: torch.Tensor, fused_output: torch.Tensor, index=None) -> None:
+        residual = fused_output - fused_input
+        if (index is not None and self.residual is not None
+                and self.residual.shape != residual.shape
+                and self.residual[index].shape == residual.shape):
+            # only these rows are refreshed; the others (e.g., the unconditional half of a
+            # batched-CFG batch) are refreshed by the next evaluation of the whole batch
+            self.residual[index] = residual
+            if self.similarity_threshold is not None:
+                self.reference_input[index] = fused_input
+            return
+        self.residual = residual
+        if self.similarity_threshold is not None:
+            self.reference_input = fused_input
+
+
+@dataclass
+class FusedBlockCacheRows:
+    # a view of some rows (an index along the batch dimension) of a FusedBlockCache
+    cache: FusedBlockCache
+    index: object
+
+    def lookup(self, x: torch.Tensor) -> Optional[torch.Tensor]:
+        return self.cache.lookup(x, self.index)
+
+    def update(self, fused_input: torch.Tensor, fused_output: torch.Tensor) -> None:
+        self.cache.update(fused_input, fused_output, self.index)
+
+
 @dataclass
 class PreprocessedConditions:
     clip_f: torch.Tensor
@@ -21,11 +146,87 @@ class PreprocessedConditions:
     text_f: torch.Tensor
     clip_f_c: torch.Tensor
     text_f_c: torch.Tensor
+    # optional, see MMAudio.build_modulation_plan
+    modulation: Optional[ModulationPlan] = None
+    # optional, inference only; not carried over by cat, shared by indexing and expand
+    fused_block_cache: Optional[Union[FusedBlockCache, FusedBlockCacheRows]] = None
+    # optional, for padded batches with per-sample lengths (see MMAudio.preprocess_conditions)
+    # latent_mask: (B, N), clip_mask: (B, N_clip); True for the valid tokens
+    latent_mask: Optional[torch.Tensor] = None
+    clip_mask: Optional[torch.Tensor] = None
+    # per-sample RoPE rotations of the clip tokens, (B, 1, N_clip, D/2, 2, 2)
+    clip_rot: Optional[torch.Tensor] = None
+
+    @property
+    def is_padded(self) -> bool:
+        return self.latent_mask is not None
+
+    @classmethod
+    def cat(cls, conditions: list['PreprocessedConditions']) -> 'PreprocessedConditions':
+        # concatenate along the batch dimension, e.g., to run CFG in a single forward pass
+        # modulation plans are not carried over; build one for the result if needed
+        # padded conditions can only be concatenated with padded conditions of the same lengths
+        assert len(set(c.is_padded for c in conditions)) == 1, 'cannot mix padded conditions'
+        padded = conditions[0].is_padded
+        return cls(
+            clip_f=torch.cat([c.clip_f for c in conditions], dim=0),
+            sync_f=torch.cat([c.sync_f for c in conditions], dim=0),
+            text_f=torch.cat([c.text_f for c in conditions], dim=0),
+            clip_f_c=torch.cat([c.clip_f_c for c in conditions], dim=0),
+            text_f_c=torch.cat([c.text_f_c for c in conditions], dim=0),
+            latent_mask=torch.cat([c.latent_mask for c in conditions]) if padded else None,
+            clip_mask=torch.cat([c.clip_mask for c in conditions]) if padded else None,
+            clip_rot=torch.cat([c.clip_rot for c in conditions]) if padded else None)
+
+    def __getitem__(self, index) -> 'PreprocessedConditions':
+        # index along the batch dimension
+        padded = self.is_padded
+        return PreprocessedConditions(
+            clip_f=self.clip_f[index],
+            sync_f=self.sync_f[index],
+            text_f=self.text_f[index],
+            clip_f_c=self.clip_f_c[index],
+            text_f_c=self.text_f_c[index],
+            modulation=self.modulation[index] if self.modulation is not None else None,
+            fused_block_cache=_cache_rows(self.fused_block_cache, index),
+            latent_mask=self.latent_mask[index] if padded else None,
+            clip_mask=self.clip_mask[index] if padded else None,
+            clip_rot=self.clip_rot[index] if padded else None)
+
+    def expand(self, bs: int) -> 'PreprocessedConditions':
+        # expand a batch of one to bs without copying
+        padded = self.is_padded
+        return PreprocessedConditions(
+            clip_f=self.clip_f.expand(bs, -1, -1),
+            sync_f=self.sync_f.expand(bs, -1, -1),
+            text_f=self.text_f.expand(bs, -1, -1),
+            clip_f_c=self.clip_f_c.expand(bs, -1),
+            text_f_c=self.text_f_c.expand(bs, -1),
+            # the residual of a batch of one is replaced by the first evaluation of the batch
+            fused_block_cache=self.fused_block_cache,
+            latent_mask=self.latent_mask.expand(bs, -1) if padded else None,
+            clip_mask=self.clip_mask.expand(bs, -1) if padded else None,
+            clip_rot=self.clip_rot.expand(bs, -1, -1, -1, -1, -1) if padded else None)
+
+
+def _cache_rows(cache: Optional[Union[FusedBlockCache, FusedBlockCacheRows]],
+                index) -> Optional[FusedBlockCacheRows]:
+    if cache is None:
+        return None
+    # rows of rows are not needed (nor supported)
+    assert isinstance(cache, FusedBlockCache), 'cannot index an indexed fused-block cache'
+    return cache.rows(index)
 
 
 # Partially from https://github.com/facebookresearch/DiT
 class MMAudio(nn.Module):
 
+    # max. number of (negative text, sequence lengths, dtype, device) entries
+    # kept by get_cached_empty_conditions
+    empty_conditions_cache_size: int = 16
+    # max. number of (latent length, clip length, device) entries kept by get_rotations
+    rotation_cache_size: int = 64
+
     def __init__(self,
                  *,
                  latent_dim: int,
@@ -150,30 +351,54 @@ class MMAudio(nn.Module):
         self.empty_sync_feat = nn.Parameter(torch.zeros(1, sync_dim), requires_grad=True)
 
         self.initialize_weights()
-        self.initialize_rotations()
 
-    def initialize_rotations(self):
+        # LRU; shared by concurrent requests (e.g., the demo threads and the batch scheduler)
+        self._rotation_cache: OrderedDict[tuple[int, int, torch.device],
+                                          tuple[torch.Tensor, torch.Tensor]] = OrderedDict()
+        self._rotation_cache_lock = threading.Lock()
+
+        self._empty_conditions_cache: OrderedDict = OrderedDict()
+        self._empty_conditions_cache_lock = threading.Lock()
+
+    def get_rotations(self, latent_seq_len: int,
+                      clip_seq_len: int) -> tuple[torch.Tensor, torch.Tensor]:
+        """
+        RoPE rotations for the latent and clip tokens, cached per (lengths, device)
+        so that requests of different durations can share the network without recomputation
+        or mutating any module state
+        """
+        key = (latent_seq_len, clip_seq_len, self.device)
+        with self._rotation_cache_lock:
+            rotations = self._rotation_cache.get(key)
+            if rotations is not None:
+                self._rotation_cache.move_to_end(key)
+                return rotations
+
         base_freq = 1.0
-        latent_rot = compute_rope_rotations(self._latent_seq_len,
+        latent_rot = compute_rope_rotations(latent_seq_len,
                                             self.hidden_dim // self.num_heads,
                                             10000,
                                             freq_scaling=base_freq,
                                             device=self.device)
-        clip_rot = compute_rope_rotations(self._clip_seq_len,
+        clip_rot = compute_rope_rotations(clip_seq_len,
                                           self.hidden_dim // self.num_heads,
                                           10000,
-                                          freq_scaling=base_freq * self._latent_seq_len /
-                                          self._clip_seq_len,
+                                          freq_scaling=base_freq * latent_seq_len / clip_seq_len,
                                           device=self.device)
 
-        self.latent_rot = nn.Buffer(latent_rot, persistent=False)
-        self.clip_rot = nn.Buffer(clip_rot, persistent=False)
+        with self._rotation_cache_lock:
+            # another thread may have computed them in the meantime; keep a single entry
+            rotations = self._rotation_cache.setdefault(key, (latent_rot, clip_rot))
+            self._rotation_cache.move_to_end(key)
+            while len(self._rotation_cache) > self.rotation_cache_size:
+                self._rotation_cache.popitem(last=False)
+        return rotations
 
     def update_seq_lengths(self, latent_seq_len: int, clip_seq_len: int, sync_seq_len: int) -> None:
+        # sets the default sequence lengths; rotations are looked up per-call in predict_flow
         self._latent_seq_len = latent_seq_len
         self._clip_seq_len = clip_seq_len
         self._sync_seq_len = sync_seq_len
-        self.initialize_rotations()
 
     def initialize_weights(self):
 
@@ -220,49 +445,165 @@ class MMAudio(nn.Module):
         # return x * self.latent_std + self.latent_mean
         return x.mul_(self.latent_std).add_(self.latent_mean)
 
-    def preprocess_conditions(self, clip_f: torch.Tensor, sync_f: torch.Tensor,
-                              text_f: torch.Tensor) -> PreprocessedConditions:
+    def preprocess_conditions(
+            self,
+            clip_f: torch.Tensor,
+            sync_f: torch.Tensor,
+            text_f: torch.Tensor,
+            *,
+            latent_seq_len: Optional[int] = None,
+            seq_lens: Optional[list[tuple[int, int, int]]] = None) -> PreprocessedConditions:
         """
         cache computations that do not depend on the latent/time step
         i.e., the features are reused over steps during inference
+        latent_seq_len: if given, the clip/sync lengths are taken from the inputs instead of
+            the defaults set by update_seq_lengths (e.g., for concurrent requests)
+        seq_lens: per-sample (latent, clip, sync) lengths of a padded batch, optional;
+            clip_f/sync_f are padded to the longest sequences and latent_seq_len defaults to
+            the longest latent length. The conditions then carry key-padding masks and
+            per-sample clip rotations that predict_flow uses.
         """
-        assert clip_f.shape[1] == self._clip_seq_len, f'{clip_f.shape=} {self._clip_seq_len=}'
-        assert sync_f.shape[1] == self._sync_seq_len, f'{sync_f.shape=} {self._sync_seq_len=}'
+        if seq_lens is not None:
+            latent_lens, clip_lens, sync_lens = (list(lens) for lens in zip(*seq_lens))
+            if latent_seq_len is None:
+                latent_seq_len = max(latent_lens)
+            assert max(clip_lens) <= clip_f.shape[1], f'{clip_lens=} {clip_f.shape=}'
+            assert max(sync_lens) <= sync_f.shape[1], f'{sync_lens=} {sync_f.shape=}'
+            assert all(sync_len % 8 == 0 for sync_len in sync_lens), f'{sync_lens=}'
+            if (min(latent_lens) == latent_seq_len and min(clip_lens) == clip_f.shape[1]
+                    and min(sync_lens) == sync_f.shape[1]):
+                # nothing is padded
+                seq_lens = None
+        if latent_seq_len is None:
+            latent_seq_len = self._latent_seq_len
+            assert clip_f.shape[1] == self._clip_seq_len, f'{clip_f.shape=} {self._clip_seq_len=}'
+            assert sync_f.shape[1] == self._sync_seq_len, f'{sync_f.shape=} {self._sync_seq_len=}'
+        assert sync_f.shape[1] % 8 == 0, f'{sync_f.shape=}'
         assert text_f.shape[1] == self._text_seq_len, f'{text_f.shape=} {self._text_seq_len=}'
 
         bs = clip_f.shape[0]
 
+        if seq_lens is not None:
+            latent_mask = _length_mask(latent_lens, latent_seq_len, clip_f.device)
+            clip_mask = _length_mask(clip_lens, clip_f.shape[1], clip_f.device)
+            sync_mask = _length_mask(sync_lens, sync_f.shape[1], clip_f.device)
+            clip_token_mask = clip_mask.unsqueeze(-1).to(clip_f.dtype)
+            sync_token_mask = sync_mask.unsqueeze(-1).to(sync_f.dtype)
+        else:
+            latent_mask = clip_mask = clip_token_mask = sync_token_mask = None
+
         # B * num_segments (24) * 8 * 768
-        num_sync_segments = self._sync_seq_len // 8
+        num_sync_segments = sync_f.shape[1] // 8
         sync_f = sync_f.view(bs, num_sync_segments, 8, -1) + self.sync_pos_emb
         sync_f = sync_f.flatten(1, 2)  # (B, VN, D)
 
         # extend vf to match x
-        clip_f = self.clip_input_proj(clip_f)  # (B, VN, D)
-        sync_f = self.sync_input_proj(sync_f)  # (B, VN, D)
+        clip_f = run_masked(self.clip_input_proj, clip_f, clip_token_mask)  # (B, VN, D)
+        sync_f = run_masked(self.sync_input_proj, sync_f, sync_token_mask)  # (B, VN, D)
         text_f = self.text_input_proj(text_f)  # (B, VN, D)
 
         # upsample the sync features to match the audio
-        sync_f = sync_f.transpose(1, 2)  # (B, D, VN)
-        sync_f = F.interpolate(sync_f, size=self._latent_seq_len, mode='nearest-exact')
-        sync_f = sync_f.transpose(1, 2)  # (B, N, D)
+        if seq_lens is None:
+            sync_f = sync_f.transpose(1, 2)  # (B, D, VN)
+            sync_f = F.interpolate(sync_f, size=latent_seq_len, mode='nearest-exact')
+            sync_f = sync_f.transpose(1, 2)  # (B, N, D)
+        else:
+            # each sample to its own latent length
+            upsampled = sync_f.new_zeros(bs, latent_seq_len, sync_f.shape[-1])
+            for i, (latent_len, sync_len) in enumerate(zip(latent_lens, sync_lens)):
+                sample_f = sync_f[i:i + 1, :sync_len].transpose(1, 2)
+                sample_f = F.interpolate(sample_f, size=latent_len, mode='nearest-exact')
+                upsampled[i, :latent_len] = sample_f[0].transpose(0, 1)
+            sync_f = upsampled
 
         # get conditional features from the clip side
-        clip_f_c = self.clip_cond_proj(clip_f.mean(dim=1))  # (B, D)
+        clip_f_c = self.clip_cond_proj(_masked_mean(clip_f, clip_mask))  # (B, D)
         text_f_c = self.text_cond_proj(text_f.mean(dim=1))  # (B, D)
 
+        clip_rot = None
+        if seq_lens is not None:
+            clip_rot = self._get_padded_clip_rotations(latent_lens, clip_lens, clip_f.shape[1])
+
         return PreprocessedConditions(clip_f=clip_f,
                                       sync_f=sync_f,
                                       text_f=text_f,
                                       clip_f_c=clip_f_c,
-                                      text_f_c=text_f_c)
-
-    def predict_flow(self, latent: torch.Tensor, t: torch.Tensor,
-                     conditions: PreprocessedConditions) -> torch.Tensor:
+                                      text_f_c=text_f_c,
+                                      latent_mask=latent_mask,
+                                      clip_mask=clip_mask,
+                                      clip_rot=clip_rot)
+
+    def _get_padded_clip_rotations(self, latent_lens: list[int], clip_lens: list[int],
+                                   clip_seq_len: int) -> torch.Tensor:
+        # per-sample clip rotations (B, 1, N_clip, D/2, 2, 2); the padded tokens are not rotated
+        clip_rot = []
+        for latent_len, clip_len in zip(latent_lens, clip_lens):
+            rot = self.get_rotations(latent_len, clip_len)[1]
+            clip_rot.append(F.pad(rot, (0, 0, 0, 0, 0, 0, 0, clip_seq_len - clip_len)))
+        return torch.cat(clip_rot).unsqueeze(1)
+
+    def collate_conditions(self,
+                           conditions: list[PreprocessedConditions]) -> PreprocessedConditions:
+        """
+        pads (unpadded) conditions of possibly different lengths to the longest ones and
+        concatenates them along the batch dimension, with masks as in preprocess_conditions
+        """
+        assert not any(c.is_padded for c in conditions), 'already padded'
+        latent_lens = [c.sync_f.shape[1] for c in conditions for _ in range(len(c.sync_f))]
+        clip_lens = [c.clip_f.shape[1] for c in conditions for _ in range(len(c.clip_f))]
+        latent_seq_len = max(latent_lens)
+        clip_seq_len = max(clip_lens)
+        if min(latent_lens) == latent_seq_len and min(clip_lens) == clip_seq_len:
+            return PreprocessedConditions.cat(conditions)
+
+        def pad(x: torch.Tensor, length: int) -> torch.Tensor:
+            return F.pad(x, (0, 0, 0, length - x.shape[1]))
+
+        device = conditions[0].clip_f.device
+        return PreprocessedConditions(
+            clip_f=torch.cat([pad(c.clip_f, clip_seq_len) for c in conditions]),
+            sync_f=torch.cat([pad(c.sync_f, latent_seq_len) for c in conditions]),
+            text_f=torch.cat([c.text_f for c in conditions]),
+            clip_f_c=torch.cat([c.clip_f_c for c in conditions]),
+            text_f_c=torch.cat([c.text_f_c for c in conditions]),
+            latent_mask=_length_mask(latent_lens, latent_seq_len, device),
+            clip_mask=_length_mask(clip_lens, clip_seq_len, device),
+            clip_rot=self._get_padded_clip_rotations(latent_lens, clip_lens, clip_seq_len))
+
+    def build_modulation_plan(self, times: torch.Tensor,
+                              conditions: PreprocessedConditions) -> ModulationPlan:
+        """
+        precompute the timestep embeddings and the adaLN modulations that only depend on
+        global_c for all evaluation times (S,) of a fixed step schedule;
+        each adaLN layer runs once over all S steps instead of once per step.
+        The latent branch and the fused blocks are conditioned on the per-token extended_c
+        and are still modulated at every step.
+        """
+        dtype = conditions.clip_f_c.dtype
+        t = times.to(conditions.clip_f_c.device, dtype)
+        global_c = self.global_cond_mlp(conditions.clip_f_c + conditions.text_f_c)  # (B, D)
+        global_c = self.t_embed(t)[:, None, None] + global_c[None, :, None]  # (S, B, 1, D)
+
+        clip_modulation = [b.clip_block.adaLN_modulation(global_c) for b in self.joint_blocks]
+        text_modulation = [b.text_block.adaLN_modulation(global_c) for b in self.joint_blocks]
+        return ModulationPlan(times={float(time): i
+                                     for i, time in enumerate(times)},
+                              global_c=global_c,
+                              clip_modulation=clip_modulation,
+                              text_modulation=text_modulation,
+                              final_modulation=self.final_layer.adaLN_modulation(global_c))
+
+    def predict_flow(self,
+                     latent: torch.Tensor,
+                     t: torch.Tensor,
+                     conditions: PreprocessedConditions,
+                     step_modulation: Optional[StepModulation] = None) -> torch.Tensor:
         """
         for non-cacheable computations
+        step_modulation: precomputed with build_modulation_plan for this t, optional
         """
-        assert latent.shape[1] == self._latent_seq_len, f'{latent.shape=} {self._latent_seq_len=}'
+        assert latent.shape[1] == conditions.sync_f.shape[1], \
+            f'{latent.shape=} {conditions.sync_f.shape=}'
 
         clip_f = conditions.clip_f
         sync_f = conditions.sync_f
@@ -270,22 +611,78 @@ class MMAudio(nn.Module):
         clip_f_c = conditions.clip_f_c
         text_f_c = conditions.text_f_c
 
-        latent = self.audio_input_proj(latent)  # (B, N, D)
-        global_c = self.global_cond_mlp(clip_f_c + text_f_c)  # (B, D)
-
-        global_c = self.t_embed(t).unsqueeze(1) + global_c.unsqueeze(1)  # (B, D)
-        extended_c = global_c + sync_f
+        if conditions.is_padded:
+            # token masks for the convolutions and key-padding masks for the attention
+            latent_mask = conditions.latent_mask.unsqueeze(-1).to(latent.dtype)
+            clip_mask = conditions.clip_mask.unsqueeze(-1).to(latent.dtype)
+            text_mask = conditions.latent_mask.new_ones(len(latent), text_f.shape[1])
+            joint_attn_mask = torch.cat([conditions.latent_mask, conditions.clip_mask, text_mask],
+                                        dim=1)[:, None, None]
+            latent_attn_mask = conditions.latent_mask[:, None, None]
+        else:
+            latent_mask = clip_mask = joint_attn_mask = latent_attn_mask = None
 
-        for block in self.joint_blocks:
-            latent, clip_f, text_f = block(latent, clip_f, text_f, global_c, extended_c,
-                                           self.latent_rot, self.clip_rot)  # (B, N, D)
+        latent = run_masked(self.audio_input_proj, latent, latent_mask)  # (B, N, D)
 
-        for block in self.fused_blocks:
-            latent = block(latent, extended_c, self.latent_rot)
+        if step_modulation is None:
+            global_c = self.global_cond_mlp(clip_f_c + text_f_c)  # (B, D)
+            global_c = self.t_embed(t).unsqueeze(1) + global_c.unsqueeze(1)  # (B, D)
+            clip_modulation = text_modulation = [None] * len(self.joint_blocks)
+            final_modulation = None
+        else:
+            global_c = step_modulation.global_c
+            clip_modulation = step_modulation.clip_modulation
+            text_modulation = step_modulation.text_modulation
+            final_modulation = step_modulation.final_modulation
+        extended_c = global_c + sync_f
 
-        flow = self.final_layer(latent, global_c)  # (B, N, out_dim), remove t
+        latent_rot, clip_rot = self.get_rotations(latent.shape[1], clip_f.shape[1])
+        if conditions.clip_rot is not None:
+            # the latent rotations do not depend on the length, but the clip ones do
+            clip_rot = conditions.clip_rot
+
+        for block, clip_mod, text_mod in zip(self.joint_blocks, clip_modulation, text_modulation):
+            latent, clip_f, text_f = block(latent,
+                                           clip_f,
+                                           text_f,
+                                           global_c,
+                                           extended_c,
+                                           latent_rot,
+                                           clip_rot,
+                                           clip_modulation=clip_mod,
+                                           text_modulation=text_mod,
+                                           latent_mask=latent_mask,
+                                           clip_mask=clip_mask,
+                                           attn_mask=joint_attn_mask)  # (B, N, D)
+
+        cache = conditions.fused_block_cache
+        cached_latent = cache.lookup(latent) if cache is not None else None
+        if cached_latent is not None:
+            latent = cached_latent
+        else:
+            fused_input = latent
+            for block in self.fused_blocks:
+                latent = block(latent,
+                               extended_c,
+                               latent_rot,
+                               mask=latent_mask,
+                               attn_mask=latent_attn_mask)
+            if cache is not None:
+                cache.update(fused_input, latent)
+
+        flow = self.final_layer(latent, global_c, final_modulation,
+                                latent_mask)  # (B, N, out_dim), remove t
         return flow
 
+    def _predict_flow_with_plan(self, latent: torch.Tensor, t: torch.Tensor,
+                                conditions: PreprocessedConditions) -> torch.Tensor:
+        # t: the scalar time of the step; looked up in the modulation plan if there is one
+        step_modulation = None
+        if conditions.modulation is not None:
+            step_modulation = conditions.modulation.get(t)
+        t = t * torch.ones(len(latent), device=latent.device, dtype=latent.dtype)
+        return self.predict_flow(latent, t, conditions, step_modulation)
+
     def forward(self, latent: torch.Tensor, clip_f: torch.Tensor, sync_f: torch.Tensor,
                 text_f: torch.Tensor, t: torch.Tensor) -> torch.Tensor:
         """
@@ -300,11 +697,13 @@ class MMAudio(nn.Module):
     def get_empty_string_sequence(self, bs: int) -> torch.Tensor:
         return self.empty_string_feat.unsqueeze(0).expand(bs, -1, -1)
 
-    def get_empty_clip_sequence(self, bs: int) -> torch.Tensor:
-        return self.empty_clip_feat.unsqueeze(0).expand(bs, self._clip_seq_len, -1)
+    def get_empty_clip_sequence(self, bs: int, seq_len: Optional[int] = None) -> torch.Tensor:
+        seq_len = self._clip_seq_len if seq_len is None else seq_len
+        return self.empty_clip_feat.unsqueeze(0).expand(bs, seq_len, -1)
 
-    def get_empty_sync_sequence(self, bs: int) -> torch.Tensor:
-        return self.empty_sync_feat.unsqueeze(0).expand(bs, self._sync_seq_len, -1)
+    def get_empty_sync_sequence(self, bs: int, seq_len: Optional[int] = None) -> torch.Tensor:
+        seq_len = self._sync_seq_len if seq_len is None else seq_len
+        return self.empty_sync_feat.unsqueeze(0).expand(bs, seq_len, -1)
 
     def get_empty_conditions(
             self,
@@ -328,25 +727,146 @@ class MMAudio(nn.Module):
 
         return conditions
 
-    def ode_wrapper(self, t: torch.Tensor, latent: torch.Tensor, conditions: PreprocessedConditions,
-                    empty_conditions: PreprocessedConditions, cfg_strength: float) -> torch.Tensor:
-        t = t * torch.ones(len(latent), device=latent.device, dtype=latent.dtype)
+    def _empty_conditions_key(self, negative_text: Optional[str],
+                              seq_lengths: tuple[int, int, int]) -> tuple:
+        device_type = self.device.type
+        if torch.is_autocast_enabled(device_type):
+            dtype = torch.get_autocast_dtype(device_type)
+        else:
+            dtype = self.latent_mean.dtype
+        return (negative_text, *seq_lengths, dtype, self.device)
+
+    def get_cached_empty_conditions(
+        self,
+        bs: int,
+        *,
+        negative_text: Optional[list[str]] = None,
+        encode_text: Optional[Callable[[list[str]], torch.Tensor]] = None,
+        seq_lengths: Optional[Union[tuple[int, int, int], list[tuple[int, int, int]]]] = None,
+    ) -> PreprocessedConditions:
+        """
+        same as get_empty_conditions, but the preprocessed conditions are memoized (LRU)
+        per negative text, sequence lengths, dtype, and device.
+        encode_text is only called for negative texts that are not in the cache.
+        seq_lengths: (latent, clip, sync) lengths; defaults to those set by update_seq_lengths.
+            A list of per-sample lengths gives a padded batch (see collate_conditions).
+        Only meant for inference -- the cache is not updated when the weights are trained.
+        """
+        if isinstance(seq_lengths, list):
+            if negative_text is None:
+                negative_text = [None] * bs
+            assert len(seq_lengths) == bs, f'{len(seq_lengths)=} != {bs=}'
+            return self.collate_conditions([
+                self.get_cached_empty_conditions(1,
+                                                 negative_text=[text],
+                                                 encode_text=encode_text,
+                                                 seq_lengths=tuple(lengths))
+                for text, lengths in zip(negative_text, seq_lengths)
+            ])
+        if seq_lengths is None:
+            seq_lengths = (self._latent_seq_len, self._clip_seq_len, self._sync_seq_len)
+        latent_seq_len, clip_seq_len, sync_seq_len = seq_lengths
+        if negative_text is None:
+            negative_text = [None] * bs
+        assert len(negative_text) == bs, f'{len(negative_text)=} != {bs=}'
+
+        unique_text = list(dict.fromkeys(negative_text))
+        keys = {text: self._empty_conditions_key(text, seq_lengths) for text in unique_text}
+        with self._empty_conditions_cache_lock:
+            entries = {}
+            for text in unique_text:
+                if keys[text] in self._empty_conditions_cache:
+                    self._empty_conditions_cache.move_to_end(keys[text])
+                    entries[text] = self._empty_conditions_cache[keys[text]]
+
+        missing_text = [text for text in unique_text if text not in entries]
+        if missing_text:
+            num_missing = len(missing_text)
+            if missing_text == [None]:
+                text_f = self.get_empty_string_sequence(1)
+            else:
+                assert encode_text is not None, 'encode_text is needed for negative texts'
+                text_f = encode_text(missing_text)
+            conditions = self.preprocess_conditions(
+                self.get_empty_clip_sequence(num_missing, clip_seq_len),
+                self.get_empty_sync_sequence(num_missing, sync_seq_len),
+                text_f,
+                latent_seq_len=latent_seq_len)
+            with self._empty_conditions_cache_lock:
+                for i, text in enumerate(missing_text):
+                    entries[text] = conditions[i:i + 1]
+                    self._empty_conditions_cache[keys[text]] = entries[text]
+                while len(self._empty_conditions_cache) > self.empty_conditions_cache_size:
+                    self._empty_conditions_cache.popitem(last=False)
+
+        if len(unique_text) == 1:
+            return entries[unique_text[0]].expand(bs)
+        return PreprocessedConditions.cat([entries[text] for text in negative_text])
+
+    def clear_empty_conditions_cache(self) -> None:
+        with self._empty_conditions_cache_lock:
+            self._empty_conditions_cache.clear()
+
+    def ode_wrapper(self,
+                    t: torch.Tensor,
+                    latent: torch.Tensor,
+                    conditions: PreprocessedConditions,
+                    empty_conditions: PreprocessedConditions,
+                    cfg_strength: Union[float, torch.Tensor],
+                    guidance: Optional[GuidanceSchedule] = None) -> torch.Tensor:
+        # guidance: overrides cfg_strength per step, optional
+        # cfg_strength: a float or a (B, ) tensor of per-sample strengths
+        if guidance is not None:
+            cfg_strength = guidance.get_strength(t)
+
+        cfg_strength = _get_cfg_scale(cfg_strength)
+        if cfg_strength is None:
+            return self._predict_flow_with_plan(latent, t, conditions)
+        else:
+            cond_flow = self._predict_flow_with_plan(latent, t, conditions)
+            flow = (cfg_strength * cond_flow +
+                    (1 - cfg_strength) * self._predict_flow_with_plan(latent, t, empty_conditions))
+            if guidance is not None:
+                guidance.observe(cond_flow, flow)
+            return flow
+
+    def ode_wrapper_batched(self,
+                            t: torch.Tensor,
+                            latent: torch.Tensor,
+                            joint_conditions: PreprocessedConditions,
+                            cfg_strength: Union[float, torch.Tensor],
+                            guidance: Optional[GuidanceSchedule] = None) -> torch.Tensor:
+        """
+        same as ode_wrapper, but evaluates the conditional and unconditional branches
+        in a single forward pass of batch size 2B
+        joint_conditions: PreprocessedConditions.cat([conditions, empty_conditions])
+        """
+        bs = len(latent)
+        if guidance is not None:
+            cfg_strength = guidance.get_strength(t)
 
-        if cfg_strength < 1.0:
-            return self.predict_flow(latent, t, conditions)
+        cfg_strength = _get_cfg_scale(cfg_strength)
+        if cfg_strength is None:
+            return self._predict_flow_with_plan(latent, t, joint_conditions[:bs])
         else:
-            return (cfg_strength * self.predict_flow(latent, t, conditions) +
-                    (1 - cfg_strength) * self.predict_flow(latent, t, empty_conditions))
+            flow = self._predict_flow_with_plan(latent.repeat(2, 1, 1), t, joint_conditions)
+            cond_flow, empty_flow = flow.chunk(2, dim=0)
+            flow = cfg_strength * cond_flow + (1 - cfg_strength) * empty_flow
+            if guidance is not None:
+                guidance.observe(cond_flow, flow)
+            return flow
 
     def load_weights(self, src_dict) -> None:
         if 't_embed.freqs' in src_dict:
             del src_dict['t_embed.freqs']
+        # rotations used to be stored as buffers
         if 'latent_rot' in src_dict:
             del src_dict['latent_rot']
         if 'clip_rot' in src_dict:
             del src_dict['clip_rot']
 
         self.load_state_dict(src_dict, strict=True)
+        self.clear_empty_conditions_cache()
 
     @property
     def device(self) -> torch.device:
@@ -365,6 +885,32 @@ class MMAudio(nn.Module):
         return self._sync_seq_len
 
 
+def _length_mask(lens: list[int], max_len: int, device: torch.device) -> torch.Tensor:
+    # (B, max_len); True for the first lens[i] tokens of each sample
+    return (torch.arange(max_len, device=device).unsqueeze(0) < torch.tensor(
+        lens, device=device).unsqueeze(1))
+
+
+def _masked_mean(x: torch.Tensor, mask: Optional[torch.Tensor]) -> torch.Tensor:
+    # mean over the valid tokens of x (B, N, D); mask: (B, N) or None
+    if mask is None:
+        return x.mean(dim=1)
+    mask = mask.unsqueeze(-1).to(x.dtype)
+    return (x * mask).sum(dim=1) / mask.sum(dim=1)
+
+
+def _get_cfg_scale(
+        cfg_strength: Union[float, torch.Tensor]) -> Optional[Union[float, torch.Tensor]]:
+    # returns None if the unconditional branch is not needed at all,
+    # and per-sample strengths as a (B, 1, 1) tensor otherwise;
+    # a strength < 1 means conditional only, which is the same as a strength of 1
+    if isinstance(cfg_strength, torch.Tensor):
+        if (cfg_strength < 1.0).all():
+            return None
+        return cfg_strength.clamp(min=1.0).view(-1, 1, 1)
+    return None if cfg_strength < 1.0 else cfg_strength
+
+
 def small_16k(**kwargs) -> MMAudio:
     num_heads = 7
     return MMAudio(latent_dim=20,
@@ -7,21 +7,25 @@ from einops import rearrange
 from einops.layers.torch import Rearrange
 
 from mmaudio.ext.rotary_embeddings import apply_rope
-from mmaudio.model.low_level import MLP, ChannelLastConv1d, ConvMLP
+from mmaudio.model.low_level import MLP, ChannelLastConv1d, ConvMLP, run_masked
 
 
 def modulate(x: torch.Tensor, shift: torch.Tensor, scale: torch.Tensor):
     return x * (1 + scale) + shift
 
 
-def attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor):
+def attention(q: torch.Tensor,
+              k: torch.Tensor,
+              v: torch.Tensor,
+              attn_mask: Optional[torch.Tensor] = None):
+    # attn_mask: (B, 1, 1, N) key-padding mask (True: attend), optional
     # training will crash without these contiguous calls and the CUDNN limitation
     # I believe this is related to https://github.com/pytorch/pytorch/issues/133974
     # unresolved at the time of writing
     q = q.contiguous()
     k = k.contiguous()
     v = v.contiguous()
-    out = F.scaled_dot_product_attention(q, k, v)
+    out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
     out = rearrange(out, 'b h n d -> b n (h d)').contiguous()
     return out
 
@@ -102,10 +106,16 @@ class MMDitSingleBlock(nn.Module):
 
             self.adaLN_modulation = nn.Sequential(nn.SiLU(), nn.Linear(dim, 6 * dim, bias=True))
 
-    def pre_attention(self, x: torch.Tensor, c: torch.Tensor, rot: Optional[torch.Tensor]):
+    def pre_attention(self,
+                      x: torch.Tensor,
+                      c: torch.Tensor,
+                      rot: Optional[torch.Tensor],
+                      modulation: Optional[torch.Tensor] = None):
         # x: BS * N * D
         # cond: BS * D
-        modulation = self.adaLN_modulation(c)
+        # modulation: precomputed self.adaLN_modulation(c), optional
+        if modulation is None:
+            modulation = self.adaLN_modulation(c)
         if self.pre_only:
             (shift_msa, scale_msa) = modulation.chunk(2, dim=-1)
             gate_msa = shift_mlp = scale_mlp = gate_mlp = None
@@ -117,24 +127,34 @@ class MMDitSingleBlock(nn.Module):
         q, k, v = self.attn.pre_attention(x, rot)
         return (q, k, v), (gate_msa, shift_mlp, scale_mlp, gate_mlp)
 
-    def post_attention(self, x: torch.Tensor, attn_out: torch.Tensor, c: tuple[torch.Tensor]):
+    def post_attention(self,
+                       x: torch.Tensor,
+                       attn_out: torch.Tensor,
+                       c: tuple[torch.Tensor],
+                       mask: Optional[torch.Tensor] = None):
+        # mask: (B, N, 1) for padded batches, optional; see run_masked
         if self.pre_only:
             return x
 
         (gate_msa, shift_mlp, scale_mlp, gate_mlp) = c
-        x = x + self.linear1(attn_out) * gate_msa
+        x = x + run_masked(self.linear1, attn_out, mask) * gate_msa
         r = modulate(self.norm2(x), shift_mlp, scale_mlp)
-        x = x + self.ffn(r) * gate_mlp
+        x = x + run_masked(self.ffn, r, mask) * gate_mlp
 
         return x
 
-    def forward(self, x: torch.Tensor, cond: torch.Tensor,
-                rot: Optional[torch.Tensor]) -> torch.Tensor:
+    def forward(self,
+                x: torch.Tensor,
+                cond: torch.Tensor,
+                rot: Optional[torch.Tensor],
+                mask: Optional[torch.Tensor] = None,
+                attn_mask: Optional[torch.Tensor] = None) -> torch.Tensor:
         # x: BS * N * D
         # cond: BS * D
+        # mask/attn_mask: token mask (B, N, 1) and key-padding mask (B, 1, 1, N), optional
         x_qkv, x_conditions = self.pre_attention(x, cond, rot)
-        attn_out = attention(*x_qkv)
-        x = self.post_attention(x, attn_out, x_conditions)
+        attn_out = attention(*x_qkv, attn_mask=attn_mask)
+        x = self.post_attention(x, attn_out, x_conditions, mask)
 
         return x
 
@@ -158,15 +178,35 @@ class JointBlock(nn.Module):
                                            padding=1)
         self.text_block = MMDitSingleBlock(dim, nhead, mlp_ratio, pre_only=pre_only, kernel_size=1)
 
-    def forward(self, latent: torch.Tensor, clip_f: torch.Tensor, text_f: torch.Tensor,
-                global_c: torch.Tensor, extended_c: torch.Tensor, latent_rot: torch.Tensor,
-                clip_rot: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+    def forward(self,
+                latent: torch.Tensor,
+                clip_f: torch.Tensor,
+                text_f: torch.Tensor,
+                global_c: torch.Tensor,
+                extended_c: torch.Tensor,
+                latent_rot: torch.Tensor,
+                clip_rot: torch.Tensor,
+                clip_modulation: Optional[torch.Tensor] = None,
+                text_modulation: Optional[torch.Tensor] = None,
+                latent_mask: Optional[torch.Tensor] = None,
+                clip_mask: Optional[torch.Tensor] = None,
+                attn_mask: Optional[torch.Tensor] = None
+                ) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
         # latent: BS * N1 * D
         # clip_f: BS * N2 * D
         # c: BS * (1/N) * D
+        # clip/text_modulation: precomputed adaLN outputs of the clip/text blocks, optional
+        # latent/clip_mask: (B, N1/N2, 1) token masks for padded batches, optional
+        # attn_mask: (B, 1, 1, N1 + N2 + N3) key-padding mask of the joint sequence, optional
         x_qkv, x_mod = self.latent_block.pre_attention(latent, extended_c, latent_rot)
-        c_qkv, c_mod = self.clip_block.pre_attention(clip_f, global_c, clip_rot)
-        t_qkv, t_mod = self.text_block.pre_attention(text_f, global_c, rot=None)
+        c_qkv, c_mod = self.clip_block.pre_attention(clip_f,
+                                                     global_c,
+                                                     clip_rot,
+                                                     modulation=clip_modulation)
+        t_qkv, t_mod = self.text_block.pre_attention(text_f,
+                                                     global_c,
+                                                     rot=None,
+                                                     modulation=text_modulation)
 
         latent_len = latent.shape[1]
         clip_len = clip_f.shape[1]
@@ -174,14 +214,14 @@ class JointBlock(nn.Module):
 
         joint_qkv = [torch.cat([x_qkv[i], c_qkv[i], t_qkv[i]], dim=2) for i in range(3)]
 
-        attn_out = attention(*joint_qkv)
+        attn_out = attention(*joint_qkv, attn_mask=attn_mask)
         x_attn_out = attn_out[:, :latent_len]
         c_attn_out = attn_out[:, latent_len:latent_len + clip_len]
         t_attn_out = attn_out[:, latent_len + clip_len:]
 
-        latent = self.latent_block.post_attention(latent, x_attn_out, x_mod)
+        latent = self.latent_block.post_attention(latent, x_attn_out, x_mod, latent_mask)
         if not self.pre_only:
-            clip_f = self.clip_block.post_attention(clip_f, c_attn_out, c_mod)
+            clip_f = self.clip_block.post_attention(clip_f, c_attn_out, c_mod, clip_mask)
             text_f = self.text_block.post_attention(text_f, t_attn_out, t_mod)
 
         return latent, clip_f, text_f
@@ -195,8 +235,12 @@ class FinalBlock(nn.Module):
         self.norm = nn.LayerNorm(dim, elementwise_affine=False)
         self.conv = ChannelLastConv1d(dim, out_dim, kernel_size=7, padding=3)
 
-    def forward(self, latent, c):
-        shift, scale = self.adaLN_modulation(c).chunk(2, dim=-1)
+    def forward(self, latent, c, modulation=None, mask=None):
+        # modulation: precomputed self.adaLN_modulation(c), optional
+        # mask: (B, N, 1) for padded batches, optional
+        if modulation is None:
+            modulation = self.adaLN_modulation(c)
+        shift, scale = modulation.chunk(2, dim=-1)
         latent = modulate(self.norm(latent), shift, scale)
-        latent = self.conv(latent)
+        latent = self.conv(latent, mask)
         return latent
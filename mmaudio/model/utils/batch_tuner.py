@@ -0,0 +1,115 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Callable, Optional, Union
+
+import torch
+
+log = logging.getLogger()
+
+
+class MicroBatchTuner:
+    """
+    Finds the largest micro-batch size of an encoder, per device and dtype, whose peak memory fits
+    in the free device memory minus memory_headroom (a fraction of it), by doubling the size until
+    it does not fit, runs out of memory, or reaches max_batch_size.
+    The sizes are persisted in cache_path (JSON), so the probe runs once per setup. When a
+    micro-batch runs out of memory later on (e.g., next to concurrent requests), backoff halves
+    the size, which is persisted as well.
+    Devices without memory statistics (CPU/MPS) use default_batch_size.
+    """
+
+    def __init__(self,
+                 cache_path: Optional[Union[str, Path]] = None,
+                 *,
+                 memory_headroom: float = 0.2,
+                 max_batch_size: int = 1024,
+                 default_batch_size: int = 64):
+        assert 0 <= memory_headroom < 1, f'{memory_headroom=}'
+        self.cache_path = Path(cache_path) if cache_path is not None else None
+        self.memory_headroom = memory_headroom
+        self.max_batch_size = max_batch_size
+        self.default_batch_size = default_batch_size
+
+        self._lock = threading.Lock()
+        self._batch_sizes: dict[str, int] = {}
+        if self.cache_path is not None and self.cache_path.exists():
+            with open(self.cache_path) as f:
+                self._batch_sizes = json.load(f)
+
+    def _key(self, name: str, device: torch.device, dtype: torch.dtype) -> str:
+        device = torch.device(device)
+        if device.type == 'cuda':
+            properties = torch.cuda.get_device_properties(device)
+            device_name = f'{properties.name}-{properties.total_memory}'
+        else:
+            device_name = device.type
+        return f'{name}-{device_name}-{dtype}-{self.memory_headroom}'
+
+    def _save(self) -> None:
+        if self.cache_path is not None:
+            # written atomically, as several processes (e.g., one per GPU) may share the file
+            self.cache_path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.cache_path.with_name(f'{self.cache_path.name}.{os.getpid()}.tmp')
+            with open(tmp_path, 'w') as f:
+                json.dump(self._batch_sizes, f, indent=2)
+            os.replace(tmp_path, self.cache_path)
+
+    def get(self, name: str, device: torch.device, dtype: torch.dtype) -> Optional[int]:
+        with self._lock:
+            return self._batch_sizes.get(self._key(name, device, dtype))
+
+    def tune(self, name: str, device: torch.device, dtype: torch.dtype,
+             run: Callable[[int], object]) -> int:
+        """
+        run(batch_size): runs the encoder on a dummy micro-batch of batch_size items
+        """
+        key = self._key(name, device, dtype)
+        with self._lock:
+            if key in self._batch_sizes:
+                return self._batch_sizes[key]
+
+        device = torch.device(device)
+        if device.type != 'cuda':
+            batch_size = self.default_batch_size
+        else:
+            torch.cuda.empty_cache()
+            free_memory, _ = torch.cuda.mem_get_info(device)
+            budget = free_memory * (1 - self.memory_headroom)
+            batch_size = 1
+            candidate = 1
+            while candidate <= self.max_batch_size:
+                torch.cuda.reset_peak_memory_stats(device)
+                base_memory = torch.cuda.memory_allocated(device)
+                try:
+                    run(candidate)
+                    torch.cuda.synchronize(device)
+                except torch.cuda.OutOfMemoryError:
+                    break
+                finally:
+                    torch.cuda.empty_cache()
+                if torch.cuda.max_memory_allocated(device) - base_memory > budget:
+                    break
+                batch_size = candidate
+                candidate *= 2
+
+        log.info(f'Micro-batch size of {key}: {batch_size}')
+        with self._lock:
+            self._batch_sizes[key] = batch_size
+            self._save()
+        return batch_size
+
+    def backoff(self, name: str, device: torch.device, dtype: torch.dtype,
+                batch_size: int) -> int:
+        # after running out of memory with batch_size; returns the new size
+        key = self._key(name, device, dtype)
+        new_batch_size = max(batch_size // 2, 1)
+        log.warning(f'Out of memory with a micro-batch size of {batch_size} ({key}), '
+                    f'retrying with {new_batch_size}')
+        with self._lock:
+            self._batch_sizes[key] = min(self._batch_sizes.get(key, new_batch_size),
+                                         new_batch_size)
+            self._save()
+        return new_batch_size
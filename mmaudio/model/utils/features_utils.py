@@ -1,4 +1,5 @@
-from typing import Literal, Optional
+import threading
+from typing import Callable, Iterable, Iterator, Literal, Optional
 
 import open_clip
 import torch
@@ -11,7 +12,9 @@ from torchvision.transforms import Normalize
 from mmaudio.ext.autoencoder import AutoEncoderModule
 from mmaudio.ext.mel_converter import get_mel_converter
 from mmaudio.ext.synchformer import Synchformer
+from mmaudio.model.utils.batch_tuner import MicroBatchTuner
 from mmaudio.model.utils.distributions import DiagonalGaussianDistribution
+from mmaudio.utils.feature_cache import TextFeatureCache
 
 
 def patch_clip(clip_model):
@@ -31,6 +34,76 @@ def patch_clip(clip_model):
     return clip_model
 
 
+def dedupe_frames(frames: torch.Tensor, threshold: float,
+                  num_videos: int) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    frames: (N, C, H, W) frames of num_videos videos, in order
+    A frame is a near-duplicate of the last kept frame of its video if the mean absolute
+    difference of their 48x48 average-pooled thumbnails is at most threshold (in the value range
+    of frames; 0: only frames that are identical at the thumbnail level).
+    Returns the indices of the kept frames, and for each frame, the position in the kept frames
+    of the one that stands in for it.
+    """
+    # (num_videos, T, C * 48 * 48) thumbnails; small enough to compare on the CPU
+    thumbnails = F.adaptive_avg_pool2d(frames.float(), 48).flatten(1).cpu()
+    thumbnails = thumbnails.unflatten(0, (num_videos, -1))
+
+    keep = []
+    inverse = []
+    num_frames = thumbnails.shape[1]
+    for video_idx, video_thumbnails in enumerate(thumbnails):
+        # one pass, comparing each frame with the last kept frame only
+        last = None
+        for i, thumbnail in enumerate(video_thumbnails):
+            if last is None or (thumbnail - last).abs().mean().item() > threshold:
+                last = thumbnail
+                keep.append(video_idx * num_frames + i)
+            inverse.append(len(keep) - 1)
+    return torch.tensor(keep, device=frames.device), torch.tensor(inverse, device=frames.device)
+
+
+def tiled_apply(fn: Callable[[torch.Tensor], torch.Tensor], x: torch.Tensor, tile_len: int,
+                overlap: int) -> torch.Tensor:
+    """
+    Applies fn, which maps (B, C, L) to (B, C', L * r) for an integer factor r (e.g., the VAE
+    decoder or the vocoder), to tiles of tile_len steps of x with overlap steps between
+    consecutive tiles, so that the activation memory does not grow with L.
+    The outputs are crossfaded (raised cosine) over the middle half of each overlap, and taken
+    from one tile only in its outer quarters. Outputs within the receptive field of a tile edge
+    are affected by the edge, so for layers with a one-sided receptive field of at most
+    overlap / 4 steps, the result is the same as fn(x); layers with a longer (e.g., global)
+    receptive field drift from it.
+    """
+    length = x.shape[-1]
+    if length <= tile_len:
+        return fn(x)
+    assert 0 < 2 * overlap <= tile_len, f'{tile_len=} {overlap=}'
+
+    stride = tile_len - overlap
+    output = None
+    for start in range(0, length - overlap, stride):
+        end = min(start + tile_len, length)
+        y = fn(x[..., start:end])
+        r = y.shape[-1] // (end - start)
+        if output is None:
+            output = y.new_zeros(*y.shape[:-1], length * r)
+
+        # the weights of the two tiles sum to one in each overlap
+        margin = overlap * r // 4
+        fade_len = overlap * r - 2 * margin
+        fade_in = 0.5 - 0.5 * torch.cos(
+            torch.pi * (torch.arange(fade_len, device=y.device, dtype=y.dtype) + 0.5) / fade_len)
+        weight = y.new_ones(y.shape[-1])
+        if start > 0:
+            weight[:margin] = 0
+            weight[margin:margin + fade_len] = fade_in
+        if end < length:
+            weight[len(weight) - overlap * r + margin:len(weight) - margin] = fade_in.flip(0)
+            weight[len(weight) - margin:] = 0
+        output[..., start * r:end * r] += y * weight
+    return output
+
+
 class FeaturesUtils(nn.Module):
 
     def __init__(
@@ -42,8 +115,36 @@ class FeaturesUtils(nn.Module):
         enable_conditions: bool = True,
         mode=Literal['16k', '44k'],
         need_vae_encoder: bool = True,
+        text_cache: Optional[TextFeatureCache] = None,
+        batch_tuner: Optional[MicroBatchTuner] = None,
+        clip_dedupe_threshold: Optional[float] = None,
+        decode_tile_len: Optional[int] = None,
+        decode_overlap: int = 96,
+        vocode_tile_len: Optional[int] = None,
+        vocode_overlap: int = 128,
+        cpu_activation: bool = False,
     ):
         super().__init__()
+        # encode_text only runs the text tower for prompts that are not in text_cache
+        self.text_cache = text_cache
+        # with a batch_tuner, the video encoders run in the tuned micro-batch sizes (see
+        # tune_batch_sizes) and back off when they run out of memory
+        self.batch_tuner = batch_tuner
+        # if set, CLIP only encodes one of each run of near-duplicate frames (e.g., still images,
+        # slideshows, slow pans) and shares its embedding; see dedupe_frames for the threshold
+        self.clip_dedupe_threshold = clip_dedupe_threshold
+        self.clip_dedupe_stats = {'frames': 0, 'encoded': 0}
+        # the demo runs requests in threads that share one FeaturesUtils
+        self._stats_lock = threading.Lock()
+        # if set, decode (in latents) and vocode (in mel frames) run in overlapping tiles; see
+        # tiled_apply. The one-sided receptive fields are about 21 latents for the VAE decoder
+        # (whose mid-block attention is global, though) and about 22 mel frames for BigVGAN, so
+        # the default overlaps reproduce their convolutions exactly. Tiling only pays off for
+        # outputs that are several tiles long; generate_long decodes one window at a time.
+        self.decode_tile_len = decode_tile_len
+        self.decode_overlap = decode_overlap
+        self.vocode_tile_len = vocode_tile_len
+        self.vocode_overlap = vocode_overlap
 
         if enable_conditions:
             self.clip_model = create_model_from_pretrained('hf-hub:apple/DFN5B-CLIP-ViT-H-14-384',
@@ -67,7 +168,8 @@ class FeaturesUtils(nn.Module):
             self.tod = AutoEncoderModule(vae_ckpt_path=tod_vae_ckpt,
                                          vocoder_ckpt_path=bigvgan_vocoder_ckpt,
                                          mode=mode,
-                                         need_vae_encoder=need_vae_encoder)
+                                         need_vae_encoder=need_vae_encoder,
+                                         cpu_activation=cpu_activation)
         else:
             self.tod = None
 
@@ -77,26 +179,86 @@ class FeaturesUtils(nn.Module):
             self.clip_model.encode_text = torch.compile(self.clip_model.encode_text)
         if self.synchformer is not None:
             self.synchformer = torch.compile(self.synchformer)
-        self.decode = torch.compile(self.decode)
-        self.vocode = torch.compile(self.vocode)
+        if self.tod is not None:
+            # the tiles, rather than the tiling loop
+            self.tod.decode = torch.compile(self.tod.decode)
+            self.tod.vocode = torch.compile(self.tod.vocode)
 
     def train(self, mode: bool) -> None:
         return super().train(False)
 
+    @torch.inference_mode()
+    def tune_batch_sizes(self) -> None:
+        # probes (once per device and dtype; the results are persisted) the micro-batch sizes of
+        # CLIP (in frames) and Synchformer (in segments) with dummy inputs
+        # under autocast (e.g., batch_eval), the inputs are cast to (and keyed by) the autocast
+        # dtype, so that the probes measure the memory of the actual runs
+        assert self.batch_tuner is not None, 'No batch tuner'
+        device, dtype = self.device, self.compute_dtype
+        if self.clip_model is not None:
+            self.batch_tuner.tune(
+                'clip', device, dtype, lambda n: self.clip_model.encode_image(
+                    torch.zeros(n, 3, 384, 384, device=device, dtype=dtype), normalize=True))
+        if self.synchformer is not None:
+            self.batch_tuner.tune(
+                'sync', device, dtype, lambda n: self.synchformer(
+                    torch.zeros(n, 1, 16, 3, 224, 224, device=device, dtype=dtype)))
+
+    def _run_micro_batches(self, name: str, num_items: int, batch_size: int,
+                           default_batch_size: int,
+                           run: Callable[[int, int], torch.Tensor]) -> list[torch.Tensor]:
+        """
+        run(start, end): encodes the items [start, end)
+        batch_size < 0 uses the tuned size of the batch tuner (or default_batch_size without one);
+        other sizes are capped by the tuned size. Running out of memory halves the size and
+        retries the micro-batch.
+        """
+        tuned_batch_size = None
+        if self.batch_tuner is not None:
+            tuned_batch_size = self.batch_tuner.get(name, self.device, self.compute_dtype)
+        if batch_size < 0:
+            batch_size = tuned_batch_size or default_batch_size
+        elif tuned_batch_size is not None:
+            batch_size = min(batch_size, tuned_batch_size)
+
+        outputs = []
+        start = 0
+        while start < num_items:
+            end = min(start + batch_size, num_items)
+            try:
+                outputs.append(run(start, end))
+            except torch.cuda.OutOfMemoryError:
+                if self.batch_tuner is None or batch_size == 1:
+                    raise
+                torch.cuda.empty_cache()
+                batch_size = self.batch_tuner.backoff(name, self.device, self.compute_dtype,
+                                                      batch_size)
+                continue
+            start = end
+        return outputs
+
     @torch.inference_mode()
     def encode_video_with_clip(self, x: torch.Tensor, batch_size: int = -1) -> torch.Tensor:
         assert self.clip_model is not None, 'CLIP is not loaded'
         # x: (B, T, C, H, W) H/W: 384
         b, t, c, h, w = x.shape
         assert c == 3 and h == 384 and w == 384
-        x = self.clip_preprocess(x)
         x = rearrange(x, 'b t c h w -> (b t) c h w')
-        outputs = []
-        if batch_size < 0:
-            batch_size = b * t
-        for i in range(0, b * t, batch_size):
-            outputs.append(self.clip_model.encode_image(x[i:i + batch_size], normalize=True))
+        inverse = None
+        if self.clip_dedupe_threshold is not None:
+            keep, inverse = dedupe_frames(x, self.clip_dedupe_threshold, b)
+            x = x[keep]
+            with self._stats_lock:
+                self.clip_dedupe_stats['frames'] += b * t
+                self.clip_dedupe_stats['encoded'] += len(keep)
+        x = self.clip_preprocess(x)
+        outputs = self._run_micro_batches(
+            'clip', len(x), batch_size, len(x),
+            lambda start, end: self.clip_model.encode_image(x[start:end], normalize=True))
         x = torch.cat(outputs, dim=0)
+        if inverse is not None:
+            # scattered back to all frames
+            x = x[inverse]
         # x = self.clip_model.encode_image(x, normalize=True)
         x = rearrange(x, '(b t) d -> b t d', b=b)
         return x
@@ -109,32 +271,75 @@ class FeaturesUtils(nn.Module):
         b, t, c, h, w = x.shape
         assert c == 3 and h == 224 and w == 224
 
-        # partition the video
+        # partition the video into overlapping segments; a view, without copying the frames
         segment_size = 16
         step_size = 8
-        num_segments = (t - segment_size) // step_size + 1
-        segments = []
-        for i in range(num_segments):
-            segments.append(x[:, i * step_size:i * step_size + segment_size])
-        x = torch.stack(segments, dim=1)  # (B, S, T, C, H, W)
+        segments = x.unfold(1, segment_size, step_size).permute(0, 1, 5, 2, 3, 4)
+        num_segments = segments.shape[1]  # (t - segment_size) // step_size + 1
 
-        outputs = []
-        if batch_size < 0:
-            batch_size = b
-        x = rearrange(x, 'b s t c h w -> (b s) 1 t c h w')
-        for i in range(0, b * num_segments, batch_size):
-            outputs.append(self.synchformer(x[i:i + batch_size]))
+        def run(start: int, end: int) -> torch.Tensor:
+            # only the segments of one micro-batch are materialized
+            parts = []
+            for j in range(start, end):
+                video_idx, segment_idx = divmod(j, num_segments)
+                if parts and parts[-1][0] == video_idx:
+                    parts[-1][2] = segment_idx + 1
+                else:
+                    parts.append([video_idx, segment_idx, segment_idx + 1])
+            batch = torch.cat([segments[v, s:e] for v, s, e in parts])
+            return self.synchformer(batch.unsqueeze(1))
+
+        outputs = self._run_micro_batches('sync', b * num_segments, batch_size, b, run)
         x = torch.cat(outputs, dim=0)
         x = rearrange(x, '(b s) 1 t d -> b (s t) d', b=b)
         return x
 
+    @torch.inference_mode()
+    def encode_video_with_sync_streaming(self,
+                                         chunks: Iterable[torch.Tensor],
+                                         batch_size: int = -1,
+                                         min_segments: int = 1) -> Iterator[torch.Tensor]:
+        """
+        chunks: consecutive (B, T_i, C, H, W) chunks of the video, of any length
+        Yields the (B, S_i * 8, D) features of the segments as soon as all of their frames are
+        available, in batches of at least min_segments segments (except at the end); together,
+        they are the same as encode_video_with_sync of the whole video. Only the frames of the
+        segments that are yet to be encoded are kept, so the memory does not grow with the length.
+        """
+        segment_size = 16
+        step_size = 8
+        pending = None
+        for chunk in chunks:
+            pending = chunk if pending is None else torch.cat([pending, chunk], dim=1)
+            num_segments = (pending.shape[1] - segment_size) // step_size + 1
+            if num_segments >= max(min_segments, 1):
+                end = (num_segments - 1) * step_size + segment_size
+                yield self.encode_video_with_sync(pending[:, :end], batch_size)
+                pending = pending[:, num_segments * step_size:]
+        if pending is not None and pending.shape[1] >= segment_size:
+            yield self.encode_video_with_sync(pending, batch_size)
+
     @torch.inference_mode()
     def encode_text(self, text: list[str]) -> torch.Tensor:
         assert self.clip_model is not None, 'CLIP is not loaded'
         assert self.tokenizer is not None, 'Tokenizer is not loaded'
         # x: (B, L)
-        tokens = self.tokenizer(text).to(self.device)
-        return self.clip_model.encode_text(tokens, normalize=True)
+        if self.text_cache is None:
+            tokens = self.tokenizer(text).to(self.device)
+            return self.clip_model.encode_text(tokens, normalize=True)
+
+        # keyed by the dtype the encoder runs in (the autocast dtype under autocast), and
+        # returned in the dtype it produced, as in the uncached path
+        variant = str(self.compute_dtype)
+        features = {t: self.text_cache.get(t, variant) for t in dict.fromkeys(text)}
+        missing = [t for t, f in features.items() if f is None]
+        if len(missing) > 0:
+            tokens = self.tokenizer(missing).to(self.device)
+            missing_features = self.clip_model.encode_text(tokens, normalize=True)
+            for t, f in zip(missing, missing_features):
+                self.text_cache.put(t, f, variant)
+                features[t] = f
+        return torch.stack([features[t].to(self.device) for t in text])
 
     @torch.inference_mode()
     def encode_audio(self, x) -> DiagonalGaussianDistribution:
@@ -148,11 +353,16 @@ class FeaturesUtils(nn.Module):
     @torch.inference_mode()
     def vocode(self, mel: torch.Tensor) -> torch.Tensor:
         assert self.tod is not None, 'VAE is not loaded'
+        if self.vocode_tile_len is not None:
+            return tiled_apply(self.tod.vocode, mel, self.vocode_tile_len, self.vocode_overlap)
         return self.tod.vocode(mel)
 
     @torch.inference_mode()
     def decode(self, z: torch.Tensor) -> torch.Tensor:
         assert self.tod is not None, 'VAE is not loaded'
+        if self.decode_tile_len is not None:
+            return tiled_apply(self.tod.decode, z.transpose(1, 2), self.decode_tile_len,
+                               self.decode_overlap)
         return self.tod.decode(z.transpose(1, 2))
 
     @property
@@ -162,3 +372,11 @@ class FeaturesUtils(nn.Module):
     @property
     def dtype(self):
         return next(self.parameters()).dtype
+
+    @property
+    def compute_dtype(self) -> torch.dtype:
+        # the dtype the encoders run in: the autocast dtype under autocast
+        device_type = self.device.type
+        if torch.is_autocast_enabled(device_type):
+            return torch.get_autocast_dtype(device_type)
+        return self.dtype
@@ -24,6 +24,7 @@ from mmaudio.model.utils.sample_utils import log_normal_sample
 from mmaudio.utils.dist_utils import (info_if_rank_zero, local_rank, string_if_rank_zero)
 from mmaudio.utils.log_integrator import Integrator
 from mmaudio.utils.logger import TensorboardLogger
+from mmaudio.utils.tensor_utils import randn_per_sample
 from mmaudio.utils.time_estimator import PartialTimeEstimator, TimeEstimator
 from mmaudio.utils.video_joiner import VideoJoiner
 
@@ -69,9 +70,15 @@ class Runner:
             self.train_fn = torch.compile(self.train_fn)
             self.val_fn = torch.compile(self.val_fn)
 
-        self.fm = FlowMatching(cfg.sampling.min_sigma,
-                               inference_mode=cfg.sampling.method,
-                               num_steps=cfg.sampling.num_steps)
+        sampling_cfg = cfg.sampling
+        self.fm = FlowMatching(sampling_cfg.min_sigma,
+                               inference_mode=sampling_cfg.method,
+                               num_steps=sampling_cfg.num_steps,
+                               time_schedule=sampling_cfg.time_schedule,
+                               schedule_shift=sampling_cfg.schedule_shift,
+                               guidance_interval=sampling_cfg.guidance_interval,
+                               guidance_weights=sampling_cfg.guidance_weights,
+                               adaptive_guidance_threshold=sampling_cfg.adaptive_guidance_threshold)
 
         # ema profile
         if for_training and cfg.ema.enable and local_rank == 0:
@@ -415,7 +422,10 @@ class Runner:
                        it: int,
                        data_cfg: DictConfig,
                        *,
-                       save_eval: bool = True) -> Path:
+                       save_eval: bool = True,
+                       rng: Optional[list[Union[torch.Generator, int]]] = None) -> Path:
+        # rng: one generator or seed per sample, optional; by default, the noise of the whole
+        # batch is drawn from self.rng and hence depends on the batch composition
         self.enter_val()
         with torch.amp.autocast('cuda', enabled=self.use_amp, dtype=torch.bfloat16):
             clip_f = data['clip_features'].cuda(non_blocking=True)
@@ -430,11 +440,19 @@ class Runner:
             text_f[~text_exist] = self.network.module.empty_string_feat
 
             # sample
-            x0 = torch.empty_like(a_mean).normal_(generator=self.rng)
+            if rng is None:
+                x0 = torch.empty_like(a_mean).normal_(generator=self.rng)
+            else:
+                bs, seq_len, latent_dim = a_mean.shape
+                x0 = randn_per_sample(rng, [seq_len] * bs,
+                                      latent_dim,
+                                      device=a_mean.device,
+                                      dtype=a_mean.dtype)
             conditions = self.network.module.preprocess_conditions(clip_f, sync_f, text_f)
             empty_conditions = self.network.module.get_empty_conditions(x0.shape[0])
+            guidance = self.fm.get_guidance_schedule(self.cfg_strength)
             cfg_ode_wrapper = lambda t, x: self.network.module.ode_wrapper(
-                t, x, conditions, empty_conditions, self.cfg_strength)
+                t, x, conditions, empty_conditions, self.cfg_strength, guidance)
             x1_hat = self.fm.to_data(cfg_ode_wrapper, x0)
             x1_hat = self.network.module.unnormalize(x1_hat)
             mel = self.features.decode(x1_hat)
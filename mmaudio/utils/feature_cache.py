@@ -0,0 +1,216 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+import torch
+from safetensors.torch import load_file, save_file
+
+log = logging.getLogger()
+
+
+def hash_file(path: Union[str, Path], chunk_size: int = 1 << 20) -> str:
+    # sha256 of the file content
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class TieredFeatureCache:
+    """
+    Two-tier cache of named CPU tensors: an in-memory LRU of max_memory_entries entries and,
+    optionally, safetensors files in cache_dir that are evicted (least recently used first)
+    once they exceed max_disk_bytes (down to 90% of it). Keys must be valid file names. Thread-safe.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[Union[str, Path]] = None,
+                 *,
+                 max_memory_entries: int = 32,
+                 max_disk_bytes: int = 16 << 30):
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        self._memory: OrderedDict[str, dict[str, torch.Tensor]] = OrderedDict()
+        self._lock = threading.Lock()
+        # running total of the sizes of the files in cache_dir; scanned on the first put and on
+        # each eviction (which also picks up the files of other processes)
+        self._disk_bytes: Optional[int] = None
+
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / f'{key}.safetensors'
+
+    def get_tensors(self, key: str) -> Optional[dict[str, torch.Tensor]]:
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self.memory_hits += 1
+                return self._memory[key]
+
+        if self.cache_dir is not None and self._disk_path(key).exists():
+            path = self._disk_path(key)
+            try:
+                tensors = load_file(path)
+            except Exception as e:
+                # e.g., evicted by another process in the meantime or a partial write
+                log.warning(f'Cannot read cached features {path}: {e}')
+            else:
+                os.utime(path)  # for the LRU eviction
+                with self._lock:
+                    self.disk_hits += 1
+                    self._put_memory(key, tensors)
+                return tensors
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put_tensors(self, key: str, tensors: dict[str, torch.Tensor]) -> None:
+        tensors = {k: v.detach().cpu().contiguous() for k, v in tensors.items()}
+        with self._lock:
+            self._put_memory(key, tensors)
+
+        if self.cache_dir is not None:
+            path = self._disk_path(key)
+            tmp_path = path.with_suffix(f'.{os.getpid()}.{threading.get_ident()}.tmp')
+            save_file(tensors, tmp_path)
+            old_size = path.stat().st_size if path.exists() else 0
+            os.replace(tmp_path, path)
+            size = path.stat().st_size
+            with self._lock:
+                if self._disk_bytes is not None:
+                    self._disk_bytes += size - old_size
+                disk_bytes = self._disk_bytes
+            if disk_bytes is None or disk_bytes > self.max_disk_bytes:
+                self._evict_disk(keep=path)
+
+    def _put_memory(self, key: str, tensors: dict[str, torch.Tensor]) -> None:
+        self._memory[key] = tensors
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict_disk(self, keep: Path) -> None:
+        # once the total size exceeds max_disk_bytes, removes the least recently used files (but
+        # not keep) until it is below 90% of it, so that the directory is not scanned on every put
+        files = []
+        for path in self.cache_dir.glob('*.safetensors'):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in files)
+        if total_bytes > self.max_disk_bytes:
+            for _, size, path in sorted(files):
+                if total_bytes <= 0.9 * self.max_disk_bytes:
+                    break
+                if path == keep:
+                    continue
+                path.unlink(missing_ok=True)
+                total_bytes -= size
+        with self._lock:
+            self._disk_bytes = total_bytes
+
+    @property
+    def hit_rate(self) -> float:
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            return hits / max(hits + self.misses, 1)
+
+    def stats(self) -> dict[str, int]:
+        with self._lock:
+            return {
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'memory_entries': len(self._memory),
+            }
+
+
+class VideoFeatureCache(TieredFeatureCache):
+    """
+    Content-addressed cache of the CLIP and Synchformer features of videos, so that retries,
+    prompt tweaks, and new seeds on the same upload skip the visual encoders.
+    Entries are keyed by make_key, i.e., by the content hash of the video file, the duration,
+    and a variant string that identifies the encoders/preprocessing.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[Union[str, Path]] = None,
+                 *,
+                 max_file_hashes: int = 1024,
+                 **kwargs):
+        super().__init__(cache_dir, **kwargs)
+        # LRU of (path, size, mtime) -> content hash, to avoid re-hashing unchanged files
+        self.max_file_hashes = max_file_hashes
+        self._file_hashes: OrderedDict[tuple[str, int, int], str] = OrderedDict()
+
+    def make_key(self, video_path: Union[str, Path], duration_sec: float, variant: str) -> str:
+        stat = os.stat(video_path)
+        file_key = (str(video_path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            content_hash = self._file_hashes.get(file_key)
+            if content_hash is not None:
+                self._file_hashes.move_to_end(file_key)
+        if content_hash is None:
+            # hashed outside the lock, which is shared with the feature lookups
+            content_hash = hash_file(video_path)
+            with self._lock:
+                self._file_hashes[file_key] = content_hash
+                while len(self._file_hashes) > self.max_file_hashes:
+                    self._file_hashes.popitem(last=False)
+        return hashlib.sha256(f'{content_hash}-{duration_sec:.3f}-{variant}'.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[tuple[torch.Tensor, torch.Tensor]]:
+        # returns (clip_features, sync_features) on the CPU, each without the batch dimension
+        tensors = self.get_tensors(key)
+        if tensors is None:
+            return None
+        return tensors['clip_features'], tensors['sync_features']
+
+    def put(self, key: str, clip_features: torch.Tensor, sync_features: torch.Tensor) -> None:
+        self.put_tensors(key, {'clip_features': clip_features, 'sync_features': sync_features})
+
+
+class TextFeatureCache(TieredFeatureCache):
+    """
+    Cache of CLIP text features keyed by the exact prompt string and a variant string, e.g., the
+    dtype the text encoder ran in (see FeaturesUtils.encode_text). The features are stored in
+    the dtype they were produced in.
+    A cache_dir should be used by one text encoder only.
+    """
+
+    def __init__(self,
+                 cache_dir: Optional[Union[str, Path]] = None,
+                 *,
+                 max_memory_entries: int = 1024,
+                 **kwargs):
+        super().__init__(cache_dir, max_memory_entries=max_memory_entries, **kwargs)
+
+    @staticmethod
+    def make_key(text: str, variant: str = '') -> str:
+        # without a variant, the keys are the same as those of earlier versions
+        if variant:
+            text = f'{variant}-{text}'
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, text: str, variant: str = '') -> Optional[torch.Tensor]:
+        # returns the (L, D) features on the CPU
+        tensors = self.get_tensors(self.make_key(text, variant))
+        return tensors['text_features'] if tensors is not None else None
+
+    def put(self, text: str, text_features: torch.Tensor, variant: str = '') -> None:
+        self.put_tensors(self.make_key(text, variant), {'text_features': text_features})
@@ -1,4 +1,7 @@
+from typing import Optional, Union
+
 import torch
+import torch.nn.functional as F
 
 
 def distribute_into_histogram(loss: torch.Tensor,
@@ -12,3 +15,38 @@ def distribute_into_histogram(loss: torch.Tensor,
     hist.scatter_add_(0, t, loss)
     count.scatter_add_(0, t, torch.ones_like(loss))
     return hist, count
+
+
+def make_generators(seeds: list[int], device: Union[torch.device, str]) -> list[torch.Generator]:
+    # one generator per sample; a negative seed means a random seed
+    generators = []
+    for seed in seeds:
+        generator = torch.Generator(device=device)
+        if seed >= 0:
+            generator.manual_seed(seed)
+        else:
+            generator.seed()
+        generators.append(generator)
+    return generators
+
+
+def randn_per_sample(generators: list[Union[torch.Generator, int]],
+                     lengths: list[int],
+                     dim: int,
+                     *,
+                     max_length: Optional[int] = None,
+                     device: Union[torch.device, str] = 'cpu',
+                     dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """
+    Draws (B, max_length, dim) Gaussian noise where sample i only depends on generators[i]
+    (or on the seed if it is an int) and lengths[i], so that a sample does not change with the
+    size or the composition of its batch. The samples are zero-padded to max_length.
+    """
+    max_length = max(lengths) if max_length is None else max_length
+    generators = [
+        make_generators([g], device)[0] if isinstance(g, int) else g for g in generators
+    ]
+    return torch.cat([
+        F.pad(torch.randn(1, length, dim, device=device, dtype=dtype, generator=g),
+              (0, 0, 0, max_length - length)) for g, length in zip(generators, lengths)
+    ])
@@ -0,0 +1,71 @@
+import pytest
+import torch
+
+from mmaudio.model.networks import MMAudio
+from mmaudio.model.utils.features_utils import FeaturesUtils
+
+
+def make_tiny_mmaudio(v2: bool = True) -> MMAudio:
+    # a small network with random (non-zero) weights for numerical tests
+    torch.manual_seed(0)
+    net = MMAudio(latent_dim=8,
+                  clip_dim=16,
+                  sync_dim=16,
+                  text_dim=16,
+                  hidden_dim=64,
+                  depth=3,
+                  fused_depth=1,
+                  num_heads=2,
+                  latent_seq_len=43,
+                  clip_seq_len=8,
+                  sync_seq_len=24,
+                  text_seq_len=5,
+                  latent_mean=torch.zeros(8),
+                  latent_std=torch.ones(8),
+                  v2=v2)
+    # the default initialization zeros out the modulation and output layers
+    with torch.no_grad():
+        for p in net.parameters():
+            if p.requires_grad:
+                p.normal_(std=0.1)
+    return net.double().eval()
+
+
+@pytest.fixture
+def tiny_net() -> MMAudio:
+    return make_tiny_mmaudio()
+
+
+def _random_conditions(net: MMAudio, bs: int):
+    clip_f = torch.randn(bs, net.clip_seq_len, net.empty_clip_feat.shape[-1], dtype=torch.float64)
+    sync_f = torch.randn(bs, net.sync_seq_len, net.empty_sync_feat.shape[-1], dtype=torch.float64)
+    text_f = torch.randn(bs, *net.empty_string_feat.shape, dtype=torch.float64)
+    return clip_f, sync_f, text_f
+
+
+@pytest.fixture
+def random_conditions():
+    return _random_conditions
+
+
+class PoolingEncoder(torch.nn.Module):
+    # stands in for CLIP and the Synchformer: average-pools the frames
+
+    def __init__(self):
+        super().__init__()
+        self.scale = torch.nn.Parameter(torch.ones(()))
+
+    def encode_image(self, x, normalize=False):
+        return x.mean(dim=(2, 3)) * self.scale
+
+    def forward(self, x):
+        # (B, 1, 16, C, H, W) -> (B, 1, 8, C)
+        return x.mean(dim=(4, 5)).unflatten(2, (8, 2)).mean(dim=3) * self.scale
+
+
+@pytest.fixture
+def pooling_feature_utils() -> FeaturesUtils:
+    feature_utils = FeaturesUtils(enable_conditions=False)
+    feature_utils.clip_model = feature_utils.synchformer = PoolingEncoder()
+    feature_utils.clip_preprocess = lambda x: x
+    return feature_utils
@@ -0,0 +1,99 @@
+from pathlib import Path
+
+import av
+import numpy as np
+import pytest
+import torch
+
+from mmaudio.data.av_utils import FrameIndex, read_frames, remux_with_audio
+from mmaudio.eval_utils import load_video, make_video
+
+EXAMPLE_DIR = Path(__file__).parents[1] / 'training/example_videos'
+VIDEO_PATH = EXAMPLE_DIR / '0B4dYTMsgHA_000130.mp4'
+SAMPLING_RATE = 16000
+
+
+def test_selective_decode_matches_full_decode():
+    kwargs = dict(list_of_fps=[8, 25], start_sec=1.0, end_sec=3.0, need_all_frames=True)
+    full_frames, all_frames, fps = read_frames(VIDEO_PATH, **kwargs)
+    small_frames, frame_index, _ = read_frames(VIDEO_PATH,
+                                               **kwargs,
+                                               frame_size=128,
+                                               index_all_frames=True)
+
+    # the same frames are sampled, at a reduced size
+    for full, small in zip(full_frames, small_frames):
+        assert len(full) == len(small)
+        assert min(small.shape[1:3]) == 128
+
+    assert isinstance(frame_index, FrameIndex)
+    assert len(frame_index) == len(all_frames)
+    assert (frame_index.height, frame_index.width) == all_frames[0].shape[:2]
+    assert all(np.array_equal(a, b) for a, b in zip(frame_index, all_frames))
+
+
+def _read_output(path: Path) -> tuple[list[np.ndarray], float, float]:
+    # the decoded frames and the durations of the video and audio tracks
+    with av.open(path) as container:
+        stream = container.streams.video[0]
+        frames = [frame.to_ndarray(format='rgb24') for frame in container.decode(stream)]
+        video_duration = float(stream.duration * stream.time_base)
+    with av.open(path) as container:
+        num_samples = sum(frame.samples for frame in container.decode(audio=0))
+    return frames, video_duration, num_samples / SAMPLING_RATE
+
+
+def _clean_cut_times(video_path: Path) -> list[float]:
+    # the times after which the earlier frames are a prefix of the stream in decoding order
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        times = [
+            float(packet.pts * stream.time_base) for packet in container.demux(stream)
+            if packet.pts is not None
+        ]
+    cut_times = []
+    for i in range(1, len(times)):
+        if max(times[:i]) < min(times[i:]):
+            cut_times.append(max(times[:i]))
+    return cut_times
+
+
+def _check_output(path: Path, expected_frames: list[np.ndarray], fps: float, exact: bool):
+    frames, video_duration, audio_duration = _read_output(path)
+    assert len(frames) == len(expected_frames)
+    if exact:
+        # copied packets decode to the same pixels; a lost reference would not
+        assert all(np.array_equal(a, b) for a, b in zip(frames, expected_frames))
+    assert abs(video_duration - len(frames) / fps) < 1 / fps
+    # up to the padding of the last AAC frame; re-encoding keeps the audio as it is, which may
+    # be shorter than the last frame
+    tolerance = 1024 / SAMPLING_RATE + (0 if exact else 1 / fps) + 1e-3
+    assert abs(audio_duration - video_duration) < tolerance
+
+
+@pytest.mark.parametrize('video_path', sorted(EXAMPLE_DIR.glob('*.mp4')), ids=lambda p: p.stem)
+def test_remux(video_path, tmp_path):
+    output_path = tmp_path / 'output.mp4'
+    audio = torch.randn(1, 10 * SAMPLING_RATE) * 0.1
+
+    # a cut in the middle of the video where the stream can be cut without re-encoding
+    cut_times = [t for t in _clean_cut_times(video_path) if t >= 2.0]
+    assert len(cut_times) > 0
+    video_info = load_video(video_path, cut_times[0] + 0.01)
+    fps = float(video_info.fps)
+    expected_frames = list(video_info.all_frames)
+    remux_with_audio(video_path, audio, output_path, SAMPLING_RATE, end_sec=cut_times[0] + 0.01)
+    _check_output(output_path, expected_frames, fps, exact=True)
+
+    # elsewhere, the cut is either clean or refused, and make_video falls back to re-encoding
+    for end_sec in [2.3, 4.05, 6.5]:
+        video_info = load_video(video_path, end_sec)
+        expected_frames = list(video_info.all_frames)
+        try:
+            remux_with_audio(video_path, audio, output_path, SAMPLING_RATE, end_sec=end_sec)
+            _check_output(output_path, expected_frames, fps, exact=True)
+        except ValueError:
+            pass
+        make_video(video_info, output_path, audio[:, :int(end_sec * SAMPLING_RATE)],
+                   SAMPLING_RATE)
+        _check_output(output_path, expected_frames, fps, exact=False)
@@ -0,0 +1,58 @@
+import threading
+
+import torch
+
+from mmaudio.batch_scheduler import BatchScheduler, GenerationRequest
+
+
+class RecordingScheduler(BatchScheduler):
+    # records the batches instead of running the network
+
+    def __init__(self, **kwargs):
+        super().__init__({'default': None}, **kwargs)
+        self.batches = []
+
+    def run_batch(self, key, batch):
+        self.batches.append((key, [r.prompt for r in batch]))
+        return [torch.full((1, 4), i, dtype=torch.float32) for i in range(len(batch))]
+
+
+def test_requests_are_grouped_and_scattered():
+    scheduler = RecordingScheduler(max_batch_size=2, max_wait_sec=0.2)
+    durations = [7.5, 8.0, 4.0, 7.2]
+    requests = [
+        GenerationRequest(None, None, f'prompt {i}', '', duration)
+        for i, duration in enumerate(durations)
+    ]
+    requests.append(GenerationRequest(None, None, 'prompt 4', '', 8.0, num_steps=10))
+    futures = [scheduler.submit(r) for r in requests]
+    scheduler.start()
+    try:
+        results = [f.result(timeout=10) for f in futures]
+    finally:
+        scheduler.stop()
+
+    # different durations share batches, sorted by duration; different step counts do not
+    assert sorted(prompts for _, prompts in scheduler.batches) == [
+        ['prompt 0', 'prompt 1'],
+        ['prompt 2', 'prompt 3'],
+        ['prompt 4'],
+    ]
+    # each request receives the output at its position in its batch
+    assert [r[0, 0].item() for r in results] == [0, 1, 0, 1, 0]
+
+
+def test_failed_batch_propagates_the_exception():
+
+    class FailingScheduler(RecordingScheduler):
+
+        def run_batch(self, key, batch):
+            raise RuntimeError('out of memory')
+
+    scheduler = FailingScheduler().start()
+    try:
+        future = scheduler.submit(GenerationRequest(None, None, 'prompt', '', 8.0))
+        assert isinstance(future.exception(timeout=10), RuntimeError)
+    finally:
+        scheduler.stop()
+    assert not any(t.name == 'batch_scheduler' for t in threading.enumerate())
@@ -0,0 +1,44 @@
+import json
+
+import torch
+
+from mmaudio.model.utils.batch_tuner import MicroBatchTuner
+
+
+def test_backoff_on_out_of_memory(pooling_feature_utils, tmp_path):
+    feature_utils = pooling_feature_utils
+    cache_path = tmp_path / 'batch_sizes.json'
+    feature_utils.batch_tuner = MicroBatchTuner(cache_path, default_batch_size=8)
+    feature_utils.tune_batch_sizes()
+    assert feature_utils.batch_tuner.get('clip', feature_utils.device, feature_utils.dtype) == 8
+
+    # an encoder that runs out of memory with more than 3 frames at once
+    encode_image = feature_utils.clip_model.encode_image
+    batch_sizes = []
+
+    def limited_encode_image(x, normalize=False):
+        batch_sizes.append(len(x))
+        if len(x) > 3:
+            raise torch.cuda.OutOfMemoryError('out of memory')
+        return encode_image(x, normalize)
+
+    video = torch.randn(2, 5, 3, 384, 384)
+    expected = feature_utils.encode_video_with_clip(video)
+    feature_utils.clip_model.encode_image = limited_encode_image
+    torch.testing.assert_close(feature_utils.encode_video_with_clip(video), expected)
+    assert batch_sizes == [8, 4, 2, 2, 2, 2, 2]
+
+    # the reduced size is persisted
+    assert list(json.loads(cache_path.read_text()).values()) == [2, 8]
+    tuner = MicroBatchTuner(cache_path, default_batch_size=8)
+    assert tuner.get('clip', feature_utils.device, feature_utils.dtype) == 2
+
+
+def test_tuned_with_the_autocast_dtype(pooling_feature_utils):
+    feature_utils = pooling_feature_utils
+    feature_utils.batch_tuner = MicroBatchTuner(default_batch_size=8)
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        assert feature_utils.compute_dtype == torch.bfloat16
+        feature_utils.tune_batch_sizes()
+    assert feature_utils.batch_tuner.get('clip', feature_utils.device, torch.bfloat16) == 8
+    assert feature_utils.batch_tuner.get('clip', feature_utils.device, feature_utils.dtype) is None
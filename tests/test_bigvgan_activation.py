@@ -0,0 +1,24 @@
+import pytest
+import torch
+
+from mmaudio.ext.bigvgan_v2.activations import Snake, SnakeBeta
+from mmaudio.ext.bigvgan_v2.alias_free_activation.cpu.activation1d import replace_activations
+from mmaudio.ext.bigvgan_v2.alias_free_activation.torch.act import Activation1d
+
+
+@pytest.mark.parametrize('activation', [Snake, SnakeBeta])
+@pytest.mark.parametrize('alpha_logscale', [False, True])
+@pytest.mark.parametrize('length', [1, 5, 64])
+def test_cpu_activation(activation, alpha_logscale, length):
+    torch.manual_seed(0)
+    act = activation(8, alpha_logscale=alpha_logscale)
+    with torch.no_grad():
+        for p in act.parameters():
+            p.normal_(mean=0 if alpha_logscale else 1, std=0.3)
+    model = torch.nn.Sequential(Activation1d(act)).double()
+    x = torch.randn(2, 8, length, dtype=torch.float64)
+
+    expected = model(x)
+    replace_activations(model)
+    assert not isinstance(model[0], Activation1d)
+    torch.testing.assert_close(model(x), expected)
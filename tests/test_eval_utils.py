@@ -0,0 +1,179 @@
+from pathlib import Path
+from types import SimpleNamespace
+
+import torch
+
+from mmaudio.eval_utils import (_crossfade_into, av_sync_score, decode_latents_streaming, generate,
+                                generate_latents, load_and_encode_video, load_video)
+from mmaudio.ext.autoencoder.vae import get_my_vae
+from mmaudio.model.flow_matching import FlowMatching
+
+VIDEO_PATH = Path(__file__).parents[1] / 'training/example_videos/0B4dYTMsgHA_000130.mp4'
+
+
+def test_crossfade_into():
+    audio = torch.zeros(1, 20, dtype=torch.float64)
+    _crossfade_into(audio, torch.ones(1, 12, dtype=torch.float64), 0, 0)
+    _crossfade_into(audio, torch.full((1, 12), 3.0, dtype=torch.float64), 8, 4)
+
+    assert (audio[:, :8] == 1).all()
+    assert (audio[:, 12:] == 3).all()
+    # the seam is a monotonic ramp between the two windows
+    seam = audio[0, 8:12]
+    assert (seam > 1).all() and (seam < 3).all()
+    assert (seam[1:] > seam[:-1]).all()
+
+
+def test_decode_latents_streaming():
+    # a pointwise decoder/vocoder, so the streamed blocks must match the full decode exactly
+    feature_utils = SimpleNamespace(decode=lambda z: z.transpose(1, 2).repeat_interleave(2, -1),
+                                    vocode=lambda spec: spec.sum(1, keepdim=True).repeat_interleave(
+                                        4, -1))
+    net = SimpleNamespace(unnormalize=lambda x: x * 2)
+    x1 = torch.randn(2, 45, 3, dtype=torch.float64)
+
+    expected = feature_utils.vocode(feature_utils.decode(net.unnormalize(x1)))
+    blocks = list(
+        decode_latents_streaming(x1, feature_utils=feature_utils, net=net, chunk_len=8,
+                                 context_len=3))
+    assert len(blocks) == 6
+    torch.testing.assert_close(torch.cat(blocks, dim=-1), expected)
+
+
+@torch.inference_mode()
+def test_decode_latents_streaming_seams():
+    # the VAE decoder (with random weights), whose mid-block attention sees the whole sequence
+    torch.manual_seed(0)
+    decoder = get_my_vae('16k').decoder.eval()
+    feature_utils = SimpleNamespace(decode=lambda z: decoder(z.transpose(1, 2)),
+                                    vocode=lambda spec: spec)
+    net = SimpleNamespace(unnormalize=lambda x: x)
+    x1 = torch.randn(1, 250, 20)
+
+    expected = feature_utils.decode(x1)
+
+    def relative_error(context_len: int) -> float:
+        blocks = decode_latents_streaming(x1.clone(),
+                                          feature_utils=feature_utils,
+                                          net=net,
+                                          context_len=context_len)
+        return ((torch.cat(list(blocks), dim=-1) - expected).norm() / expected.norm()).item()
+
+    assert relative_error(32) < 0.05
+    # the context hides the edges of the convolutions
+    assert relative_error(32) < relative_error(0)
+
+
+@torch.inference_mode()
+def test_per_sample_seeds_do_not_depend_on_the_batch(tiny_net):
+
+    def encode_text(text: list[str]) -> torch.Tensor:
+        # a deterministic "text encoder"
+        generators = [torch.Generator().manual_seed(sum(map(ord, t))) for t in text]
+        return torch.stack([
+            torch.randn(tiny_net.empty_string_feat.shape, generator=g, dtype=torch.float64)
+            for g in generators
+        ])
+
+    feature_utils = SimpleNamespace(device=torch.device('cpu'),
+                                    dtype=torch.float64,
+                                    encode_text=encode_text,
+                                    decode=lambda z: z.transpose(1, 2),
+                                    vocode=lambda spec: spec.sum(1, keepdim=True))
+    fm = FlowMatching(num_steps=4)
+    prompts = [f'prompt {i}' for i in range(8)]
+    seeds = list(range(100, 108))
+
+    def run(indices: list[int]) -> torch.Tensor:
+        return generate(None,
+                        None, [prompts[i] for i in indices],
+                        negative_text=['music'] * len(indices),
+                        feature_utils=feature_utils,
+                        net=tiny_net,
+                        fm=fm,
+                        rng=[seeds[i] for i in indices],
+                        cfg_strength=4.5,
+                        batch_cfg=True)
+
+    batched = run(list(range(8)))
+    for i in [0, 5]:
+        torch.testing.assert_close(run([i]), batched[i:i + 1])
+    # also independent of the position in the batch
+    torch.testing.assert_close(run([5, 0]), batched[[5, 0]])
+
+
+@torch.inference_mode()
+def test_candidates_share_the_video_features(tiny_net):
+    num_encoded = []
+
+    def encode_video_with_clip(x, batch_size):
+        num_encoded.append(len(x))
+        return x.flatten(2)[..., :16]
+
+    def encode_video_with_sync(x, batch_size):
+        num_encoded.append(len(x))
+        return x.flatten(2)[..., :16].repeat_interleave(3, dim=1)
+
+    feature_utils = SimpleNamespace(device=torch.device('cpu'),
+                                    dtype=torch.float64,
+                                    batch_tuner=None,
+                                    encode_video_with_clip=encode_video_with_clip,
+                                    encode_video_with_sync=encode_video_with_sync,
+                                    encode_text=lambda text: torch.zeros(
+                                        len(text),
+                                        *tiny_net.empty_string_feat.shape,
+                                        dtype=torch.float64))
+    clip_video = torch.randn(2, 8, 3, 4, 4, dtype=torch.float64)
+    sync_video = torch.randn(2, 8, 3, 4, 4, dtype=torch.float64)
+    kwargs = dict(feature_utils=feature_utils,
+                  net=tiny_net,
+                  fm=FlowMatching(num_steps=2),
+                  cfg_strength=4.5)
+
+    seeds = [0, 1, 2, 3, 4, 5]
+    candidates = generate_latents(clip_video,
+                                  sync_video, ['a', 'b'],
+                                  rng=seeds,
+                                  num_samples=3,
+                                  **kwargs)
+    assert num_encoded == [2, 2]
+    assert candidates.shape[0] == 6
+    # the same as generating each candidate with its video on its own
+    expected = generate_latents(clip_video[1:2],
+                                sync_video[1:2], ['b'],
+                                rng=seeds[4:5],
+                                **kwargs)
+    torch.testing.assert_close(candidates[4:5], expected)
+
+
+def test_av_sync_score():
+    sampling_rate, fps, num_frames = 100, 25.0, 20
+    video = torch.zeros(2, num_frames, 1, 2, 2)
+    video[:, 10:] = 1  # a single cut
+    hop = int(sampling_rate / fps)
+    audio = torch.randn(2, 1, hop * num_frames) * 0.01
+    # a burst at the cut for the first one, elsewhere for the second one
+    audio[0, :, hop * 10:hop * 11] += torch.randn(hop)
+    audio[1, :, hop * 3:hop * 4] += torch.randn(hop)
+    scores = av_sync_score(audio, video, sampling_rate=sampling_rate, fps=fps)
+    assert scores[0] > 0.5 > scores[1]
+
+
+def test_pipelined_encoding_matches_load_video(pooling_feature_utils):
+    feature_utils = pooling_feature_utils
+
+    # chunks that do not align with the segments
+    video_info, clip_f, sync_f = load_and_encode_video(VIDEO_PATH,
+                                                       3.3,
+                                                       feature_utils=feature_utils,
+                                                       chunk_size=12)
+    expected_info = load_video(VIDEO_PATH, 3.3)
+    assert video_info.duration_sec == expected_info.duration_sec
+    torch.testing.assert_close(video_info.clip_frames, expected_info.clip_frames)
+    torch.testing.assert_close(video_info.sync_frames, expected_info.sync_frames)
+    torch.testing.assert_close(clip_f,
+                               feature_utils.encode_video_with_clip(
+                                   expected_info.clip_frames.unsqueeze(0)))
+    torch.testing.assert_close(sync_f,
+                               feature_utils.encode_video_with_sync(
+                                   expected_info.sync_frames.unsqueeze(0)))
@@ -0,0 +1,147 @@
+import torch
+
+from mmaudio.eval_utils import _encode_videos_with_cache
+from mmaudio.model.utils.features_utils import FeaturesUtils
+from mmaudio.utils.feature_cache import TextFeatureCache, VideoFeatureCache
+
+
+def test_memory_and_disk_tiers(tmp_path):
+    clip_f, sync_f = torch.randn(8, 4), torch.randn(24, 3)
+    cache = VideoFeatureCache(tmp_path, max_memory_entries=1)
+    assert cache.get('a') is None
+    cache.put('a', clip_f, sync_f)
+    cache.put('b', clip_f + 1, sync_f + 1)
+
+    # 'a' is evicted from memory by 'b' but is still on disk
+    features = cache.get('a')
+    assert torch.equal(features[0], clip_f) and torch.equal(features[1], sync_f)
+    assert torch.equal(cache.get('a')[0], clip_f)
+    assert cache.stats() == {'memory_hits': 1, 'disk_hits': 1, 'misses': 1, 'memory_entries': 1}
+
+    # a new process (cold memory) reads from the disk
+    assert torch.equal(VideoFeatureCache(tmp_path).get('b')[1], sync_f + 1)
+
+
+def test_disk_eviction(tmp_path):
+    cache = VideoFeatureCache(tmp_path, max_memory_entries=0, max_disk_bytes=1)
+    cache.put('a', torch.randn(8, 4), torch.randn(24, 3))
+    cache.put('b', torch.randn(8, 4), torch.randn(24, 3))
+    # the disk tier never exceeds its size, except for the latest entry
+    assert [p.stem for p in tmp_path.glob('*.safetensors')] == ['b']
+
+
+def test_disk_bytes_running_total(tmp_path):
+    cache = VideoFeatureCache(tmp_path, max_memory_entries=0, max_disk_bytes=1 << 20)
+    for key in ['a', 'b', 'a', 'c']:
+        cache.put(key, torch.randn(8, 4), torch.randn(24, 3))
+    assert cache._disk_bytes == sum(p.stat().st_size for p in tmp_path.glob('*.safetensors'))
+
+
+def test_make_key_depends_on_content(tmp_path):
+    cache = VideoFeatureCache()
+    video_path = tmp_path / 'video.mp4'
+    video_path.write_bytes(b'video')
+    key = cache.make_key(video_path, 8.0, 'v1')
+    copy_path = tmp_path / 'copy.mp4'
+    copy_path.write_bytes(b'video')
+    assert cache.make_key(copy_path, 8.0, 'v1') == key
+    assert cache.make_key(video_path, 4.0, 'v1') != key
+    assert cache.make_key(video_path, 8.0, 'v2') != key
+
+
+def test_file_hashes_are_bounded(tmp_path):
+    cache = VideoFeatureCache(max_file_hashes=2)
+    paths = []
+    for i in range(3):
+        paths.append(tmp_path / f'{i}.mp4')
+        paths[-1].write_bytes(b'video')
+        cache.make_key(paths[-1], 8.0, 'v1')
+    assert [file_key[0] for file_key in cache._file_hashes] == [str(p) for p in paths[1:]]
+
+
+class CountingEncoder:
+    # encodes each frame as its mean and records the encoded batch sizes
+    device = torch.device('cpu')
+    dtype = torch.float32
+
+    def __init__(self):
+        self.encoded = []
+
+    def encode_video_with_clip(self, x, batch_size):
+        self.encoded.append(len(x))
+        return x.flatten(2).mean(dim=2, keepdim=True)
+
+    def encode_video_with_sync(self, x, batch_size):
+        return x.flatten(2).mean(dim=2, keepdim=True)
+
+
+def test_only_missing_videos_are_encoded():
+    encoder = CountingEncoder()
+    cache = VideoFeatureCache()
+    clip_video, sync_video = torch.randn(3, 8, 3, 2, 2), torch.randn(3, 24, 3, 2, 2)
+    kwargs = dict(feature_utils=encoder,
+                  feature_cache=cache,
+                  clip_batch_size_multiplier=1,
+                  sync_batch_size_multiplier=1)
+
+    expected = _encode_videos_with_cache(clip_video[:2],
+                                         sync_video[:2],
+                                         video_keys=['a', None],
+                                         feature_lens=None,
+                                         **kwargs)
+    # 'a' is cached and the video without a key is encoded again; 'c' is padded to the batch
+    clip_f, sync_f = _encode_videos_with_cache(clip_video,
+                                               sync_video,
+                                               video_keys=['a', None, 'c'],
+                                               feature_lens=[(8, 24), (8, 24), (4, 16)],
+                                               **kwargs)
+    assert encoder.encoded == [2, 2]
+    assert torch.equal(clip_f[:2], expected[0]) and torch.equal(sync_f[:2], expected[1])
+    assert (clip_f[2, 4:] == 0).all() and (sync_f[2, 16:] == 0).all()
+    assert cache.get('c')[0].shape == (4, 1)
+
+
+class FakeTextEncoder(torch.nn.Module):
+    # 'tokenizes' each string as its length and records the encoded batch sizes
+
+    def __init__(self):
+        super().__init__()
+        self.scale = torch.nn.Parameter(torch.ones(()))
+        self.encoded = []
+
+    def tokenize(self, text):
+        return torch.tensor([[len(t)] * 3 for t in text], dtype=torch.float32)
+
+    def encode_text(self, tokens, normalize=False):
+        self.encoded.append(len(tokens))
+        return tokens.unsqueeze(-1) * self.scale
+
+
+def test_text_features_are_cached(tmp_path):
+    feature_utils = FeaturesUtils(enable_conditions=False,
+                                  text_cache=TextFeatureCache(tmp_path, max_memory_entries=2))
+    feature_utils.clip_model = FakeTextEncoder()
+    feature_utils.tokenizer = feature_utils.clip_model.tokenize
+
+    first = feature_utils.encode_text(['a', 'bb', 'a'])
+    second = feature_utils.encode_text(['ccc', 'a', 'bb'])
+    # duplicates and cached prompts are not encoded again
+    assert feature_utils.clip_model.encoded == [2, 1]
+    assert torch.equal(second[1:], first[[0, 1]])
+    assert torch.equal(second[0], torch.full((3, 1), 3.0))
+    assert feature_utils.text_cache.hit_rate == 2 / 5
+
+
+def test_text_features_keyed_by_autocast_dtype(tmp_path):
+    feature_utils = FeaturesUtils(enable_conditions=False, text_cache=TextFeatureCache(tmp_path))
+    feature_utils.clip_model = FakeTextEncoder()
+    feature_utils.tokenizer = feature_utils.clip_model.tokenize
+
+    with torch.autocast('cpu', dtype=torch.bfloat16):
+        miss = feature_utils.encode_text(['a'])
+        hit = feature_utils.encode_text(['a'])
+    # a hit has the dtype of the encoder output, like a miss
+    assert hit.dtype == miss.dtype
+    # and is not shared with the encoder outside autocast
+    feature_utils.encode_text(['a'])
+    assert feature_utils.clip_model.encoded == [1, 1]
@@ -0,0 +1,72 @@
+import torch
+
+from mmaudio.ext.autoencoder.vae import get_my_vae
+from mmaudio.model.utils.features_utils import dedupe_frames, tiled_apply
+
+
+def test_sync_segments(pooling_feature_utils):
+    feature_utils = pooling_feature_utils
+    video = torch.randn(2, 60, 3, 224, 224)
+
+    # the segments as they were built before: a copy of each 16-frame window with a step of 8
+    segments = torch.stack([video[:, i * 8:i * 8 + 16] for i in range(6)], dim=1)
+    expected = feature_utils.synchformer(segments.flatten(0, 1).unsqueeze(1)).flatten(1, 2)
+    expected = expected.unflatten(0, (2, 6)).flatten(1, 2)
+
+    # micro-batches that cross the videos
+    for batch_size in [-1, 1, 4, 5, 100]:
+        torch.testing.assert_close(feature_utils.encode_video_with_sync(video, batch_size),
+                                   expected)
+
+    chunks = [video[:, :7], video[:, 7:30], video[:, 30:31], video[:, 31:]]
+    streamed = list(feature_utils.encode_video_with_sync_streaming(chunks, min_segments=2))
+    assert len(streamed) == 2
+    torch.testing.assert_close(torch.cat(streamed, dim=1), expected)
+
+
+def test_clip_dedupe(pooling_feature_utils):
+    feature_utils = pooling_feature_utils
+    torch.manual_seed(0)
+    # a still scene with a cut and slight noise, and a video of distinct frames
+    frames = torch.rand(3, 3, 384, 384)
+    still = frames[[0, 0, 0, 1, 1, 2]] + 0.001 * torch.randn(6, 3, 384, 384)
+    video = torch.stack([still, torch.rand(6, 3, 384, 384)])
+    expected = feature_utils.encode_video_with_clip(video)
+
+    feature_utils.clip_dedupe_threshold = 0.01
+    features = feature_utils.encode_video_with_clip(video, batch_size=2)
+    assert feature_utils.clip_dedupe_stats == {'frames': 12, 'encoded': 9}
+    # the duplicates share the embedding of the first frame of their run
+    torch.testing.assert_close(features[0], expected[0, [0, 0, 0, 3, 3, 5]])
+    torch.testing.assert_close(features[1], expected[1])
+
+
+def test_dedupe_frames_drift():
+    # a slow fade: each step is below the threshold, but it adds up against the last kept frame
+    frames = torch.linspace(0, 0.05, 6).view(6, 1, 1, 1).expand(6, 3, 96, 96)
+    keep, inverse = dedupe_frames(frames, threshold=0.015, num_videos=1)
+    assert keep.tolist() == [0, 2, 4]
+    assert inverse.tolist() == [0, 0, 1, 1, 2, 2]
+
+
+def test_tiled_apply_local():
+    torch.manual_seed(0)
+    # a convolution with a one-sided receptive field of 2 steps, upsampled by 4
+    conv = torch.nn.Conv1d(3, 2, kernel_size=5, padding=2)
+    fn = lambda x: conv(x).repeat_interleave(4, dim=-1)
+    x = torch.randn(2, 3, 101)
+    with torch.no_grad():
+        for tile_len in [16, 20, 101, 200]:
+            torch.testing.assert_close(tiled_apply(fn, x, tile_len, overlap=8), fn(x))
+
+
+@torch.inference_mode()
+def test_tiled_vae_decode_drift():
+    torch.manual_seed(0)
+    decoder = get_my_vae('16k').decoder.eval()
+    z = torch.randn(1, 20, 400)
+    expected = decoder(z)
+    tiled = tiled_apply(decoder, z, tile_len=192, overlap=96)
+    assert tiled.shape == expected.shape
+    # only the global mid-block attention sees different contexts
+    assert (tiled - expected).norm() / expected.norm() < 0.05
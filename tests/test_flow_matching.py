@@ -0,0 +1,51 @@
+import math
+
+import pytest
+import torch
+
+from mmaudio.model.flow_matching import FlowMatching
+
+
+@pytest.mark.parametrize('time_schedule', ['linear', 'shifted', 'cosine'])
+def test_time_steps(time_schedule):
+    fm = FlowMatching(num_steps=10, time_schedule=time_schedule)
+    steps = fm.get_time_steps(0, 1)
+    assert len(steps) == 11
+    assert steps[0] == 0 and steps[-1] == 1
+    assert (steps[1:] > steps[:-1]).all()
+    torch.testing.assert_close(fm.get_time_steps(1, 0), steps.flip(0))
+
+
+@pytest.mark.parametrize('inference_mode', ['euler', 'heun', 'midpoint', 'rk4', 'dpm_solver_2m'])
+def test_solvers_converge(inference_mode):
+    # dx/dt = -x has the solution x(1) = x(0) / e
+    x0 = torch.randn(2, 5, 3, dtype=torch.float64)
+    expected = x0 / math.e
+    errors = []
+    for num_steps in [10, 20]:
+        fm = FlowMatching(inference_mode=inference_mode, num_steps=num_steps)
+        x1 = fm.to_data(lambda t, x: -x, x0)
+        errors.append((x1 - expected).abs().max().item())
+    assert errors[1] < errors[0] < 0.1
+
+
+def test_guidance_schedule():
+    assert FlowMatching(num_steps=6).get_guidance_schedule(4.5) is None
+
+    fm = FlowMatching(num_steps=6, guidance_interval=(0.0, 0.5))
+    guidance = fm.get_guidance_schedule(4.5)
+    fm.to_data(lambda t, x: torch.full_like(x, guidance.get_strength(t)), torch.zeros(1))
+    assert (guidance.num_guided, guidance.num_unguided) == (4, 2)
+
+    weights = [4.5, 4.5, 3.0, 2.0, 0.0, 0.0]
+    fm = FlowMatching(num_steps=6, guidance_weights=weights)
+    guidance = fm.get_guidance_schedule(4.5)
+    strengths = []
+    fm.to_data(lambda t, x: strengths.append(guidance.get_strength(t)) or x, torch.zeros(1))
+    assert strengths == weights
+
+    fm = FlowMatching(num_steps=6, adaptive_guidance_threshold=0.99)
+    guidance = fm.get_guidance_schedule(4.5)
+    assert guidance.get_strength(torch.tensor(0.0)) == 4.5
+    guidance.observe(torch.ones(1, 4), torch.ones(1, 4) * 1.5)
+    assert guidance.get_strength(torch.tensor(0.5)) == 0.0
@@ -0,0 +1,35 @@
+import torch
+from torchvision.transforms import v2
+
+from mmaudio.data.frame_preprocessor import FramePreprocessor
+
+
+def test_matches_separate_transforms():
+    torch.manual_seed(0)
+    # a smooth random image, so that the two resize orders agree closely
+    frames = torch.rand(2, 3, 27, 48)
+    frames = v2.functional.resize(frames, [540, 960], interpolation=v2.InterpolationMode.BICUBIC)
+    frames = (frames.clamp(0, 1) * 255).to(torch.uint8)
+
+    clip_transform = v2.Compose([
+        v2.Resize((384, 384), interpolation=v2.InterpolationMode.BICUBIC),
+        v2.ToImage(),
+        v2.ToDtype(torch.float32, scale=True),
+    ])
+    sync_transform = v2.Compose([
+        v2.Resize(224, interpolation=v2.InterpolationMode.BICUBIC),
+        v2.CenterCrop(224),
+        v2.ToImage(),
+        v2.ToDtype(torch.float32, scale=True),
+        v2.Normalize(mean=[0.5, 0.5, 0.5], std=[0.5, 0.5, 0.5]),
+    ])
+
+    preprocessor = FramePreprocessor()
+    clip_frames, sync_frames = preprocessor(frames, frames)
+    assert clip_frames.shape == (2, 3, 384, 384) and sync_frames.shape == (2, 3, 224, 224)
+    assert (clip_frames - clip_transform(frames)).abs().mean() < 2 / 255
+    assert (sync_frames - sync_transform(frames)).abs().mean() < 4 / 255
+
+    # sharing the intermediate resize does not change the result
+    torch.testing.assert_close(preprocessor.clip(frames), clip_frames)
+    torch.testing.assert_close(preprocessor.sync(frames), sync_frames)
@@ -0,0 +1,176 @@
+import pytest
+import torch
+
+from mmaudio.model.flow_matching import FlowMatching
+from mmaudio.model.networks import FusedBlockCache, PreprocessedConditions
+
+
+@torch.inference_mode()
+def test_batched_cfg_matches_two_pass(tiny_net, random_conditions):
+    bs = 3
+    conditions = tiny_net.preprocess_conditions(*random_conditions(tiny_net, bs))
+    empty_conditions = tiny_net.get_empty_conditions(bs)
+    joint_conditions = PreprocessedConditions.cat([conditions, empty_conditions])
+
+    latent = torch.randn(bs, tiny_net.latent_seq_len, tiny_net.latent_dim, dtype=torch.float64)
+    for t in [0.0, 0.3, 0.9]:
+        t = torch.tensor(t, dtype=torch.float64)
+        for cfg_strength in [0.5, 4.5]:
+            two_pass = tiny_net.ode_wrapper(t, latent, conditions, empty_conditions, cfg_strength)
+            batched = tiny_net.ode_wrapper_batched(t, latent, joint_conditions, cfg_strength)
+            # the same math, but not bitwise: BLAS picks its kernels (and summation orders) by
+            # the matrix sizes, which differ between batches of B and 2B. In float64, that is
+            # at the level of rounding errors, far below the default tolerances.
+            torch.testing.assert_close(batched, two_pass, rtol=1e-12, atol=1e-12)
+
+
+@torch.inference_mode()
+def test_per_sample_cfg_strength(tiny_net, random_conditions):
+    bs = 3
+    conditions = tiny_net.preprocess_conditions(*random_conditions(tiny_net, bs))
+    empty_conditions = tiny_net.get_empty_conditions(bs)
+    joint_conditions = PreprocessedConditions.cat([conditions, empty_conditions])
+
+    latent = torch.randn(bs, tiny_net.latent_seq_len, tiny_net.latent_dim, dtype=torch.float64)
+    t = torch.tensor(0.3, dtype=torch.float64)
+    cfg_strength = torch.tensor([0.5, 2.0, 4.5], dtype=torch.float64)
+    batched = tiny_net.ode_wrapper_batched(t, latent, joint_conditions, cfg_strength)
+    for i in range(bs):
+        expected = tiny_net.ode_wrapper(t, latent[i:i + 1], conditions[i:i + 1],
+                                        empty_conditions[i:i + 1], cfg_strength[i].item())
+        torch.testing.assert_close(batched[i:i + 1], expected)
+
+
+@torch.inference_mode()
+def test_padded_batch_matches_individual_samples(tiny_net, random_conditions):
+    # per-sample (latent, clip, sync) lengths; the first one is the longest
+    seq_lens = [(43, 8, 24), (30, 6, 16), (21, 4, 8)]
+    clip_f, sync_f, text_f = random_conditions(tiny_net, len(seq_lens))
+    latent = torch.randn(len(seq_lens), 43, tiny_net.latent_dim, dtype=torch.float64)
+    t = torch.full((len(seq_lens), ), 0.4, dtype=torch.float64)
+
+    padded = tiny_net.preprocess_conditions(clip_f, sync_f, text_f, seq_lens=seq_lens)
+    padded_empty = tiny_net.get_cached_empty_conditions(len(seq_lens), seq_lengths=seq_lens)
+    flow = tiny_net.predict_flow(latent, t, padded)
+    empty_flow = tiny_net.predict_flow(latent, t, padded_empty)
+    for i, (latent_len, clip_len, sync_len) in enumerate(seq_lens):
+        conditions = tiny_net.preprocess_conditions(clip_f[i:i + 1, :clip_len],
+                                                    sync_f[i:i + 1, :sync_len],
+                                                    text_f[i:i + 1],
+                                                    latent_seq_len=latent_len)
+        empty_conditions = tiny_net.get_cached_empty_conditions(1,
+                                                                seq_lengths=(latent_len, clip_len,
+                                                                             sync_len))
+        x = latent[i:i + 1, :latent_len]
+        torch.testing.assert_close(flow[i:i + 1, :latent_len],
+                                   tiny_net.predict_flow(x, t[i:i + 1], conditions))
+        torch.testing.assert_close(empty_flow[i:i + 1, :latent_len],
+                                   tiny_net.predict_flow(x, t[i:i + 1], empty_conditions))
+
+
+@torch.no_grad()
+def test_cached_empty_conditions(tiny_net):
+    encoded = []
+
+    def encode_text(text: list[str]) -> torch.Tensor:
+        encoded.extend(text)
+        return torch.stack([torch.full_like(tiny_net.empty_string_feat, len(t)) for t in text])
+
+    expected = tiny_net.get_empty_conditions(2, negative_text_features=encode_text(['music'] * 2))
+    encoded.clear()
+
+    for _ in range(2):
+        cached = tiny_net.get_cached_empty_conditions(2,
+                                                      negative_text=['music'] * 2,
+                                                      encode_text=encode_text)
+        torch.testing.assert_close(cached.text_f, expected.text_f)
+        torch.testing.assert_close(cached.sync_f, expected.sync_f)
+    assert encoded == ['music']
+
+    mixed = tiny_net.get_cached_empty_conditions(2,
+                                                 negative_text=['music', 'speech'],
+                                                 encode_text=encode_text)
+    assert encoded == ['music', 'speech']
+    torch.testing.assert_close(mixed.text_f_c[0], expected.text_f_c[0])
+
+    tiny_net.load_weights(tiny_net.state_dict())
+    tiny_net.get_cached_empty_conditions(2, negative_text=['music'] * 2, encode_text=encode_text)
+    assert encoded == ['music', 'speech', 'music']
+
+
+@torch.inference_mode()
+def test_rotations_per_length(tiny_net, random_conditions):
+    assert tiny_net.get_rotations(43, 8) is tiny_net.get_rotations(43, 8)
+
+    # a request with a different duration, without mutating the network
+    clip_f, sync_f, text_f = random_conditions(tiny_net, 2)
+    clip_f, sync_f = clip_f[:, :4], sync_f[:, :16]
+    conditions = tiny_net.preprocess_conditions(clip_f, sync_f, text_f, latent_seq_len=21)
+    latent = torch.randn(2, 21, tiny_net.latent_dim, dtype=torch.float64)
+    t = torch.full((2, ), 0.5, dtype=torch.float64)
+    flow = tiny_net.predict_flow(latent, t, conditions)
+    assert tiny_net.latent_seq_len == 43
+
+    tiny_net.update_seq_lengths(21, 4, 16)
+    expected = tiny_net.predict_flow(latent, t, tiny_net.preprocess_conditions(clip_f, sync_f, text_f))
+    torch.testing.assert_close(flow, expected)
+
+
+@torch.inference_mode()
+def test_modulation_plan(tiny_net, random_conditions):
+    fm = FlowMatching(inference_mode='rk4', num_steps=4)
+    conditions = tiny_net.preprocess_conditions(*random_conditions(tiny_net, 2))
+    empty_conditions = tiny_net.get_empty_conditions(2)
+    x0 = torch.randn(2, tiny_net.latent_seq_len, tiny_net.latent_dim, dtype=torch.float64)
+    expected = fm.to_data(
+        lambda t, x: tiny_net.ode_wrapper(t, x, conditions, empty_conditions, 4.5), x0)
+
+    times = fm.get_evaluation_times(0, 1)
+    assert len(times) == 9
+    conditions.modulation = tiny_net.build_modulation_plan(times, conditions)
+    empty_conditions.modulation = tiny_net.build_modulation_plan(times, empty_conditions)
+    assert conditions.modulation.get(times[3]) is not None
+    x1 = fm.to_data(lambda t, x: tiny_net.ode_wrapper(t, x, conditions, empty_conditions, 4.5), x0)
+    torch.testing.assert_close(x1, expected)
+
+    # a plan of another schedule is not silently ignored
+    with pytest.raises(AssertionError, match='modulation plan'):
+        FlowMatching(inference_mode='euler', num_steps=3).to_data(
+            lambda t, x: tiny_net.ode_wrapper(t, x, conditions, empty_conditions, 4.5), x0)
+
+
+@torch.inference_mode()
+def test_fused_block_cache(tiny_net, random_conditions):
+    conditions = tiny_net.preprocess_conditions(*random_conditions(tiny_net, 2))
+    latent = torch.randn(2, tiny_net.latent_seq_len, tiny_net.latent_dim, dtype=torch.float64)
+    t = torch.full((2, ), 0.5, dtype=torch.float64)
+    expected = tiny_net.predict_flow(latent, t, conditions)
+
+    conditions.fused_block_cache = FusedBlockCache(refresh_interval=3)
+    for _ in range(4):
+        # the same input each time, so reusing the residual is exact
+        torch.testing.assert_close(tiny_net.predict_flow(latent, t, conditions), expected)
+    assert conditions.fused_block_cache.num_reused == 2
+
+
+@torch.inference_mode()
+def test_fused_block_cache_unguided_steps(tiny_net, random_conditions):
+    bs = 2
+    conditions = tiny_net.preprocess_conditions(*random_conditions(tiny_net, bs))
+    joint_conditions = PreprocessedConditions.cat([conditions, tiny_net.get_empty_conditions(bs)])
+    latent = torch.randn(bs, tiny_net.latent_seq_len, tiny_net.latent_dim, dtype=torch.float64)
+    t = torch.tensor(0.5, dtype=torch.float64)
+    expected = tiny_net.predict_flow(latent, t.expand(bs), conditions)
+
+    cache = joint_conditions.fused_block_cache = FusedBlockCache(refresh_interval=4)
+    tiny_net.ode_wrapper_batched(t, latent, joint_conditions, 4.5)
+    # the unguided steps (e.g., after adaptive guidance converged) reuse the rows of the
+    # conditional branch, and refresh them
+    for _ in range(3):
+        torch.testing.assert_close(tiny_net.ode_wrapper_batched(t, latent, joint_conditions, 0.0),
+                                   expected)
+    assert cache.num_reused == 3
+    torch.testing.assert_close(tiny_net.ode_wrapper_batched(t, latent, joint_conditions, 0.0),
+                               expected)
+    assert cache.num_reused == 3
+    assert cache.residual.shape[0] == 2 * bs
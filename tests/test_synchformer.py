@@ -0,0 +1,28 @@
+import pytest
+import torch
+
+from mmaudio.ext.synchformer.vit_helper import DividedAttention
+
+
+@pytest.mark.parametrize('einops_to', ['(b f) n d', '(b n) f d'])
+@pytest.mark.parametrize('masked', [False, True])
+def test_fused_divided_attention(einops_to, masked):
+    torch.manual_seed(0)
+    attn = DividedAttention(32, num_heads=4, qkv_bias=True).double()
+    with torch.no_grad():
+        for p in attn.parameters():
+            p.normal_(std=0.2)
+
+    num_frames, num_patches = 4, 6
+    x = torch.randn(2, 1 + num_frames * num_patches, 32, dtype=torch.float64)
+    tok_mask = None
+    if masked:
+        tok_mask = torch.ones(2, x.shape[1], dtype=torch.long)
+        tok_mask[1, 5:9] = 0  # the CLS token is kept, so that no row is fully masked
+    kwargs = dict(tok_mask=tok_mask, f=num_frames) if einops_to.startswith('(b f)') else dict(
+        tok_mask=tok_mask, n=num_patches)
+
+    out = attn(x, 'b (f n) d', einops_to, **kwargs)
+    attn.fused_attn = False
+    expected = attn(x, 'b (f n) d', einops_to, **kwargs)
+    torch.testing.assert_close(out, expected)